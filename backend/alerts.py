@@ -0,0 +1,454 @@
+"""
+Alert dispatch for SmartSense.
+
+Status transitions of each device are escalated to external sinks
+(webhooks, an email relay, a SCADA listener) without ever slowing ingest:
+
+- AlertTracker confirms transitions per device on the ingest path (a dict
+  lookup per reading). A higher status must hold ALERT_DEBOUNCE_SECONDS and
+  a lower one ALERT_HOLD_SECONDS before it counts, so a gas reading
+  hovering around a threshold raises one alert instead of a storm. The same
+  alert for a device is not repeated within ALERT_DEDUP_SECONDS, unless a
+  confirmed return to SAFE ended the incident in between.
+- AlertDispatcher queues each confirmed alert once per sink on a bounded
+  queue drained by a pool of worker tasks. Failed deliveries are retried
+  with exponential backoff, off the queue, so a slow or failing sink never
+  holds up the others. When the queue is full, deliveries are dropped and
+  counted instead of buffering without bound.
+"""
+
+import asyncio
+import json
+import os
+import random
+import secrets
+import smtplib
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from logger import log
+from metrics import REGISTRY
+from rules import STATUS_LEVELS, STATUS_NAMES
+
+# Lowest status whose transitions are dispatched (into or out of it)
+ALERT_MIN_STATUS = os.getenv("ALERT_MIN_STATUS", "DANGER")
+
+# Seconds a higher status must persist before its alert is confirmed
+# (0 escalates on the first reading; raise it to ignore single spikes)
+ALERT_DEBOUNCE_SECONDS = float(os.getenv("ALERT_DEBOUNCE_SECONDS", "0"))
+
+# Seconds a lower status must persist before the all-clear is confirmed
+ALERT_HOLD_SECONDS = float(os.getenv("ALERT_HOLD_SECONDS", "30"))
+
+# Seconds during which a repeat of the same device/status alert is dropped
+ALERT_DEDUP_SECONDS = float(os.getenv("ALERT_DEDUP_SECONDS", "300"))
+
+# Readings taken longer than this before they arrive (a gateway's spool
+# flushed after an outage) are stored but never raise alerts
+ALERT_MAX_AGE = float(os.getenv("ALERT_MAX_AGE", "300"))
+
+# Sinks: comma-separated webhook URLs, email recipients and SCADA listeners
+ALERT_WEBHOOK_URLS = os.getenv("ALERT_WEBHOOK_URLS", "")
+ALERT_EMAIL_TO = os.getenv("ALERT_EMAIL_TO", "")
+ALERT_SMTP_HOST = os.getenv("ALERT_SMTP_HOST", "localhost")
+ALERT_SMTP_PORT = int(os.getenv("ALERT_SMTP_PORT", "25"))
+ALERT_EMAIL_FROM = os.getenv("ALERT_EMAIL_FROM", "smartsense@localhost")
+# tcp://host:port listeners that take one JSON alert per line
+ALERT_SCADA_URLS = os.getenv("ALERT_SCADA_URLS", "")
+
+# Deliveries waiting for a worker before new ones are dropped
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "1000"))
+
+# Concurrent deliveries
+ALERT_WORKERS = int(os.getenv("ALERT_WORKERS", "4"))
+
+# Retries per delivery; the delay doubles from ALERT_RETRY_DELAY up to ALERT_RETRY_MAX_DELAY
+ALERT_RETRIES = int(os.getenv("ALERT_RETRIES", "5"))
+ALERT_RETRY_DELAY = float(os.getenv("ALERT_RETRY_DELAY", "1"))
+ALERT_RETRY_MAX_DELAY = float(os.getenv("ALERT_RETRY_MAX_DELAY", "60"))
+
+# Seconds a single delivery may take
+ALERT_TIMEOUT = float(os.getenv("ALERT_TIMEOUT", "10"))
+
+# Confirmed alerts kept for GET /alerts
+ALERT_RECENT = 100
+
+ALERTS_TOTAL = REGISTRY.counter(
+    "smartsense_alerts_total", "Confirmed status-transition alerts, by new status", "status"
+)
+ALERTS_SUPPRESSED = REGISTRY.counter(
+    "smartsense_alerts_suppressed_total", "Alerts dropped as repeats within ALERT_DEDUP_SECONDS"
+)
+ALERT_DELIVERIES = REGISTRY.counter(
+    "smartsense_alert_deliveries_total", "Alerts delivered, by sink", "sink"
+)
+ALERT_FAILURES = REGISTRY.counter(
+    "smartsense_alert_failures_total", "Alerts given up on after all retries, by sink", "sink"
+)
+ALERT_RETRIES_TOTAL = REGISTRY.counter(
+    "smartsense_alert_retries_total", "Delivery attempts retried, by sink", "sink"
+)
+ALERTS_DROPPED = REGISTRY.counter(
+    "smartsense_alerts_dropped_total", "Deliveries dropped because the alert queue was full"
+)
+
+
+class AlertTracker:
+    """Per-device status transition detection with debounce, hold-down and dedup."""
+
+    def __init__(self, debounce: float = ALERT_DEBOUNCE_SECONDS,
+                 hold: float = ALERT_HOLD_SECONDS, dedup: float = ALERT_DEDUP_SECONDS,
+                 min_status: str = ALERT_MIN_STATUS):
+        if min_status not in STATUS_LEVELS:
+            raise ValueError(f"ALERT_MIN_STATUS must be one of {', '.join(STATUS_NAMES)}")
+        self.debounce = debounce
+        self.hold = hold
+        self.dedup = dedup
+        self.min_level = STATUS_LEVELS[min_status]
+        # device_id -> [confirmed level, candidate level, candidate since]
+        self.devices: Dict[str, list] = {}
+        # (device_id, level) -> when that alert was last raised
+        self.last_raised: Dict[Tuple[str, int], float] = {}
+
+    def observe(self, reading: dict, timestamp: float) -> Optional[dict]:
+        """Feed one classified reading; returns an alert when a transition is confirmed."""
+        device_id = reading["device_id"]
+        level = STATUS_LEVELS[reading["status"]]
+        state = self.devices.get(device_id)
+        if state is None:
+            state = self.devices[device_id] = [0, 0, timestamp]  # Devices start SAFE
+        if level == state[0]:
+            state[1] = level
+            return None
+        if level != state[1]:
+            state[1] = level
+            state[2] = timestamp
+        window = self.debounce if level > state[0] else self.hold
+        if timestamp - state[2] < window:
+            return None
+
+        previous = state[0]
+        state[0] = level
+        if level == 0:
+            # A confirmed all-clear ends the incident: the next escalation is a new one
+            for raised in range(1, len(STATUS_NAMES)):
+                self.last_raised.pop((device_id, raised), None)
+        if max(level, previous) < self.min_level:
+            return None
+        key = (device_id, level)
+        last = self.last_raised.get(key)
+        if last is not None and timestamp - last < self.dedup:
+            ALERTS_SUPPRESSED.inc()
+            return None
+        self.last_raised[key] = timestamp
+
+        status = STATUS_NAMES[level]
+        ALERTS_TOTAL.inc(1, status)
+        return {
+            "id": secrets.token_hex(8),
+            "device_id": device_id,
+            "status": status,
+            "previous": STATUS_NAMES[previous],
+            "timestamp": datetime.fromtimestamp(timestamp, timezone.utc).isoformat(),
+            "reading": reading,
+        }
+
+
+class Sink:
+    """Interface for alert destinations."""
+
+    name = "sink"
+
+    async def send(self, alert: dict):
+        """Deliver one alert; raise on failure so it is retried."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class BlockingSink(Sink):
+    """A sink whose client library blocks; deliveries run on its own threads."""
+
+    def __init__(self, threads: int = ALERT_WORKERS):
+        # Not the shared default pool: a hung sink must not starve /history reads
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix=f"alert-{self.name}")
+
+    def deliver(self, alert: dict):
+        raise NotImplementedError
+
+    async def send(self, alert: dict):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.deliver, alert)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class WebhookSink(Sink):
+    """
+    POSTs each alert as JSON over keep-alive HTTP/1.1 connections.
+
+    Written on asyncio streams rather than a blocking client on threads:
+    those threads contend with the event loop for the GIL and show up in
+    /data latency while a delivery is in flight. Idle connections are
+    pooled, one per concurrent delivery.
+    """
+
+    name = "webhook"
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError(f"Webhook URL must be http(s)://host[:port]/path, got '{url}'")
+        self.name = f"webhook:{parsed.hostname}" + (f":{parsed.port}" if parsed.port else "")
+        self.host = parsed.hostname
+        self.ssl = parsed.scheme == "https"
+        self.port = parsed.port or (443 if self.ssl else 80)
+        target = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        headers = [f"POST {target} HTTP/1.1", f"Host: {parsed.netloc.rpartition('@')[2]}",
+                   "Content-Type: application/json"]
+        if parsed.username is not None:
+            credentials = f"{unquote(parsed.username)}:{unquote(parsed.password or '')}"
+            headers.append(f"Authorization: Basic {b64encode(credentials.encode()).decode()}")
+        self.head = "\r\n".join(headers)
+        self.idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def send(self, alert: dict):
+        request = json.dumps(alert).encode()
+        request = f"{self.head}\r\nContent-Length: {len(request)}\r\n\r\n".encode() + request
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if writer.is_closing():
+                continue
+            try:
+                status = await self._exchange(reader, writer, request)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                continue  # Closed by the server while idle: try the next one
+            break
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port,
+                                                           ssl=self.ssl or None)
+            status = await self._exchange(reader, writer, request)
+        if status >= 400:
+            raise ConnectionError(f"Webhook answered {status}")
+
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                        request: bytes) -> int:
+        """Send one request and read its response; the connection is pooled if reusable."""
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            parts = status_line.split()
+            if len(parts) < 2 or not parts[1].isdigit():
+                raise ConnectionError("No HTTP response from webhook")
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip().lower()
+            if "chunked" in headers.get("transfer-encoding", ""):
+                while size := int((await reader.readline()).split(b";")[0], 16):
+                    await reader.readexactly(size + 2)
+                await reader.readline()
+            elif "content-length" in headers:
+                await reader.readexactly(int(headers["content-length"]))
+            else:
+                headers["connection"] = "close"  # Body runs to the end of the connection
+        except BaseException:
+            writer.close()
+            raise
+        if headers.get("connection") == "close" or parts[0] == b"HTTP/1.0":
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+        return int(parts[1])
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class EmailSink(BlockingSink):
+    """Sends each alert through an SMTP relay."""
+
+    name = "email"
+
+    def __init__(self, recipients: List[str], host: str = ALERT_SMTP_HOST,
+                 port: int = ALERT_SMTP_PORT, sender: str = ALERT_EMAIL_FROM,
+                 timeout: float = ALERT_TIMEOUT):
+        super().__init__(threads=1)  # One SMTP conversation at a time
+        self.recipients = recipients
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+
+    def deliver(self, alert: dict):
+        reading = alert["reading"]
+        message = EmailMessage()
+        message["Subject"] = (f"[SmartSense] {alert['device_id']}: "
+                              f"{alert['previous']} -> {alert['status']}")
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(
+            f"Device {alert['device_id']} changed from {alert['previous']} to "
+            f"{alert['status']} at {alert['timestamp']}.\n\n"
+            f"Temperature: {reading['temperature']} °C\n"
+            f"Gas level: {reading['gas_level']} PPM\n"
+            f"Humidity: {reading['humidity']} %\n"
+        )
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+
+class ScadaSink(Sink):
+    """Writes each alert as a JSON line to a SCADA listener over TCP."""
+
+    name = "scada"
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        if parsed.scheme != "tcp" or not parsed.port:
+            raise ValueError(f"SCADA sink URL must be tcp://host:port, got '{url}'")
+        self.name = f"scada:{parsed.netloc}"
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def send(self, alert: dict):
+        if self.writer is None or self.writer.is_closing():
+            _, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            self.writer.write(json.dumps(alert).encode() + b"\n")
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.writer.close()
+            self.writer = None  # Reconnect on the retry
+            raise
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _split(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def create_sinks() -> List[Sink]:
+    """Build the sinks configured by the ALERT_* environment variables."""
+    sinks: List[Sink] = [WebhookSink(url) for url in _split(ALERT_WEBHOOK_URLS)]
+    if _split(ALERT_EMAIL_TO):
+        sinks.append(EmailSink(_split(ALERT_EMAIL_TO)))
+    sinks += [ScadaSink(url) for url in _split(ALERT_SCADA_URLS)]
+    return sinks
+
+
+def alert_payload(alert: dict) -> dict:
+    """What a sink is sent: a copy of the alert, without the dispatcher's delivery state."""
+    payload = {key: value for key, value in alert.items() if key != "deliveries"}
+    payload["reading"] = dict(alert["reading"])
+    return payload
+
+
+# A queued delivery: (sink, alert, attempt number)
+Delivery = Tuple[Sink, dict, int]
+
+
+class AlertDispatcher:
+    """Bounded delivery queue drained by worker tasks, with retry and backoff."""
+
+    def __init__(self, sinks: List[Sink], queue_size: int = ALERT_QUEUE_SIZE,
+                 workers: int = ALERT_WORKERS, retries: int = ALERT_RETRIES,
+                 retry_delay: float = ALERT_RETRY_DELAY,
+                 retry_max_delay: float = ALERT_RETRY_MAX_DELAY,
+                 timeout: float = ALERT_TIMEOUT):
+        self.sinks = sinks
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.recent: Deque[dict] = deque(maxlen=ALERT_RECENT)
+        self._tasks: List[asyncio.Task] = []
+        self._retry_timers: set = set()
+
+    async def start(self):
+        if self.sinks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+            log.info("🚨 Alert dispatch to %s", ", ".join(sink.name for sink in self.sinks))
+
+    async def stop(self):
+        for timer in self._retry_timers:
+            timer.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for sink in self.sinks:
+            await sink.close()
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def submit(self, alert: dict):
+        """Queue an alert for every sink. Never blocks."""
+        log.warning("🚨 %s: %s -> %s", alert["device_id"], alert["previous"], alert["status"],
+                    extra={"fields": {key: alert[key] for key in
+                                      ("id", "device_id", "previous", "status")}})
+        alert["deliveries"] = {}
+        self.recent.append(alert)
+        for sink in self.sinks:
+            self._enqueue((sink, alert, 0))
+
+    def _enqueue(self, delivery: Delivery):
+        sink, alert, _ = delivery
+        try:
+            self.queue.put_nowait(delivery)
+        except asyncio.QueueFull:
+            ALERTS_DROPPED.inc()
+            alert["deliveries"][sink.name] = "dropped"
+            return
+        alert["deliveries"][sink.name] = "pending"
+
+    def _retry(self, delivery: Delivery):
+        sink, alert, attempt = delivery
+        ALERT_RETRIES_TOTAL.inc(1, sink.name)
+        # Exponential backoff with jitter, so retries to a sink that was down don't arrive at once
+        delay = min(self.retry_delay * 2 ** attempt, self.retry_max_delay)
+        delay *= random.uniform(0.5, 1.0)
+        loop = asyncio.get_running_loop()
+
+        def requeue():
+            self._retry_timers.discard(timer)
+            self._enqueue((sink, alert, attempt + 1))
+
+        timer = loop.call_later(delay, requeue)
+        self._retry_timers.add(timer)
+
+    async def _work(self):
+        while True:
+            delivery = await self.queue.get()
+            sink, alert, attempt = delivery
+            try:
+                await asyncio.wait_for(sink.send(alert_payload(alert)), self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt < self.retries:
+                    alert["deliveries"][sink.name] = "retrying"
+                    self._retry(delivery)
+                else:
+                    ALERT_FAILURES.inc(1, sink.name)
+                    alert["deliveries"][sink.name] = "failed"
+                    log.error("❌ Alert %s to %s failed after %d attempts: %s",
+                              alert["id"], sink.name, attempt + 1, e)
+            else:
+                ALERT_DELIVERIES.inc(1, sink.name)
+                alert["deliveries"][sink.name] = "sent"
@@ -7,6 +7,13 @@ Usage:
 2. Upload the Arduino sketch to your ESP32/Arduino board
 3. Run this script: python arduino_reader.py
 4. Connect Arduino via USB - the script will auto-detect the COM port
+
+Readings are handed to a background uplink (uplink.py) that batches them to
+/data/batch over a keep-alive connection and spools them to disk while the
+backend is unreachable, so serial reads never wait on the network.
+
+With CAPTURE=true every raw line is also recorded to captures/ for
+replay.py (see capture.py).
 """
 
 import serial
@@ -14,9 +21,20 @@ import serial.tools.list_ports
 import requests
 import time
 import re
-from typing import Optional, Dict
+from typing import Optional, Dict, List
+
+from capture import open_capture
+from uplink import Uplink
+
+
+# Common Arduino board descriptions
+ARDUINO_KEYWORDS = ["Arduino", "CH340", "CP210x", "FTDI", "USB"]
 
-API_URL = "http://localhost:8000/data"
+
+def is_arduino_port(port) -> bool:
+    """Whether a port from list_ports looks like an Arduino board."""
+    description = (port.description or "").lower()
+    return any(keyword.lower() in description for keyword in ARDUINO_KEYWORDS)
 
 
 def find_arduino_port() -> Optional[str]:
@@ -34,14 +52,10 @@ def find_arduino_port() -> Optional[str]:
     for port in ports:
         print(f"  - {port.device}: {port.description}")
     
-    # Common Arduino board descriptions
-    arduino_keywords = ["Arduino", "CH340", "CP210x", "FTDI", "USB"]
-    
     for port in ports:
-        for keyword in arduino_keywords:
-            if keyword.lower() in port.description.lower():
-                print(f"\n✅ Found Arduino on: {port.device}")
-                return port.device
+        if is_arduino_port(port):
+            print(f"\n✅ Found Arduino on: {port.device}")
+            return port.device
     
     # If no keyword match, use first available port
     first_port = ports[0].device
@@ -50,6 +64,52 @@ def find_arduino_port() -> Optional[str]:
     return first_port
 
 
+# Known serial output formats, compiled once. Matched on raw bytes so lines
+# that are readings never need decoding; "°" may arrive as UTF-8 or Latin-1.
+SENSOR_PATTERNS = (
+    # Temp: 25.5°C | Humidity: 60.2% | Smoke Level: 250 (actual)
+    re.compile(rb"Temp:\s*([\d.]+)(?:\xc2?\xb0)?C?\s*\|\s*Humidity:\s*([\d.]+)%?\s*\|"
+               rb"\s*Smoke\s*Level:\s*(\d+)"),
+    # Temp: 25.5| Humidity: 60.2C | Smoke: 250 (original)
+    re.compile(rb"Temp:\s*([\d.]+)\|\s*Humidity:\s*([\d.]+)C\s*\|\s*Smoke:\s*(\d+)"),
+)
+
+# Longest partial line kept while waiting for its newline (guards against noise)
+MAX_LINE_BYTES = 1024
+
+
+class SensorLineParser:
+    """Parses sensor lines, trying the format that matched last time first."""
+
+    def __init__(self, patterns=SENSOR_PATTERNS):
+        self.patterns = patterns
+        self.current = patterns[0]
+
+    def parse(self, line: bytes) -> Optional[Dict]:
+        match = self.current.search(line)
+        if match is None:
+            for pattern in self.patterns:
+                if pattern is not self.current:
+                    match = pattern.search(line)
+                    if match is not None:
+                        self.current = pattern  # The device's format; cache it
+                        break
+            else:
+                return None
+        try:
+            return {
+                "temperature": float(match.group(1)),
+                "humidity": float(match.group(2)),
+                "gas_level": int(match.group(3))
+            }
+        except ValueError as e:
+            print(f"❌ Error parsing: {e}")
+            return None
+
+
+_parser = SensorLineParser()
+
+
 def parse_sensor_data(line: str) -> Optional[Dict]:
     """
     Parse sensor data from Arduino serial output.
@@ -65,53 +125,40 @@ def parse_sensor_data(line: str) -> Optional[Dict]:
         "gas_level": 250
     }
     """
-    try:
-        # Try pattern 1: Temp: 25.5°C | Humidity: 60.2% | Smoke Level: 250
-        pattern1 = r"Temp:\s*([\d.]+)°?C?\s*\|\s*Humidity:\s*([\d.]+)%?\s*\|\s*Smoke\s*Level:\s*(\d+)"
-        match = re.search(pattern1, line)
-        
-        # Try pattern 2 (original): Temp: 25.5| Humidity: 60.2C | Smoke: 250
-        if not match:
-            pattern2 = r"Temp:\s*([\d.]+)\|\s*Humidity:\s*([\d.]+)C\s*\|\s*Smoke:\s*(\d+)"
-            match = re.search(pattern2, line)
-        if match:
-            temperature = float(match.group(1))
-            humidity = float(match.group(2))
-            gas_level = int(match.group(3))
-            
-            return {
-                "temperature": temperature,
-                "humidity": humidity,
-                "gas_level": gas_level
-            }
-    except (ValueError, AttributeError) as e:
-        print(f"❌ Error parsing: {e}")
-    
-    return None
+    return _parser.parse(line.encode("utf-8"))
 
 
-def send_data_to_backend(data: Dict) -> bool:
-    """Send parsed sensor data to backend API."""
-    try:
-        response = requests.post(API_URL, json=data, timeout=5)
-        
-        if response.status_code == 200:
-            print(f"✅ Temp: {data['temperature']}°C | Humidity: {data['humidity']}% | "
-                  f"Gas: {data['gas_level']} PPM")
-            return True
-        else:
-            print(f"❌ Backend error: {response.status_code} - {response.text}")
-            return False
-            
-    except requests.exceptions.ConnectionError:
-        print("❌ Cannot connect to backend. Is it running? (uvicorn main:app --reload)")
-        return False
-    except requests.exceptions.Timeout:
-        print("❌ Backend request timeout")
-        return False
-    except Exception as e:
-        print(f"❌ Error sending data: {e}")
-        return False
+class SerialLineReader:
+    """
+    Blocking line reader over a serial port that works on bulk buffers.
+
+    Each read blocks until data arrives (or the port timeout passes) and then
+    takes everything already buffered, so there is no polling delay and no
+    per-byte work: lines are split with one bytes.split per chunk.
+    """
+
+    def __init__(self, port, max_line: int = MAX_LINE_BYTES):
+        self.port = port
+        self.max_line = max_line
+        self.partial = b""
+
+    def read_lines(self) -> List[bytes]:
+        """Complete lines received so far (empty if the read timed out)."""
+        port = self.port
+        chunk = port.read(port.in_waiting or 1)
+        if not chunk:
+            return []
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        if len(self.partial) > self.max_line:
+            self.partial = b""  # No newline in sight: drop the noise
+        return [line.strip() for line in lines]
+
+
+def print_reading(data: Dict):
+    """Echo a reading handed to the uplink."""
+    print(f"📤 Temp: {data['temperature']}°C | Humidity: {data['humidity']}% | "
+          f"Gas: {data['gas_level']} PPM")
 
 
 def main():
@@ -149,45 +196,52 @@ def main():
         print("⚠️  Backend might not be running. Start it with:")
         print("   uvicorn main:app --reload\n")
     
+    # Network I/O happens on the uplink thread, never in the serial loop
+    uplink = Uplink()
+    uplink.start()
+    
     print("📊 Streaming real-time sensor data...")
     print("(Press Ctrl+C to stop)\n")
     
+    capture = open_capture("serial")
+    if capture:
+        print(f"🎙️  Capturing raw lines to {capture.path}\n")
     consecutive_errors = 0
     max_consecutive_errors = 10
+    reader = SerialLineReader(ser)
+    parser = SensorLineParser()
     
     try:
         while True:
-            try:
-                if ser.in_waiting:
-                    line = ser.readline().decode('utf-8').strip()
-                    
-                    if line:
-                        # Parse sensor data
-                        data = parse_sensor_data(line)
-                        
-                        if data:
-                            # Send to backend
-                            success = send_data_to_backend(data)
-                            if success:
-                                consecutive_errors = 0
-                            else:
-                                consecutive_errors += 1
-                        else:
-                            # Sometimes Arduino prints other messages
-                            if "System Online" in line or "Testing" in line or "BUZZER" in line:
-                                print(f"📱 {line}")
-                
-                time.sleep(0.1)
-                
-            except UnicodeDecodeError:
-                print("⚠️  Serial decode error, skipping line")
-                consecutive_errors += 1
+            # Blocks until bytes arrive, then takes everything buffered
+            for line in reader.read_lines():
+                if not line:
+                    continue
+                if capture:
+                    capture.record("serial", line, device=port)
+                data = parser.parse(line)
+                if data:
+                    # Queue for upload; returns immediately
+                    uplink.submit(data)
+                    print_reading(data)
+                    consecutive_errors = 0
+                    continue
+                try:
+                    text = line.decode('utf-8')
+                except UnicodeDecodeError:
+                    print("⚠️  Serial decode error, skipping line")
+                    consecutive_errors += 1
+                    continue
+                # Sometimes Arduino prints other messages
+                if "System Online" in text or "Testing" in text or "BUZZER" in text:
+                    print(f"📱 {text}")
             
             if consecutive_errors >= max_consecutive_errors:
                 print(f"\n❌ Too many consecutive errors ({max_consecutive_errors}). Reconnecting...")
                 ser.close()
                 time.sleep(2)
                 ser = serial.Serial(port, 115200, timeout=1)
+                reader = SerialLineReader(ser)
                 consecutive_errors = 0
     
     except KeyboardInterrupt:
@@ -198,6 +252,11 @@ def main():
         if ser.is_open:
             ser.close()
             print("✅ Serial connection closed")
+        uplink.stop()
+        print(f"📦 Uplink: {uplink.sent} sent, {len(uplink.spool)} spooled for next run")
+        if capture:
+            capture.stop()
+            print(f"🎙️  Captured {capture.written} lines to {capture.path}")
 
 
 if __name__ == "__main__":
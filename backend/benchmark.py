@@ -0,0 +1,1519 @@
+"""
+Backend Benchmarks for SmartSense Safety Monitoring System
+Runs in-process micro-benchmarks against the FastAPI app - no server needed.
+Correctness checks along the way assert, so a failing one stops the run.
+
+Usage:
+    python benchmark.py              # run every benchmark
+    python benchmark.py batch fanout # run selected benchmarks by name
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+import numpy as np
+import requests
+from websockets.sync.client import connect as ws_connect
+
+# Endpoint benchmarks must not write into the real data directory
+os.environ.setdefault("STORAGE_BACKEND", "none")
+
+import logging
+
+import main
+from alerts import AlertDispatcher, AlertTracker, ScadaSink, WebhookSink
+from arduino_reader import SensorLineParser, SerialLineReader
+from capture import open_capture
+from compressed_history import CompressedHistory
+from connections import ConnectionManager
+from export import decode_columnar
+from history import TimeSeriesRing
+from load_test import spawn_server
+from logger import log, setup_logging
+from metrics import Counter, Histogram
+from replay import BackendReplay, load_records
+from rollups import RollupStore
+from rules import DEFAULT_RULES, RuleEngine
+from sessions import MemorySessionStore
+from simulate_sensors import FleetSimulator
+from stats import METRICS, RollingWindow, StatsTracker
+from storage import NullStorage, SegmentedLogStorage, encode_device_id
+
+
+def make_readings(count: int, seed: int = 42) -> List[dict]:
+    """Generate reproducible sensor readings for benchmarks."""
+    rng = random.Random(seed)
+    return [
+        {
+            "temperature": round(25 + rng.random() * 25, 1),
+            "gas_level": int(150 + rng.random() * 1000),
+            "humidity": round(40 + rng.random() * 30, 1)
+        }
+        for _ in range(count)
+    ]
+
+
+async def asgi_request(app, method: str, path: str, body: bytes = b"",
+                       content_type: str = "application/json") -> int:
+    """Push one HTTP request through the ASGI app and return the status code."""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"host", b"benchmark"),
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def asgi_stream(app, path: str, keep: bool = False) -> tuple:
+    """GET a streamed response through the ASGI app: (status, bytes, chunks, body if kept)."""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"benchmark")],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    status = size = chunks = 0
+    kept = []
+    inbox: asyncio.Queue = asyncio.Queue()
+    inbox.put_nowait({"type": "http.request", "body": b"", "more_body": False})
+
+    async def send(message):
+        nonlocal status, size, chunks
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and message.get("body"):
+            size += len(message["body"])
+            chunks += 1
+            if keep:
+                kept.append(message["body"])
+
+    # The request, then nothing: a client that stays connected until the end
+    await app(scope, inbox.get, send)
+    return status, size, chunks, b"".join(kept)
+
+
+async def asgi_ingest(app, frames: List[str], query: bytes = b"") -> List[str]:
+    """Stream frames over the /ingest WebSocket, waiting for each ack like a device."""
+    inbox: asyncio.Queue = asyncio.Queue()
+    replies: asyncio.Queue = asyncio.Queue()
+    scope = {
+        "type": "websocket",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "scheme": "ws",
+        "path": "/ingest",
+        "raw_path": b"/ingest",
+        "query_string": query,
+        "root_path": "",
+        "headers": [(b"host", b"benchmark")],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+        "subprotocols": [],
+    }
+
+    async def send(message):
+        if message["type"] == "websocket.send":
+            replies.put_nowait(message["text"])
+
+    inbox.put_nowait({"type": "websocket.connect"})
+    task = asyncio.create_task(app(scope, inbox.get, send))
+    acks = []
+    for frame in frames:
+        inbox.put_nowait({"type": "websocket.receive", "text": frame})
+        acks.append(await replies.get())
+    inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+    await task
+    return acks
+
+
+def report(name: str, count: int, elapsed: float, unit: str = "readings"):
+    """Print one benchmark result line."""
+    rate = count / elapsed if elapsed > 0 else float("inf")
+    print(f"  {name:<32} {count:>8} {unit} in {elapsed * 1000:8.1f} ms "
+          f"-> {rate:12,.0f} {unit}/s")
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence per-reading log and print output while timing."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        setup_logging(stream=devnull)
+        try:
+            yield
+        finally:
+            setup_logging()
+
+
+def bench_batch(count: int = 5000, batch_size: int = 500):
+    """Compare POST /data (one reading per request) with POST /data/batch."""
+    readings = make_readings(count)
+    single_bodies = [json.dumps(r).encode() for r in readings]
+    array_bodies = [
+        json.dumps(readings[i:i + batch_size]).encode()
+        for i in range(0, count, batch_size)
+    ]
+    ndjson_bodies = [
+        "\n".join(json.dumps(r) for r in readings[i:i + batch_size]).encode()
+        for i in range(0, count, batch_size)
+    ]
+
+    async def run():
+        with quiet():
+            start = time.perf_counter()
+            for body in single_bodies:
+                await asgi_request(main.app, "POST", "/data", body)
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for body in array_bodies:
+                await asgi_request(main.app, "POST", "/data/batch", body)
+            array = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for body in ndjson_bodies:
+                await asgi_request(main.app, "POST", "/data/batch", body,
+                                   "application/x-ndjson")
+            ndjson = time.perf_counter() - start
+        return single, array, ndjson
+
+    single, array, ndjson = asyncio.run(run())
+    report("POST /data", count, single)
+    report(f"POST /data/batch (json x{batch_size})", count, array)
+    report(f"POST /data/batch (ndjson x{batch_size})", count, ndjson)
+    print(f"  batch speedup: {single / array:.1f}x (json), {single / ndjson:.1f}x (ndjson)")
+
+
+class FakeWebSocket:
+    """Stand-in dashboard socket; a non-zero delay simulates a slow client."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.received = 0
+        self.bytes = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+        self.bytes += len(message.encode())
+
+    async def send_bytes(self, message: bytes):
+        self.received += 1
+        self.bytes += len(message)
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+class DeflateWebSocket(FakeWebSocket):
+    """Socket with permessage-deflate: each connection compresses every frame itself."""
+
+    def __init__(self):
+        super().__init__()
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+
+    async def send_text(self, message: str):
+        # Context takeover, as browsers negotiate it; the flush marker is stripped
+        data = self.compressor.compress(message.encode()) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        await self.send_bytes(data[:-4])
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of samples."""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def bench_fanout(clients: int = 500, slow_clients: int = 10, messages: int = 200):
+    """Broadcast latency with hundreds of dashboards, a few of them stalled."""
+    message = json.dumps(make_readings(1)[0])
+
+    async def run():
+        manager = ConnectionManager(max_queue=50, policy="drop_oldest", replay_size=0)
+        sockets = [FakeWebSocket(0.05 if i < slow_clients else 0.0)
+                   for i in range(clients)]
+        with quiet():
+            for ws in sockets:
+                await manager.connect(ws)
+
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(messages):
+            t0 = time.perf_counter()
+            await manager.broadcast(message)
+            latencies.append(time.perf_counter() - t0)
+            await asyncio.sleep(0.001)  # readings arrive spaced out, not back to back
+        elapsed = time.perf_counter() - start
+
+        # Let fast clients drain what is still queued before counting deliveries
+        fast = [manager.active_connections[ws] for ws in sockets[slow_clients:]]
+        while any(client.queue for client in fast):
+            await asyncio.sleep(0)
+
+        fast_received = sum(ws.received for ws in sockets[slow_clients:])
+        dropped = sum(c.dropped for c in manager.active_connections.values())
+        with quiet():
+            for ws in sockets:
+                manager.disconnect(ws)
+        await asyncio.sleep(0)
+        return latencies, elapsed, fast_received, dropped
+
+    latencies, elapsed, fast_received, dropped = asyncio.run(run())
+    report(f"broadcast to {clients} clients", messages, elapsed, "broadcasts")
+    print(f"  broadcast latency p50 {percentile(latencies, 50) * 1e6:.0f} us, "
+          f"p99 {percentile(latencies, 99) * 1e6:.0f} us "
+          f"({slow_clients} clients stalled 50 ms per send)")
+    print(f"  fast clients received {fast_received}/{(clients - slow_clients) * messages}, "
+          f"slow-client drops: {dropped}")
+
+
+def bench_subscriptions(clients: int = 1000, devices: int = 100, messages: int = 5000):
+    """Per-device fan-out cost when each dashboard watches a single device."""
+    message = json.dumps(make_readings(1)[0])
+
+    async def run():
+        manager = ConnectionManager(max_queue=10, policy="latest", replay_size=0)
+        sockets = [FakeWebSocket() for _ in range(clients)]
+        with quiet():
+            for i, ws in enumerate(sockets):
+                await manager.connect(ws)
+                manager.subscribe(ws, [f"device-{i % devices}"])
+
+        start = time.perf_counter()
+        for i in range(messages):
+            await manager.broadcast(message, f"device-{i % devices}")
+        elapsed = time.perf_counter() - start
+
+        with quiet():
+            for ws in sockets:
+                manager.disconnect(ws)
+        await asyncio.sleep(0)
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    report(f"{clients} clients / {devices} devices", messages, elapsed, "broadcasts")
+    print(f"  {elapsed / messages * 1e6:.1f} us per broadcast "
+          f"(~{clients // devices} subscribers each)")
+
+
+def bench_conflation(clients: int = 200, devices: int = 50, seconds: float = 1.0,
+                     rate: int = 1000, max_hz: float = 5):
+    """Frames and bytes sent to streaming vs rate-limited (conflated) clients."""
+    readings = make_readings(devices)
+    messages = [(f"device-{i}", json.dumps(dict(r, device_id=f"device-{i}")))
+                for i, r in enumerate(readings)]
+
+    async def run(limit):
+        manager = ConnectionManager(max_queue=10_000, replay_size=0)
+        sockets = [FakeWebSocket() for _ in range(clients)]
+        with quiet():
+            for ws in sockets:
+                await manager.connect(ws)
+                manager.set_rate(ws, limit)
+
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for _ in range(rate // 100):
+                device_id, message = messages[sent % devices]
+                await manager.broadcast(message, device_id)
+                sent += 1
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+
+        frames = sum(ws.received for ws in sockets)
+        sent_bytes = sum(ws.bytes for ws in sockets)
+        with quiet():
+            for ws in sockets:
+                manager.disconnect(ws)
+        await asyncio.sleep(0)
+        return sent, frames, sent_bytes
+
+    for label, limit in (("streaming", None), (f"max_hz={max_hz:g}", max_hz)):
+        sent, frames, sent_bytes = asyncio.run(run(limit))
+        print(f"  {label:<12} {sent} readings -> {frames:>7} frames, "
+              f"{sent_bytes / 1e6:6.2f} MB to {clients} clients")
+
+
+def bench_history(samples: int = 2_000_000, queries: int = 2000):
+    """Fill a history ring with millions of samples and time range queries."""
+    ring = TimeSeriesRing(capacity=samples)
+    base = time.time() - samples
+
+    start = time.perf_counter()
+    for i in range(samples):
+        ring.append(base + i, 30.0, 250, 55.0, "SAFE")
+    report("TimeSeriesRing.append", samples, time.perf_counter() - start)
+
+    rng = random.Random(7)
+    starts = [base + rng.random() * samples for _ in range(queries)]
+
+    start = time.perf_counter()
+    for t in starts:
+        ring.range(t, t + 3600)
+    elapsed = time.perf_counter() - start
+    report("range lookup (binary search)", queries, elapsed, "queries")
+    print(f"  {elapsed / queries * 1e6:.1f} us per lookup")
+
+    start = time.perf_counter()
+    for t in starts[:200]:
+        ring.query(t, t + 3600, limit=1000)
+    elapsed = time.perf_counter() - start
+    print(f"  {elapsed / 200 * 1e3:.2f} ms per query returning 1000 readings")
+    print(f"  memory: {ring.nbytes / 1e6:.1f} MB for {samples:,} samples "
+          f"({ring.nbytes / samples:.0f} bytes/sample)")
+
+    # Back-dated readings (a spool flush): slotted in near the head, or left to storage
+    late = [base + samples - rng.random() * 3 * ring.late_rows for _ in range(1000)]
+    start = time.perf_counter()
+    for t in late:
+        ring.append(t, 30.0, 250, 55.0, "SAFE")
+    elapsed = time.perf_counter() - start
+    assert ring.late and ring.late < len(late), ring.late
+    assert all(ring._time_at(i) <= ring._time_at(i + 1) for i in range(samples - 5000, samples - 1))
+    print(f"  {elapsed / len(late) * 1e6:.1f} us per late reading into a full ring "
+          f"({ring.late} too far back, left to storage)")
+
+
+def bench_storage(records: int = 200_000):
+    """Sustained group-commit write rate and mmap range reads of the segment log."""
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SegmentedLogStorage(directory, queue_size=records + 1)
+        storage.start()
+        base = time.time()
+
+        start = time.perf_counter()
+        for i in range(records):
+            storage.append((base + i * 0.001, 30.0, 250, 55.0, 0, b"station-1"))
+        enqueued = time.perf_counter() - start
+        storage.stop()  # Blocks until everything is on disk
+        elapsed = time.perf_counter() - start
+
+        report("append (event loop side)", records, enqueued)
+        report("durable writes (fsync'd)", storage.written, elapsed)
+        print(f"  {storage.commits} group commits, "
+              f"{storage.written / max(storage.commits, 1):.0f} readings per fsync")
+
+        start = time.perf_counter()
+        for i in range(200):
+            t = base + random.random() * records * 0.001
+            storage.query(t, t + 60, limit=1000)
+        elapsed = time.perf_counter() - start
+        print(f"  {elapsed / 200 * 1e3:.2f} ms per mmap range query (1000 readings)")
+
+
+def brute_force_window(samples: List[tuple], now: float, seconds: float) -> Dict:
+    """Reference aggregates computed by scanning every sample in the window."""
+    inside = [s for s in samples if s[1] >= now - seconds]
+    result = {"count": len(inside)}
+    for i, metric in enumerate(METRICS):
+        values = [s[2 + i] for s in inside]
+        mean = sum(values) / len(values)
+        result[metric] = {
+            "min": min(values),
+            "max": max(values),
+            "mean": mean,
+            "stddev": (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5
+        }
+    time_in = {"WARNING": 0.0, "DANGER": 0.0}
+    for current, following in zip(inside, inside[1:] + [None]):
+        end = following[1] if following else now
+        if current[5] in time_in:
+            time_in[current[5]] += end - current[1]
+    result["time_in_status"] = time_in
+    return result
+
+
+def bench_stats(samples: int = 200_000, checks: int = 50):
+    """Incremental rolling windows: per-sample cost, verified against brute force."""
+    rng = random.Random(3)
+    readings = []
+    t = 0.0
+    for i in range(samples):
+        t += rng.uniform(0.05, 0.5)
+        temperature = 30 + rng.gauss(0, 5)
+        gas = 250 + rng.gauss(0, 200)
+        status = "DANGER" if temperature > 45 else "WARNING" if temperature > 35 else "SAFE"
+        readings.append((i, t, temperature, gas, 55 + rng.gauss(0, 5), status))
+
+    tracker = StatsTracker()
+    start = time.perf_counter()
+    for _, ts, temperature, gas, humidity, status in readings:
+        tracker.add("bench", ts, temperature, gas, humidity, status)
+    report("StatsTracker.add (3 windows)", samples, time.perf_counter() - start)
+
+    # Verify a fresh window against brute force at several points in the stream
+    worst = 0.0
+    for seconds in (60, 900, 3600):
+        window = RollingWindow(seconds)
+        check_at = set(rng.sample(range(samples), checks))
+        for i, sample in enumerate(readings):
+            window.add(sample)
+            if i not in check_at:
+                continue
+            now = sample[1]
+            fast = window.snapshot(now)
+            slow = brute_force_window(readings[max(0, i - 20000):i + 1], now, seconds)
+            assert fast["count"] == slow["count"], (fast["count"], slow["count"])
+            for metric in METRICS:
+                for key in ("min", "max", "mean", "stddev"):
+                    worst = max(worst, abs(fast[metric][key] - slow[metric][key]))
+            for status in ("WARNING", "DANGER"):
+                diff = abs(fast["time_in_status"][status] - slow["time_in_status"][status])
+                worst = max(worst, diff)
+    assert worst < 1e-6, f"rolling windows drifted from brute force by {worst:.2e}"
+    print(f"  matched brute force on {checks * 3} checkpoints, max abs error {worst:.2e}")
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        tracker.snapshot(t)
+    print(f"  {(time.perf_counter() - start) / 1000 * 1e6:.1f} us per /stats snapshot")
+
+
+def make_rules(count: int, seed: int = 11) -> List[dict]:
+    """A mix of threshold, hysteresis, rate and anomaly rules."""
+    rng = random.Random(seed)
+    metrics = ("temperature", "gas_level", "humidity")
+    rules = []
+    for i in range(count):
+        metric = metrics[i % 3]
+        kind = i % 10
+        status = "DANGER" if i % 2 else "WARNING"
+        if kind < 6:
+            value = rng.uniform(40, 2000)
+            rule = {"name": f"threshold-{i}", "metric": metric, "op": ">",
+                    "value": value, "status": status}
+            if kind >= 4:
+                rule["clear"] = value * 0.95
+        elif kind < 8:
+            rule = {"name": f"rate-{i}", "type": "rate", "metric": metric, "op": ">",
+                    "value": rng.uniform(1, 50), "status": status}
+        else:
+            rule = {"name": f"anomaly-{i}", "type": "anomaly", "metric": metric,
+                    "z": 4.0, "status": "WARNING"}
+        rules.append(rule)
+    return rules
+
+
+def bench_rules(readings: int = 20_000):
+    """Per-reading evaluation cost of compiled rules, default set vs hundreds."""
+    samples = make_readings(readings)
+    for label, rules in (("4 default rules", DEFAULT_RULES),
+                         ("300 mixed rules", make_rules(300))):
+        start = time.perf_counter()
+        engine = RuleEngine(rules)
+        compiled = time.perf_counter() - start
+
+        evaluate = engine.evaluate
+        start = time.perf_counter()
+        for i, r in enumerate(samples):
+            evaluate("bench", r["temperature"], r["gas_level"], r["humidity"], float(i))
+        elapsed = time.perf_counter() - start
+        report(f"evaluate ({label})", readings, elapsed)
+        print(f"  {elapsed / readings * 1e6:.2f} us per reading, "
+              f"compiled in {compiled * 1e3:.1f} ms")
+
+
+def bench_sessions(logins: int = 500_000, ttl: float = 60.0, rate: float = 1000.0):
+    """Long-running login churn: store size and heap stay flat with sweeping."""
+    store = MemorySessionStore(max_sessions=100_000)
+    clock = 0.0
+    peak_sessions = peak_heap = 0
+
+    start = time.perf_counter()
+    for i in range(logins):
+        clock += 1 / rate
+        store.create(f"token-{i}", {"username": f"user-{i % 5000}",
+                                   "expires_at": clock + ttl})
+        if i % 1000 == 0:
+            store.sweep(clock)  # The app sweeps on a timer; simulated time here
+        peak_sessions = max(peak_sessions, len(store))
+        peak_heap = max(peak_heap, len(store.expiry_heap))
+    elapsed = time.perf_counter() - start
+    report("login + periodic sweep", logins, elapsed, "sessions")
+    print(f"  live sessions peak {peak_sessions:,} (expected ~{int(ttl * rate):,}), "
+          f"heap peak {peak_heap:,}")
+
+    live = MemorySessionStore()
+    tokens = [f"token-{i}" for i in range(10_000)]
+    for token in tokens:
+        live.create(token, {"username": "user", "expires_at": time.time() + ttl})
+    start = time.perf_counter()
+    for token in tokens:
+        live.get(token)
+    lookup = time.perf_counter() - start
+    print(f"  {lookup / len(tokens) * 1e9:.0f} ns per token lookup")
+
+
+class SlowStream:
+    """Log sink that stalls on every write, like stdout piped to a busy collector."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text: str):
+        time.sleep(self.delay)
+        self.lines += 1
+
+    def flush(self):
+        pass
+
+
+def bench_logging(requests: int = 2000, write_delay: float = 0.0005):
+    """POST /data latency with logging off, queued to a thread, and written inline."""
+    bodies = [json.dumps(r).encode() for r in make_readings(requests)]
+
+    async def run() -> List[float]:
+        latencies = []
+        for body in bodies:
+            t0 = time.perf_counter()
+            await asgi_request(main.app, "POST", "/data", body)
+            latencies.append(time.perf_counter() - t0)
+        return latencies
+
+    for mode in ("off", "queued", "inline"):
+        stream = SlowStream(write_delay)
+        handler = setup_logging(level="WARNING" if mode == "off" else "INFO", stream=stream)
+        if mode == "inline":
+            # What a plain StreamHandler does: format + write on the event loop
+            inline = logging.StreamHandler(stream)
+            inline.setFormatter(logging.Formatter("%(message)s"))
+            log.handlers = [inline]
+        latencies = asyncio.run(run())
+        setup_logging()
+        print(f"  logging {mode:<7} p50 {percentile(latencies, 50) * 1e6:6.0f} us, "
+              f"p99 {percentile(latencies, 99) * 1e6:6.0f} us per POST /data "
+              f"({stream.lines} lines written, {handler.dropped} dropped)")
+    print(f"  sink stalls {write_delay * 1e6:.0f} us per write")
+
+
+def bench_metrics(ops: int = 1_000_000, requests: int = 3000, clients: int = 500):
+    """Cost of recording metrics per reading, and of rendering a scrape."""
+    counter = Counter("bench_total", "benchmark", "status")
+    histogram = Histogram("bench_seconds", "benchmark")
+    perf_counter = time.perf_counter
+
+    start = perf_counter()
+    for _ in range(ops):
+        counter.inc(1, "SAFE")
+    inc = (perf_counter() - start) / ops
+
+    start = perf_counter()
+    for i in range(ops):
+        histogram.observe((i % 1000) * 1e-6)
+    observe = (perf_counter() - start) / ops
+
+    start = perf_counter()
+    for _ in range(ops):
+        t0 = perf_counter()
+        histogram.observe(perf_counter() - t0)
+    timed = (perf_counter() - start) / ops
+
+    # POST /data records 1 counter + 3 timed histograms (validation, ingest, broadcast)
+    per_reading = inc + 3 * timed
+    bodies = [json.dumps(r).encode() for r in make_readings(requests)]
+
+    async def run():
+        latencies = []
+        for body in bodies:
+            t0 = perf_counter()
+            await asgi_request(main.app, "POST", "/data", body)
+            latencies.append(perf_counter() - t0)
+
+        manager = main.manager
+        sockets = [FakeWebSocket() for _ in range(clients)]
+        for ws in sockets:
+            await manager.connect(ws)
+        scrape_start = perf_counter()
+        for _ in range(100):
+            main.REGISTRY.render()
+        scrape = (perf_counter() - scrape_start) / 100
+        for ws in sockets:
+            manager.disconnect(ws)
+        await asyncio.sleep(0)
+        return latencies, scrape
+
+    with quiet():
+        latencies, scrape = asyncio.run(run())
+    request = percentile(latencies, 50)
+    print(f"  counter inc {inc * 1e9:.0f} ns, histogram observe {observe * 1e9:.0f} ns, "
+          f"timed observe {timed * 1e9:.0f} ns")
+    print(f"  instrumentation per reading ~{per_reading * 1e6:.2f} us of "
+          f"{request * 1e6:.0f} us POST /data p50 ({per_reading / request:.1%})")
+    print(f"  /metrics render {scrape * 1e6:.0f} us with {clients} WebSocket clients")
+
+
+def legacy_parse(line: str):
+    """The reader's original per-line parser: two regex searches from source strings."""
+    import re
+    match = re.search(r"Temp:\s*([\d.]+)°?C?\s*\|\s*Humidity:\s*([\d.]+)%?\s*\|"
+                      r"\s*Smoke\s*Level:\s*(\d+)", line)
+    if not match:
+        match = re.search(r"Temp:\s*([\d.]+)\|\s*Humidity:\s*([\d.]+)C\s*\|\s*Smoke:\s*(\d+)",
+                          line)
+    if match:
+        return {"temperature": float(match.group(1)), "humidity": float(match.group(2)),
+                "gas_level": int(match.group(3))}
+    return None
+
+
+class CapturePort:
+    """Serial port stand-in that replays a byte capture in device-sized chunks."""
+
+    def __init__(self, data: bytes, seed: int = 5):
+        rng = random.Random(seed)
+        self.chunks = []
+        position = 0
+        while position < len(data):
+            size = rng.choice((1, 7, 64, 64, 512, 4096))
+            self.chunks.append(data[position:position + size])
+            position += size
+        self.chunks.reverse()
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.chunks[-1]) if self.chunks else 0
+
+    def read(self, size: int = 1) -> bytes:
+        return self.chunks.pop() if self.chunks else b""
+
+
+def bench_parser(lines: int = 200_000, baud: int = 115200):
+    """Serial line parsing, and a replayed capture through the bulk line reader."""
+    readings = make_readings(lines)
+    capture_lines = [
+        f"Temp: {r['temperature']}| Humidity: {r['humidity']}C | Smoke: {r['gas_level']}"
+        for r in readings
+    ]
+    raw = [line.encode() for line in capture_lines]
+
+    start = time.perf_counter()
+    for line in capture_lines:
+        legacy_parse(line)
+    legacy = time.perf_counter() - start
+    report("legacy parse (str, 2 regexes)", lines, legacy, "lines")
+
+    parser = SensorLineParser()
+    start = time.perf_counter()
+    parsed = [parser.parse(line) for line in raw]
+    fast = time.perf_counter() - start
+    report("precompiled parse (cached format)", lines, fast, "lines")
+    assert parsed == [legacy_parse(line) for line in capture_lines[:len(parsed)]]
+
+    capture = b"".join(line + b"\r\n" for line in raw)
+    port = CapturePort(capture)
+    reader = SerialLineReader(port)
+    parser = SensorLineParser()
+    received = 0
+    start = time.perf_counter()
+    while port.chunks:
+        for line in reader.read_lines():
+            if parser.parse(line):
+                received += 1
+    replay = time.perf_counter() - start
+    report("replayed capture (read + split + parse)", received, replay, "lines")
+
+    # 8N1 framing: 10 bits on the wire per byte
+    line_rate = baud / 10 / (len(capture) / lines)
+    print(f"  {baud} baud delivers ~{line_rate:,.0f} lines/s; reader headroom "
+          f"{received / replay / line_rate:,.0f}x, {received}/{lines} lines parsed")
+
+
+class CountingUplink:
+    """Uplink stand-in that only counts submitted readings."""
+
+    def __init__(self):
+        self.received = 0
+
+    def submit(self, reading: dict):
+        self.received += 1
+
+
+def bench_gateway(board_counts=(1, 10, 50), lines_per_board: int = 400):
+    """One gateway loop reading many serial boards (pseudo-terminals, POSIX only)."""
+    if not hasattr(os, "openpty"):
+        print("  skipped: needs pseudo-terminals (POSIX)")
+        return
+    import tracemalloc
+    import tty
+    from serial_gateway import SerialGateway
+
+    line = b"Temp: 28.5| Humidity: 65.3C | Smoke: 245\r\n"
+    for boards in board_counts:
+        masters, slaves = [], []
+        for _ in range(boards):
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            masters.append(master)
+            slaves.append(slave)
+        uplink = CountingUplink()
+        gateway = SerialGateway(uplink, [os.ttyname(fd) for fd in slaves])
+        with quiet():
+            tracemalloc.start()
+            gateway.scan()
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+        expected = boards * lines_per_board
+        cpu_start = time.process_time()
+        for _ in range(lines_per_board // 20):
+            for master in masters:
+                os.write(master, line * 20)
+            gateway.poll_once(0.01)
+        while uplink.received < expected:
+            gateway.poll_once(0.01)
+        cpu = time.process_time() - cpu_start
+
+        # Idle: the selector sleeps until data arrives instead of spinning
+        idle_start = time.process_time()
+        gateway.poll_once(0.2)
+        idle = time.process_time() - idle_start
+
+        print(f"  {boards:>3} boards: {cpu / expected * 1e6:5.1f} us CPU per line, "
+              f"{memory / boards / 1024:5.1f} KB per board, idle CPU {idle * 1e3:.2f} ms / 200 ms")
+        with quiet():
+            gateway.stop()
+        for fd in masters + slaves:
+            os.close(fd)
+
+
+def ws_frame_bytes(payload: int, masked: bool) -> int:
+    """Bytes on the wire for one WebSocket frame (header + payload)."""
+    header = 2 if payload < 126 else 4 if payload < 65536 else 10
+    return header + (4 if masked else 0) + payload
+
+
+def bench_ingest(count: int = 3000, batch_size: int = 100):
+    """POST /data per reading vs the persistent /ingest channel."""
+    readings = make_readings(count)
+    bodies = [json.dumps(r).encode() for r in readings]
+    single_frames = [body.decode() for body in bodies]
+    batch_frames = [json.dumps(readings[i:i + batch_size]) for i in range(0, count, batch_size)]
+
+    async def run():
+        start = time.perf_counter()
+        for body in bodies:
+            await asgi_request(main.app, "POST", "/data", body)
+        post = time.perf_counter() - start
+
+        start = time.perf_counter()
+        single_acks = await asgi_ingest(main.app, single_frames)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch_acks = await asgi_ingest(main.app, batch_frames)
+        batched = time.perf_counter() - start
+        return post, single, single_acks, batched, batch_acks
+
+    with quiet():
+        post, single, single_acks, batched, batch_acks = asyncio.run(run())
+    report("POST /data", count, post)
+    report("/ingest, 1 reading per frame", count, single)
+    report(f"/ingest, {batch_size} readings per frame", count, batched)
+    assert sum(json.loads(ack)["accepted"] for ack in batch_acks) == count
+
+    # Wire bytes per reading, as a device would send and receive them
+    body = len(bodies[0])
+    request_head = len(
+        "POST /data HTTP/1.1\r\nHost: 192.168.1.10:8000\r\nUser-Agent: ESP32HTTPClient\r\n"
+        "Connection: keep-alive\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {body}\r\n\r\n"
+    )
+    response = len(
+        "HTTP/1.1 200 OK\r\ndate: Thu, 01 Jan 2026 00:00:00 GMT\r\nserver: uvicorn\r\n"
+        "content-length: 150\r\ncontent-type: application/json\r\n\r\n"
+    ) + 150
+    http = request_head + body + response
+    single_ws = ws_frame_bytes(body, True) + ws_frame_bytes(len(single_acks[0]), False)
+    batch_ws = (ws_frame_bytes(len(batch_frames[0]), True)
+                + ws_frame_bytes(len(batch_acks[0]), False)) / batch_size
+    print(f"  wire bytes per reading: POST {http}, /ingest {single_ws}, "
+          f"/ingest batched {batch_ws:.0f}")
+    print(f"  speedup vs POST: {post / single:.1f}x (1 per frame), "
+          f"{post / batched:.1f}x ({batch_size} per frame)")
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def bench_workers(devices: int = 100, extra_devices: int = 100, cap: int = 150):
+    """Two uvicorn workers on one bus: POST /data to one, receive it on the other's /ws."""
+    scratch = tempfile.mkdtemp(prefix="smartsense-bench-")
+    shared = {
+        "BUS_URL": (f"tcp://127.0.0.1:{free_port()}" if sys.platform == "win32"
+                    else f"unix://{os.path.join(scratch, 'bus.sock')}"),
+        "SESSION_BACKEND": "sqlite",
+        "SESSION_DB": os.path.join(scratch, "auth.db"),
+    }
+    ports = free_port(), free_port()
+    # The first worker hosts the hub; the second caps its devices below what the first accepts
+    servers = [spawn_server(ports[0], env=shared),
+               spawn_server(ports[1], env=dict(shared, MAX_DEVICES=str(cap)))]
+    try:
+        session = requests.Session()
+        publish = f"http://127.0.0.1:{ports[0]}/data"
+        with ws_connect(f"ws://127.0.0.1:{ports[1]}/ws") as dashboard:
+            assert json.loads(dashboard.recv(timeout=10))["type"] == "snapshot"
+            # Wait until the second worker has joined the bus
+            deadline = time.monotonic() + 10
+            while True:
+                session.post(publish, json={"temperature": 20.0, "gas_level": 100,
+                                            "humidity": 40.0, "device_id": "probe"})
+                try:
+                    json.loads(dashboard.recv(timeout=0.5))
+                    break
+                except TimeoutError:
+                    assert time.monotonic() < deadline, "second worker never joined the bus"
+
+            latencies = []
+            for i in range(devices):
+                device_id = f"station-{i}"
+                start = time.perf_counter()
+                response = session.post(publish, json={"temperature": 25.0, "gas_level": 150 + i,
+                                                       "humidity": 45.0, "device_id": device_id})
+                assert response.status_code == 200, response.status_code
+                while True:
+                    frame = json.loads(dashboard.recv(timeout=5))
+                    frames = frame if isinstance(frame, list) else [frame]
+                    if any(reading.get("device_id") == device_id for reading in frames):
+                        break
+                latencies.append(time.perf_counter() - start)
+
+        # Devices past the second worker's cap are kept by the first only
+        for i in range(extra_devices):
+            session.post(publish, json={"temperature": 25.0, "gas_level": 150, "humidity": 45.0,
+                                        "device_id": f"extra-{i}"})
+        counts = []
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            counts = [session.get(f"http://127.0.0.1:{port}/devices").json()["count"]
+                      for port in ports]
+            if counts[0] == devices + extra_devices + 1 and counts[1] == cap:
+                break
+            time.sleep(0.1)
+    finally:
+        for server in reversed(servers):  # The hub's worker last
+            server.terminate()
+            server.wait()
+
+    assert len(latencies) == devices
+    assert counts == [devices + extra_devices + 1, cap], counts
+    print(f"  {devices} readings POSTed to worker 1, each seen on worker 2's /ws: "
+          f"p50 {percentile(latencies, 50) * 1e3:.2f} ms, p99 {percentile(latencies, 99) * 1e3:.2f} ms")
+    print(f"  devices after {extra_devices} more: worker 1 {counts[0]}, "
+          f"worker 2 {counts[1]} (MAX_DEVICES={cap})")
+
+
+def bench_resume(clients: int = 1000, missed: int = 50):
+    """Reconnect storm: /ws resume from last_seq vs reconnecting and refetching /history."""
+    bodies = [json.dumps(r).encode() for r in make_readings(500 + missed)]
+
+    async def drain(manager: ConnectionManager):
+        while any(client.queue for client in manager.active_connections.values()):
+            await asyncio.sleep(0)
+
+    async def run():
+        manager = main.manager
+        for body in bodies[:500]:
+            await asgi_request(main.app, "POST", "/data", body)
+        # Every dashboard saw everything up to here, then the network blipped
+        last_seq, epoch = manager.replay.seq, manager.replay.epoch
+        for body in bodies[500:]:
+            await asgi_request(main.app, "POST", "/data", body)
+
+        # Before: plain reconnect, then each dashboard refetches recent history
+        plain = ConnectionManager(replay_size=0)
+        refetch = [FakeWebSocket() for _ in range(clients)]
+        start = time.perf_counter()
+        for ws in refetch:
+            await plain.connect(ws)
+            await asgi_request(main.app, "GET", "/history?limit=20")
+        before = time.perf_counter() - start
+
+        resumed = [FakeWebSocket() for _ in range(clients)]
+        start = time.perf_counter()
+        for ws in resumed:
+            await manager.connect(ws, last_seq, epoch)
+        await drain(manager)
+        after = time.perf_counter() - start
+        for ws in resumed:
+            manager.disconnect(ws)
+        await asyncio.sleep(0)
+        replay = json.loads(manager.replay.frame_for(last_seq, epoch))
+        assert [r["seq"] for r in replay["readings"]] == list(range(last_seq + 1,
+                                                                      last_seq + missed + 1))
+        return before, after, resumed
+
+    with quiet():
+        before, after, resumed = asyncio.run(run())
+    report("reconnect + GET /history?limit=20", clients, before, "clients")
+    report(f"reconnect with last_seq ({missed} missed)", clients, after, "clients")
+    frames = sum(ws.received for ws in resumed) / clients
+    print(f"  resume: {frames:g} frame per client, {resumed[0].bytes:,} bytes, "
+          f"all {missed} missed readings recovered (refetch returns the latest 20)")
+    print(f"  speedup: {before / after:.1f}x")
+
+
+def make_stream(count: int, devices: int = 50, seed: int = 7) -> List[dict]:
+    """Readings from devices whose values drift slowly, as real sensors do."""
+    rng = random.Random(seed)
+    state = [[25.0, 200, 50.0] for _ in range(devices)]
+    now = time.time()
+    readings = []
+    for i in range(count):
+        device = state[i % devices]
+        if rng.random() < 0.5:
+            device[0] = round(device[0] + rng.choice((-0.1, 0.1)), 1)
+        if rng.random() < 0.3:
+            device[1] += rng.randint(-5, 5)
+        if rng.random() < 0.3:
+            device[2] = round(device[2] + rng.choice((-0.1, 0.1)), 1)
+        readings.append({
+            "device_id": f"station-{i % devices}", "temperature": device[0],
+            "gas_level": device[1], "humidity": device[2], "status": "SAFE",
+            "timestamp": datetime.fromtimestamp(now + i * 0.01, timezone.utc).isoformat(),
+        })
+    return readings
+
+
+def bench_formats(clients: int = 500, readings: int = 400, batch_size: int = 50):
+    """Bytes and server CPU per broadcast for each /ws frame format at 500 clients."""
+    stream = make_stream(readings)
+    modes = [
+        ("json", "json", False, FakeWebSocket),
+        ("json + permessage-deflate", "json", False, DeflateWebSocket),
+        ("json, compress=deflate", "json", True, FakeWebSocket),
+        ("binary", "binary", False, FakeWebSocket),
+        ("binary, compress=deflate", "binary", True, FakeWebSocket),
+        ("delta", "delta", False, FakeWebSocket),
+    ]
+
+    async def run(frame_format, compress, socket_type, batch):
+        manager = ConnectionManager(max_queue=10_000, replay_size=readings)
+        sockets = [socket_type() for _ in range(clients)]
+        with quiet():
+            for ws in sockets:
+                await manager.connect(ws, frame_format=frame_format, compress=compress)
+        await asyncio.sleep(0)
+        for ws in sockets:
+            ws.received = ws.bytes = 0  # Not counting the snapshot
+        start = time.perf_counter()
+        if batch:
+            for i in range(0, readings, batch_size):
+                await manager.broadcast_batch(stream[i:i + batch_size])
+        else:
+            for reading in stream:
+                await manager.broadcast_reading(reading)
+        # Server CPU includes the sender tasks writing (and compressing) every frame
+        while any(client.queue for client in manager.active_connections.values()):
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        sent_bytes = sum(ws.bytes for ws in sockets)
+        with quiet():
+            for ws in sockets:
+                manager.disconnect(ws)
+        await asyncio.sleep(0)
+        return elapsed, sent_bytes
+
+    for batch in (False, True):
+        unit = f"{batch_size}-reading batch" if batch else "single reading"
+        print(f"  {unit} broadcasts to {clients} clients:")
+        baseline = None
+        for label, frame_format, compress, socket_type in modes:
+            elapsed, sent_bytes = asyncio.run(run(frame_format, compress, socket_type, batch))
+            per_reading = sent_bytes / clients / readings
+            baseline = baseline or per_reading
+            print(f"    {label:<26} {per_reading:6.1f} B/reading/client "
+                  f"({per_reading / baseline:4.0%})  {elapsed / readings * 1e6:7.0f} us CPU "
+                  f"per reading")
+
+
+def make_trace(devices: int = 20, hours: float = 3.0, period: float = 2.0,
+               seed: int = 3) -> List[tuple]:
+    """Device readings every `period` seconds with clock jitter and drifting values."""
+    rng = random.Random(seed)
+    base = time.time() - hours * 3600
+    trace = []
+    for device in range(devices):
+        temperature, gas_level, humidity = 24.0 + device % 5, 180 + device, 45.0
+        for i in range(int(hours * 3600 / period)):
+            if rng.random() < 0.3:
+                temperature = round(temperature + rng.choice((-0.1, 0.1)), 1)
+            if rng.random() < 0.5:
+                gas_level = max(0, gas_level + rng.randint(-3, 3))
+            if rng.random() < 0.2:
+                humidity = round(humidity + rng.choice((-0.1, 0.1)), 1)
+            status = "WARNING" if gas_level > 300 or temperature > 35 else "SAFE"
+            when = base + i * period + rng.uniform(-0.005, 0.005)
+            trace.append((when, temperature, gas_level, humidity, status, f"station-{device}"))
+    trace.sort()
+    return trace
+
+
+def bench_compression(devices: int = 20, hours: float = 3.0):
+    """Gorilla-compressed history vs the raw ring: bytes per reading and decode speed."""
+    trace = make_trace(devices, hours)
+    ring = TimeSeriesRing(capacity=len(trace))
+    compressed = CompressedHistory(retention_days=365)
+
+    for row in trace:
+        ring.append(*row)
+    start = time.perf_counter()
+    for row in trace:
+        compressed.append(*row)
+    report("CompressedHistory.append", len(trace), time.perf_counter() - start)
+
+    raw = ring.nbytes / len(trace)
+    packed = compressed.nbytes / len(trace)
+    print(f"  raw ring:   {raw:5.1f} bytes/reading ({ring.nbytes / 1e6:.2f} MB)")
+    print(f"  compressed: {packed:5.1f} bytes/reading ({compressed.nbytes / 1e6:.2f} MB), "
+          f"{raw / packed:.1f}x smaller")
+
+    start = time.perf_counter()
+    decoded = list(compressed.points())
+    report("decode (all devices, merged)", len(decoded), time.perf_counter() - start)
+    # Compared per device: readings of different devices within a ms may swap places
+    by_device = sorted(decoded, key=lambda point: point[5])
+    expected = sorted(trace, key=lambda row: row[5])
+    lossless = len(decoded) == len(trace) and all(
+        abs(got[0] - want[0]) < 0.0006 and got[1:4] == want[1:4] and got[5] == want[5]
+        for got, want in zip(by_device, expected))
+    assert lossless, "compressed history round trip does not match the trace"
+    print("  round trip: ✅ lossless (timestamps to the millisecond)")
+
+    device = "station-0"
+    end = trace[-1][0]
+    start = time.perf_counter()
+    readings = compressed.query(end - 3600, end, None, device)
+    elapsed = time.perf_counter() - start
+    print(f"  last hour of {device}: {len(readings)} readings in {elapsed * 1e3:.1f} ms")
+
+    # A spool flush: station-0's last 10 minutes arrive again, back-dated, after newer readings
+    held = [row for row in trace if row[5] == "station-0"]
+    flushed = [row for row in held if row[0] > held[-1][0] - 600]
+    start = time.perf_counter()
+    for row in flushed:
+        compressed.append(*row)
+    report("append late (spool flush)", len(flushed), time.perf_counter() - start)
+    times = [point[0] for point in compressed.points(device_id="station-0")]
+    assert times == sorted(times) and len(times) == len(held) + len(flushed), \
+        "late readings were not kept in time order"
+
+    days = 90 * 86400 / 2  # Readings from one device every 2 s for 90 days
+    print(f"  90 days of one device: {raw * days / 1e6:.0f} MB raw, "
+          f"{packed * days / 1e6:.0f} MB compressed")
+
+
+class SlowWebhook(BaseHTTPRequestHandler):
+    """Stand-in webhook receiver: slow, and failing every other request."""
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, like a real webhook endpoint
+    delay = 0.1
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.delay)
+        SlowWebhook.requests += 1
+        self.send_response(503 if SlowWebhook.requests % 2 else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+async def slow_scada_listener(delay: float = 0.05):
+    """Stand-in SCADA listener that reads one alert line every `delay` seconds."""
+
+    async def serve(reader, writer):
+        try:
+            while await reader.readline():
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            pass  # Benchmark over
+
+    return await asyncio.start_server(serve, "127.0.0.1", 0)
+
+
+def serve_slow_sinks(ports):
+    """Run the stand-in webhook and SCADA listener (in a child process) until killed."""
+    webhook = ThreadingHTTPServer(("127.0.0.1", 0), SlowWebhook)
+    threading.Thread(target=webhook.serve_forever, daemon=True).start()
+
+    async def serve():
+        scada = await slow_scada_listener()
+        ports.put((webhook.server_port, scada.sockets[0].getsockname()[1]))
+        await scada.serve_forever()
+
+    asyncio.run(serve())
+
+
+def bench_alerts(devices: int = 50, readings: int = 3000):
+    """POST /data latency with gas hovering at the DANGER threshold and slow alert sinks."""
+    rng = random.Random(5)
+    bodies = []
+    statuses = []
+    for i in range(readings):
+        gas_level = 1000 + rng.randint(-40, 40)
+        bodies.append(json.dumps({"temperature": 30.0, "gas_level": gas_level, "humidity": 50.0,
+                                  "device_id": f"station-{i % devices}"}).encode())
+        statuses.append((i % devices, "DANGER" if gas_level > 1000 else "WARNING"))
+    flips = sum(1 for i, (device, status) in enumerate(statuses)
+                if i >= devices and statuses[i - devices][1] != status)
+
+    # The stand-in sinks run in their own process, like real ones on other hosts,
+    # so their work does not share this process's GIL and event loop
+    ports = multiprocessing.Queue()
+    sink_process = multiprocessing.Process(target=serve_slow_sinks, args=(ports,), daemon=True)
+    sink_process.start()
+    webhook_port, scada_port = ports.get(timeout=10)
+
+    async def run(with_sinks: bool):
+        sinks = []
+        if with_sinks:
+            sinks = [WebhookSink(f"http://127.0.0.1:{webhook_port}/alert"),
+                     ScadaSink(f"tcp://127.0.0.1:{scada_port}")]
+        main.alert_tracker = AlertTracker(hold=0.2, dedup=1.0)
+        main.alerts = AlertDispatcher(sinks, retry_delay=0.05)
+        await main.alerts.start()
+        latencies = []
+        for body in bodies:
+            t0 = time.perf_counter()
+            await asgi_request(main.app, "POST", "/data", body)
+            latencies.append(time.perf_counter() - t0)
+            await asyncio.sleep(0.001)  # Readings arrive spaced out, not back to back
+        # Let the sinks catch up before counting deliveries
+        deadline = time.perf_counter() + 30
+        while time.perf_counter() < deadline and any(
+                "pending" in alert["deliveries"].values() or
+                "retrying" in alert["deliveries"].values() for alert in main.alerts.recent):
+            await asyncio.sleep(0.05)
+        await main.alerts.stop()
+        return latencies, list(main.alerts.recent)
+
+    with quiet():
+        asyncio.run(run(False))  # Warm up
+        baseline, _ = asyncio.run(run(False))
+        latencies, raised = asyncio.run(run(True))
+    sink_process.terminate()
+
+    outcomes: Dict[str, int] = {}
+    for alert in raised:
+        for outcome in alert["deliveries"].values():
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    # Every delivery settled, flapping was debounced, and slow sinks never held up ingest
+    assert raised and set(outcomes) <= {"sent", "failed"}, outcomes
+    assert len(raised) < flips, (len(raised), flips)
+    assert percentile(latencies, 99) <= 1.2 * percentile(baseline, 99), \
+        f"slow sinks moved ingest p99 from {percentile(baseline, 99) * 1e6:.0f} us " \
+        f"to {percentile(latencies, 99) * 1e6:.0f} us"
+    print(f"  {readings} readings from {devices} devices hovering at the gas DANGER threshold")
+    print(f"  no sinks:   p50 {percentile(baseline, 50) * 1e6:5.0f} us, "
+          f"p99 {percentile(baseline, 99) * 1e6:5.0f} us per POST /data")
+    print(f"  slow sinks: p50 {percentile(latencies, 50) * 1e6:5.0f} us, "
+          f"p99 {percentile(latencies, 99) * 1e6:5.0f} us per POST /data "
+          f"(webhook 100 ms, fails every other call; SCADA 50 ms per line)")
+    print(f"  status flips: {flips}, alerts raised: {len(raised)} "
+          f"(debounce/hold-down/dedup), deliveries: "
+          + ", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items())))
+
+
+def bench_replay(lines: int = 600):
+    """Capture -> replay round trip: serial captures replayed into a server match the parsed lines."""
+    rng = random.Random(13)
+    streams = {"serial": ("/dev/ttyUSB0", "default"), "gateway": ("line-2", "line-2")}
+    expected: Dict[str, List[tuple]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for source, (device, device_id) in streams.items():
+            capture = open_capture(source, directory, enabled=True)
+            parser = SensorLineParser()
+            for _ in range(lines):
+                line = (f"Temp: {rng.uniform(20, 40):.1f}°C | Humidity: {rng.uniform(30, 70):.1f}% | "
+                        f"Smoke Level: {rng.randint(100, 900)}").encode()
+                capture.record("serial", line, device=device)
+                reading = parser.parse(line)
+                expected.setdefault(device_id, []).append(
+                    (reading["temperature"], reading["gas_level"], reading["humidity"]))
+                time.sleep(0.0005)
+            capture.stop()
+            paths.append(capture.path)
+
+        port = free_port()
+        server = spawn_server(port)
+        try:
+            replay = BackendReplay(f"http://127.0.0.1:{port}", connections=1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed = asyncio.run(replay.run(load_records(paths), speed=0))
+            session = requests.Session()
+            replayed = {
+                device_id: [(r["temperature"], r["gas_level"], r["humidity"]) for r in session.get(
+                    f"http://127.0.0.1:{port}/history",
+                    params={"device": device_id, "limit": 10 * lines}).json()["readings"]]
+                for device_id in expected
+            }
+            devices = sorted(session.get(f"http://127.0.0.1:{port}/devices").json()["devices"])
+        finally:
+            server.terminate()
+            server.wait()
+
+    # The reader's lines arrive as "default" like the live reader's; the gateway's under its board ID
+    assert devices == sorted(expected), devices
+    assert replayed == expected, "replayed readings differ from the captured lines"
+    report("capture replay into /data/batch", 2 * lines, elapsed)
+    print(f"  {', '.join(f'{len(rows)} readings as {device}' for device, rows in replayed.items())}: "
+          f"✅ identical to the captured lines")
+
+
+def bench_simulator(devices: int = 10000, steps: int = 64):
+    """Fleet simulator: NumPy blocks for every device vs one reading at a time."""
+    simulator = FleetSimulator(devices, period=2.0, seed=1)
+    start = time.perf_counter()
+    times, temperature, gas, humidity = simulator.block(steps)
+    report("FleetSimulator.block", devices * steps, time.perf_counter() - start)
+    start = time.perf_counter()
+    for k in range(steps):
+        simulator.encode(temperature[k], gas[k], humidity[k])
+    report("FleetSimulator.encode (JSON)", devices * steps, time.perf_counter() - start)
+
+    # The per-reading way: Python random draws and json.dumps for each device
+    rng = random.Random(1)
+    values = [[25.0, 50.0, 170.0] for _ in range(devices)]
+    start = time.perf_counter()
+    for _ in range(steps // 8):
+        for index, value in enumerate(values):
+            value[0] += 0.2 * (25.0 - value[0]) / 150 + rng.gauss(0, 0.06)
+            value[1] += rng.gauss(0, 0.2)
+            value[2] += 0.05 * (170.0 - value[2]) + rng.gauss(0, 4)
+            json.dumps({"device_id": f"sim-{index:05d}", "temperature": round(value[0], 1),
+                        "gas_level": int(value[2]), "humidity": round(value[1], 1)})
+    report("per-reading random + json.dumps", devices * (steps // 8),
+           time.perf_counter() - start)
+
+    # Same seed, different block sizes: identical readings
+    first, second = FleetSimulator(1000, seed=9, leak_rate=5), FleetSimulator(1000, seed=9, leak_rate=5)
+    a = [first.block(60) for _ in range(2)]
+    b = [second.block(7) for _ in range(16)] + [second.block(8)]
+    same = all(
+        (np.concatenate([block[i] for block in a]) == np.concatenate([block[i] for block in b])).all()
+        for i in range(4))
+    assert same, "seed 9 gave different readings in blocks of 60 and 7"
+    print("  seed 9, blocks of 60 vs 7: ✅ identical readings")
+    status = (gas > 300) | (temperature > 35)
+    print(f"  {devices} devices x {steps} steps: temperature {temperature.min():.1f}-"
+          f"{temperature.max():.1f}°C, gas max {gas.max()} PPM, "
+          f"{status.mean() * 100:.2f}% of readings above SAFE")
+
+
+def bench_export(devices: int = 100, readings: int = 200_000):
+    """GET /export rows/s and bytes per reading per format, and peak memory vs size."""
+    base = time.time() - readings / devices * 2
+    rows = [(base + (i // devices) * 2 + (i % devices) * 1e-4, round(22 + (i % 70) / 10, 1),
+             150 + i % 97, round(45 + (i % 31) / 10, 1), 0, f"station-{i % devices}")
+            for i in range(readings)]
+    saved = main.storage, main.compressed
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SegmentedLogStorage(directory, segment_seconds=600, queue_size=readings + 1)
+        storage.start()
+        for row in rows:
+            storage.append(row[:5] + (encode_device_id(row[5]),))
+        storage.stop()
+        main.storage = storage
+        main.compressed = CompressedHistory(retention_days=0)  # Force the storage path
+        try:
+            for name in ("csv", "ndjson", "columnar"):
+                start = time.perf_counter()
+                status, size, chunks, _ = asyncio.run(
+                    asgi_stream(main.app, f"/export?format={name}&from=0"))
+                elapsed = time.perf_counter() - start
+                assert status == 200, status
+                report(f"/export {name} (storage)", readings, elapsed, "rows")
+                print(f"  {'':32} {size / readings:6.1f} bytes/row, {chunks} chunks, HTTP {status}")
+
+            status, _, _, body = asyncio.run(asgi_stream(main.app, "/export?format=columnar&from=0",
+                                                         keep=True))
+            decoded = list(decode_columnar(body))
+            assert status == 200, status
+            assert decoded == [(r[0], r[1], r[2], r[3], r[4], r[5]) for r in rows], \
+                "columnar export round trip does not match the stored rows"
+            print("  columnar round trip: ✅ lossless")
+
+            # Peak traced memory while streaming a quarter of the rows vs all of them
+            peaks = []
+            for share in (4, 1):
+                tracemalloc.start()
+                asyncio.run(asgi_stream(main.app, f"/export?format=csv&to={rows[readings // share - 1][0]}"))
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            assert peaks[1] < 2 * peaks[0], f"export memory grew with its size: {peaks}"
+            print(f"  peak memory: {readings // 4} rows {peaks[0] / 1e6:.1f} MB, "
+                  f"{readings} rows {peaks[1] / 1e6:.1f} MB")
+
+            main.compressed = CompressedHistory(retention_days=365)
+            main.storage = NullStorage()
+            for row in rows:
+                main.compressed.append(*row[:4], "SAFE", row[5])
+            for name in ("csv", "columnar"):
+                start = time.perf_counter()
+                asyncio.run(asgi_stream(main.app, f"/export?format={name}"))
+                report(f"/export {name} (compressed)", readings, time.perf_counter() - start,
+                       "rows")
+        finally:
+            main.storage, main.compressed = saved
+
+
+def bench_chart(days: int = 30, period: float = 2.0, width: int = 800):
+    """/chart from rollup tiers: query time and payload at 1 h to 30 day zoom vs raw points."""
+    rng = random.Random(11)
+    end = time.time()
+    count = int(days * 86400 / period)
+    base = end - count * period
+    device = "station-1"
+    rollups = RollupStore()
+    compressed = CompressedHistory(retention_days=days + 1)
+    temperature, gas_level, humidity = 25.0, 180, 50.0
+    rows = []
+    for i in range(count):
+        temperature = round(temperature + 0.02 * (25 - temperature) + rng.gauss(0, 0.1), 1)
+        gas_level = min(max(gas_level + rng.randint(-2, 2), 120), 240)
+        humidity = round(humidity + 0.02 * (50 - humidity) + rng.gauss(0, 0.2), 1)
+        gas = gas_level + (400 if rng.random() < 2e-5 else 0)  # Brief leak spikes
+        rows.append((base + i * period, temperature, gas, humidity,
+                     "DANGER" if gas > 500 else "SAFE", device))
+
+    start = time.perf_counter()
+    for row in rows:
+        rollups.add(*row)
+    report("RollupStore.add (4 tiers)", count, time.perf_counter() - start)
+    for row in rows:
+        compressed.append(*row)
+
+    saved = main.rollups, main.compressed
+    main.rollups, main.compressed = rollups, compressed
+    try:
+        for label, seconds in (("1 hour", 3600), ("24 hours", 86400),
+                               ("7 days", 7 * 86400), (f"{days} days", days * 86400 - 60)):
+            for lttb in ("", "&lttb=gas_level"):
+                path = f"/chart?device={device}&from={end - seconds}&to={end}&width={width}{lttb}"
+                asyncio.run(asgi_stream(main.app, path))  # Warm up
+                start = time.perf_counter()
+                status, size, _, body = asyncio.run(asgi_stream(main.app, path, keep=True))
+                elapsed = time.perf_counter() - start
+                chart = json.loads(body)
+                print(f"  {label:>8}{' lttb' if lttb else '     '}: {chart['count']:4d} points "
+                      f"@ {chart['resolution'] or 'raw':>4}{'s' if chart['resolution'] else ' '}, "
+                      f"{size / 1e3:6.1f} KB in {elapsed * 1e3:5.1f} ms (HTTP {status}), "
+                      f"gas max {max(chart['gas_level']['max'])}")
+        # The same ranges as raw readings from /history-style dicts
+        for label, seconds in (("24 hours", 86400), (f"{days} days", days * 86400)):
+            start = time.perf_counter()
+            raw = json.dumps(compressed.query(end - seconds, end, None, device))
+            print(f"  {label:>8} raw : {len(raw) / 1e6:6.1f} MB in "
+                  f"{(time.perf_counter() - start) * 1e3:7.1f} ms")
+    finally:
+        main.rollups, main.compressed = saved
+    buckets = rollups.bucket_count()
+    print(f"  rollups: {buckets} buckets, {rollups.nbytes / 1e3:.0f} KB for one device "
+          f"({days} days of readings every {period:g}s)")
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    "batch": bench_batch,
+    "fanout": bench_fanout,
+    "subscriptions": bench_subscriptions,
+    "conflation": bench_conflation,
+    "history": bench_history,
+    "storage": bench_storage,
+    "stats": bench_stats,
+    "rules": bench_rules,
+    "sessions": bench_sessions,
+    "logging": bench_logging,
+    "metrics": bench_metrics,
+    "parser": bench_parser,
+    "gateway": bench_gateway,
+    "ingest": bench_ingest,
+    "resume": bench_resume,
+    "workers": bench_workers,
+    "formats": bench_formats,
+    "compression": bench_compression,
+    "alerts": bench_alerts,
+    "replay": bench_replay,
+    "simulator": bench_simulator,
+    "export": bench_export,
+    "chart": bench_chart,
+}
+
+
+def main_cli(names: List[str]):
+    """Run the requested benchmarks (all of them by default)."""
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"❌ Unknown benchmark(s): {', '.join(unknown)}")
+        print(f"   Available: {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+
+    for name in names or list(BENCHMARKS):
+        print(f"\n⏱️  {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
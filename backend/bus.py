@@ -0,0 +1,284 @@
+"""
+Fan-out bus between SmartSense worker processes.
+
+With several uvicorn workers, a reading ingested by one worker must reach
+the WebSocket clients (and in-memory history) of every other worker. Each
+worker publishes the readings it accepts on the bus and applies the ones
+published by others.
+
+- NullBus: single process, nothing to share (default)
+- SocketBus: local hub over a Unix socket (or TCP on localhost). The first
+  worker to take the hub lock serves it and relays frames between workers;
+  if it exits, another worker takes over and the others reconnect.
+- RedisBus: Redis pub/sub for workers on several hosts (needs `redis`)
+
+Delivery is best effort: frames published while a worker is disconnected
+from the bus are not replayed to it. A frame its handler fails on is logged
+and skipped; it never stops the worker from receiving the ones after it.
+"""
+
+import asyncio
+import os
+import struct
+import sys
+from typing import Awaitable, Callable, Optional, Set
+from urllib.parse import urlparse
+
+from logger import log
+
+# "" (single process), unix:///path/bus.sock, tcp://127.0.0.1:8765 or redis://host:6379/0
+BUS_URL = os.getenv("BUS_URL", "")
+
+# Used by `WORKERS=N python main.py` when BUS_URL is not set
+DEFAULT_BUS_URL = ("tcp://127.0.0.1:8765" if sys.platform == "win32"
+                   else "unix:///tmp/smartsense-bus.sock")
+
+# Bytes buffered for a slow peer before frames to it are dropped
+BUS_MAX_BUFFER = int(os.getenv("BUS_MAX_BUFFER", str(16 * 1024 * 1024)))
+
+# Seconds between attempts to rejoin the bus, doubling up to the maximum
+BUS_RECONNECT_DELAY = 0.05
+BUS_RECONNECT_MAX_DELAY = 5.0
+
+REDIS_CHANNEL = "smartsense:readings"
+
+# Frame: 4-byte big-endian length, then the payload
+FRAME_HEADER = struct.Struct(">I")
+
+# Each publisher prefixes payloads with its origin ID so it can skip its own
+ORIGIN_BYTES = 8
+
+Handler = Callable[[bytes], Awaitable[None]]
+
+
+async def deliver(handler: Handler, payload: bytes) -> bool:
+    """Run the handler on one payload; a failure is logged instead of raised."""
+    try:
+        await handler(payload)
+        return True
+    except Exception:
+        log.error("❌ Worker bus frame could not be applied, skipping it", exc_info=True)
+        return False
+
+
+class Bus:
+    """Interface for cross-worker fan-out."""
+
+    # False when publishing is pointless (single process)
+    active = False
+
+    async def start(self, handler: Handler):
+        """Connect and deliver payloads published by other workers to handler."""
+
+    async def stop(self):
+        """Disconnect."""
+
+    async def publish(self, payload: bytes):
+        """Send a payload to every other worker. Must never block on a slow peer."""
+
+
+class NullBus(Bus):
+    """Single process: nothing to publish to."""
+
+
+class SocketBus(Bus):
+    """Hub-and-spoke bus over a Unix socket or localhost TCP, hosted by one worker."""
+
+    active = True
+
+    def __init__(self, url: str, max_buffer: int = BUS_MAX_BUFFER):
+        parsed = urlparse(url)
+        self.scheme = parsed.scheme
+        if self.scheme == "unix":
+            self.path = parsed.path
+        elif self.scheme == "tcp":
+            self.host = parsed.hostname or "127.0.0.1"
+            self.port = parsed.port or 8765
+        else:
+            raise ValueError(f"Unsupported bus URL '{url}'")
+        self.max_buffer = max_buffer
+        self.origin = os.urandom(ORIGIN_BYTES)
+        self.dropped = 0
+        self.failed = 0  # Frames the handler raised on
+        self._handler: Optional[Handler] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Set[asyncio.StreamWriter] = set()
+        self._lock_file = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._writer:
+            self._writer.close()
+        if self._server:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+        if self._lock_file:
+            self._lock_file.close()  # Releases the hub lock
+
+    async def publish(self, payload: bytes):
+        writer = self._writer
+        if writer is None or writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.dropped += 1
+            return
+        writer.write(FRAME_HEADER.pack(ORIGIN_BYTES + len(payload)) + self.origin + payload)
+
+    # -- Spoke: every worker -------------------------------------------
+
+    async def _connect(self):
+        if self.scheme == "unix":
+            return await asyncio.open_unix_connection(self.path)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def _run(self):
+        """Stay joined to the bus: reconnect (with backoff) whenever the connection ends."""
+        announced = False
+        delay = BUS_RECONNECT_DELAY
+        while True:
+            try:
+                reader, writer = await self._connect()
+            except OSError:
+                await self._try_host()
+                await asyncio.sleep(0.05 if self._server else 0.5)
+                continue
+
+            self._writer = writer
+            if not announced:
+                log.info("🔗 Joined worker bus %s%s", self.scheme,
+                         " (hosting hub)" if self._server else "")
+                announced = True
+            try:
+                while True:
+                    (size,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                    frame = await reader.readexactly(size)
+                    delay = BUS_RECONNECT_DELAY  # The connection works again
+                    if frame[:ORIGIN_BYTES] != self.origin:
+                        if not await deliver(self._handler, frame[ORIGIN_BYTES:]):
+                            self.failed += 1
+            except (asyncio.IncompleteReadError, ConnectionError):
+                log.warning("⚠️  Lost worker bus hub, reconnecting")
+            except Exception:
+                log.error("❌ Worker bus connection failed, reconnecting in %.2fs", delay,
+                          exc_info=True)
+            finally:
+                self._writer = None
+                writer.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BUS_RECONNECT_MAX_DELAY)
+
+    # -- Hub: one worker -----------------------------------------------
+
+    async def _try_host(self):
+        """Become the hub if no other worker is hosting it."""
+        if self._server is not None:
+            return
+        try:
+            if self.scheme == "unix":
+                if not self._take_lock():
+                    return
+                if os.path.exists(self.path):
+                    os.unlink(self.path)  # Left behind by a hub that exited
+                self._server = await asyncio.start_unix_server(self._serve_peer, self.path)
+            else:
+                # Binding the port is exclusive: only one worker can host
+                self._server = await asyncio.start_server(self._serve_peer, self.host, self.port)
+        except OSError:
+            self._server = None
+
+    def _take_lock(self) -> bool:
+        import fcntl
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Relay every frame from one worker to all the others."""
+        self._peers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                frame = header + await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+                for peer in self._peers:
+                    if peer is writer:
+                        continue
+                    if peer.transport.get_write_buffer_size() > self.max_buffer:
+                        self.dropped += 1  # That worker is stuck; don't grow without bound
+                        continue
+                    peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+
+class RedisBus(Bus):
+    """Redis pub/sub bus for workers spread over several hosts."""
+
+    active = True
+
+    def __init__(self, url: str, channel: str = REDIS_CHANNEL):
+        self.url = url
+        self.channel = channel
+        self.origin = os.urandom(ORIGIN_BYTES)
+        self._client = None
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Handler):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("BUS_URL=redis://... needs the 'redis' package (pip install redis)")
+        self._client = redis.from_url(self.url)
+        self._pubsub = self._client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen(handler))
+        log.info("🔗 Joined worker bus redis")
+
+    async def _listen(self, handler: Handler):
+        async for message in self._pubsub.listen():
+            if message["type"] != "message":
+                continue
+            data = message["data"]
+            if data[:ORIGIN_BYTES] != self.origin:
+                await deliver(handler, data[ORIGIN_BYTES:])
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._pubsub:
+            await self._pubsub.close()
+        if self._client:
+            await self._client.close()
+
+    async def publish(self, payload: bytes):
+        await self._client.publish(self.channel, self.origin + payload)
+
+
+def create_bus(url: str = BUS_URL) -> Bus:
+    """Build the bus selected by BUS_URL."""
+    if not url:
+        return NullBus()
+    scheme = urlparse(url).scheme
+    if scheme in ("unix", "tcp"):
+        return SocketBus(url)
+    if scheme in ("redis", "rediss"):
+        return RedisBus(url)
+    raise ValueError(f"Unknown bus URL '{url}' (expected unix://, tcp:// or redis://)")
@@ -0,0 +1,159 @@
+"""
+Capture files for SmartSense: raw serial lines and ingest payloads, timed.
+
+With CAPTURE=true, the Arduino reader and serial gateway record every line
+they read from a board (before parsing, so lines that fail to parse are kept
+too) and the backend records every /data and /data/batch body and /ingest
+frame. replay.py feeds a capture back through the parser or into a backend
+with the original inter-arrival timing, at 1x, Nx or full speed.
+
+A capture is gzip-compressed NDJSON. The first line is a header, then one
+record per line:
+
+    {"capture": 1, "source": "gateway", "started": "2024-05-01T10:00:00", ...}
+    {"t": 0.0131, "kind": "serial", "device": "line-1", "data": "Temp: 25.5°C | ..."}
+    {"t": 0.2504, "kind": "batch", "data": "[{...}]", "content_type": "application/json"}
+
+`t` is seconds since the capture started. Kinds: serial, data, batch and
+ingest. Payloads are kept byte for byte: bytes that are not UTF-8 (e.g. a
+Latin-1 "°" from a board) are stored as surrogate escapes.
+
+Records are written by a background thread, so capturing never blocks a
+serial loop or the event loop; if the writer falls behind by more than
+CAPTURE_MAX_PENDING records, new ones are dropped and counted.
+"""
+
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+CAPTURE = os.getenv("CAPTURE", "false").lower() == "true"
+
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "captures")
+
+# Records waiting for the writer thread before new ones are dropped
+CAPTURE_MAX_PENDING = int(os.getenv("CAPTURE_MAX_PENDING", "100000"))
+
+# Seconds between flushes, so a crash loses at most this much of a capture
+CAPTURE_FLUSH_INTERVAL = float(os.getenv("CAPTURE_FLUSH_INTERVAL", "1"))
+
+CAPTURE_VERSION = 1
+CAPTURE_SUFFIX = ".ndjson.gz"
+KINDS = ("serial", "data", "batch", "ingest")
+
+# (seconds since start, kind, payload, extra fields)
+Pending = Tuple[float, str, Union[bytes, str], Dict[str, str]]
+
+
+def encode_payload(payload: Union[bytes, str]) -> str:
+    if isinstance(payload, str):
+        return payload
+    return payload.decode("utf-8", "surrogateescape")
+
+
+def decode_payload(data: str) -> bytes:
+    """A record's payload as the exact bytes that were captured."""
+    return data.encode("utf-8", "surrogateescape")
+
+
+class CaptureWriter:
+    """Appends timed records to a capture file from a background thread."""
+
+    def __init__(self, path: str, source: str, max_pending: int = CAPTURE_MAX_PENDING,
+                 flush_interval: float = CAPTURE_FLUSH_INTERVAL):
+        self.path = path
+        self.source = source
+        self.flush_interval = flush_interval
+        self.queue: "queue.Queue[Optional[Pending]]" = queue.Queue(max_pending)
+        self.started = time.monotonic()
+        self.written = 0
+        self.dropped = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        header = {
+            "capture": CAPTURE_VERSION,
+            "source": self.source,
+            "started": datetime.now().isoformat(),
+            "pid": os.getpid(),
+        }
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, args=(header,),
+                                        name="capture-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write out everything still queued and close the file."""
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def record(self, kind: str, payload: Union[bytes, str], **fields: str):
+        """Queue one record; returns immediately."""
+        try:
+            self.queue.put_nowait((time.monotonic() - self.started, kind, payload, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self, header: dict):
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            next_flush = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    t, kind, payload, fields = item
+                    record = {"t": round(t, 6), "kind": kind, **fields,
+                              "data": encode_payload(payload)}
+                    f.write(json.dumps(record) + "\n")
+                    self.written += 1
+                if time.monotonic() >= next_flush:
+                    f.flush()  # Sync flush: everything so far is readable
+                    next_flush = time.monotonic() + self.flush_interval
+
+
+def open_capture(source: str, directory: str = CAPTURE_DIR,
+                 enabled: bool = CAPTURE) -> Optional[CaptureWriter]:
+    """A started capture writer for this process, or None when CAPTURE is off."""
+    if not enabled:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    name = f"{source}-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}{CAPTURE_SUFFIX}"
+    writer = CaptureWriter(os.path.join(directory, name), source)
+    writer.start()
+    return writer
+
+
+def read_capture(path: str) -> Tuple[dict, Iterator[dict]]:
+    """The header of a capture and an iterator over its records, in order."""
+    f = gzip.open(path, "rt", encoding="utf-8")
+    try:
+        header = json.loads(f.readline())
+    except (OSError, EOFError, ValueError):
+        f.close()
+        raise ValueError(f"{path} is not a SmartSense capture")
+    if not isinstance(header, dict) or header.get("capture") != CAPTURE_VERSION:
+        f.close()
+        raise ValueError(f"{path} is not a SmartSense capture (version {CAPTURE_VERSION})")
+
+    def records() -> Iterator[dict]:
+        with f:
+            try:
+                for line in f:
+                    yield json.loads(line)
+            except (EOFError, ValueError):
+                pass  # Truncated tail of a capture whose writer was killed
+
+    return header, records()
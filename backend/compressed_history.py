@@ -0,0 +1,429 @@
+"""
+Compressed in-memory history for SmartSense, for months of retention.
+
+The ring buffer in history.py spends ~33 bytes per reading, fine for hours
+but not for months. Here each device's readings are kept in chunks
+compressed the way Facebook's Gorilla time-series database does it:
+
+- timestamps (milliseconds) as delta-of-delta: a steady reading period
+  costs 1 bit, a few ms of jitter ~1 byte
+- temperature and humidity XORed with the previous value: an unchanged
+  value costs 1 bit, a small change only its differing middle bits
+- gas level and status as deltas from the previous reading
+
+The newest chunk of each device is writable; once full it is sealed into
+immutable bytes. Late readings (older than a device's newest) go to
+separate chunks and are merged back in by time. Range queries skip chunks
+outside the range and stream points out of the rest. Compression is lossless, except that timestamps
+are kept to the millisecond.
+"""
+
+import heapq
+import os
+import struct
+from bisect import insort
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from history import DEFAULT_DEVICE, STATUS_CODES, STATUS_INDEX
+
+# Days of readings kept in compressed form (0 disables the store)
+COMPRESSED_HISTORY_DAYS = float(os.getenv("COMPRESSED_HISTORY_DAYS", "90"))
+
+# Readings per chunk before it is sealed
+COMPRESSED_CHUNK_POINTS = int(os.getenv("COMPRESSED_CHUNK_POINTS", "1024"))
+
+FLOAT_BITS = struct.Struct(">d")
+MASK64 = (1 << 64) - 1
+
+# Decoded point: (timestamp, temperature, gas_level, humidity, status code)
+Point = Tuple[float, float, int, float, int]
+
+
+def float_to_bits(value: float) -> int:
+    return int.from_bytes(FLOAT_BITS.pack(value), "big")
+
+
+def bits_to_float(bits: int) -> float:
+    return FLOAT_BITS.unpack(bits.to_bytes(8, "big"))[0]
+
+
+class BitWriter:
+    """Appends bit fields to a byte buffer, most significant bit first."""
+
+    __slots__ = ("buffer", "acc", "count")
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0    # Bits not yet flushed to the buffer
+        self.count = 0  # How many
+
+    def write(self, value: int, bits: int):
+        """Append the low `bits` bits of a non-negative value."""
+        self.acc = (self.acc << bits) | value
+        self.count += bits
+        if self.count >= 32:
+            spare = self.count & 7
+            self.buffer += (self.acc >> spare).to_bytes(self.count >> 3, "big")
+            self.acc &= (1 << spare) - 1
+            self.count = spare
+
+    def getvalue(self) -> bytes:
+        """Everything written so far, zero-padded to whole bytes."""
+        if not self.count:
+            return bytes(self.buffer)
+        pad = -self.count % 8
+        return bytes(self.buffer) + (self.acc << pad).to_bytes((self.count + pad) >> 3, "big")
+
+
+def write_signed(writer: BitWriter, value: int):
+    """Variable-length signed integer: 1 bit for 0, up to 68 bits for outliers."""
+    if value == 0:
+        writer.write(0, 1)
+    elif -63 <= value <= 64:
+        writer.write((0b10 << 7) | (value + 63), 9)
+    elif -255 <= value <= 256:
+        writer.write((0b110 << 9) | (value + 255), 12)
+    elif -2047 <= value <= 2048:
+        writer.write((0b1110 << 12) | (value + 2047), 16)
+    else:
+        writer.write(0b1111, 4)
+        writer.write(value & MASK64, 64)
+
+
+class XorEncoder:
+    """Gorilla float compression: each value XORed with the previous one."""
+
+    __slots__ = ("previous", "leading", "trailing")
+
+    def __init__(self):
+        self.previous: Optional[int] = None
+        self.leading = 65  # No window yet
+        self.trailing = 0
+
+    def write(self, writer: BitWriter, value: float):
+        bits = float_to_bits(value)
+        if self.previous is None:
+            writer.write(bits, 64)
+            self.previous = bits
+            return
+        xor = bits ^ self.previous
+        self.previous = bits
+        if xor == 0:
+            writer.write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if leading >= self.leading and trailing >= self.trailing:
+            # Fits the previous window: only the meaningful bits
+            meaningful = 64 - self.leading - self.trailing
+            writer.write(0b10, 2)
+            writer.write(xor >> self.trailing, meaningful)
+        else:
+            meaningful = 64 - leading - trailing
+            writer.write((0b11 << 11) | (leading << 6) | (meaningful - 1), 13)
+            writer.write(xor >> trailing, meaningful)
+            self.leading, self.trailing = leading, trailing
+
+
+class Chunk:
+    """An immutable block of compressed readings of one device."""
+
+    __slots__ = ("first", "last", "count", "data")
+
+    def __init__(self, first: int, last: int, count: int, data: bytes):
+        self.first = first  # Milliseconds of the first and last reading
+        self.last = last
+        self.count = count
+        self.data = data
+
+    def points(self) -> Iterator[Point]:
+        """Decode every reading, oldest first."""
+        data = self.data
+        # Reading bits out of a '0'/'1' string is the fastest pure-Python route
+        s = bin(int.from_bytes(data, "big"))[2:].zfill(len(data) * 8)
+        pos = 0
+
+        def signed() -> int:
+            nonlocal pos
+            if s[pos] == "0":
+                pos += 1
+                return 0
+            if s[pos + 1] == "0":
+                pos += 9
+                return int(s[pos - 7:pos], 2) - 63
+            if s[pos + 2] == "0":
+                pos += 12
+                return int(s[pos - 9:pos], 2) - 255
+            if s[pos + 3] == "0":
+                pos += 16
+                return int(s[pos - 12:pos], 2) - 2047
+            pos += 68
+            value = int(s[pos - 64:pos], 2)
+            return value - (1 << 64) if value >> 63 else value
+
+        def xor_reader():
+            nonlocal pos
+            previous = int(s[pos:pos + 64], 2)
+            pos += 64
+            leading = trailing = 0
+            value = bits_to_float(previous)
+            yield value
+            while True:
+                if s[pos] == "0":
+                    pos += 1
+                else:
+                    if s[pos + 1] == "1":
+                        leading = int(s[pos + 2:pos + 7], 2)
+                        meaningful = int(s[pos + 7:pos + 13], 2) + 1
+                        trailing = 64 - leading - meaningful
+                        pos += 13
+                    else:
+                        meaningful = 64 - leading - trailing
+                        pos += 2
+                    previous ^= int(s[pos:pos + meaningful], 2) << trailing
+                    pos += meaningful
+                    value = bits_to_float(previous)
+                yield value
+
+        # The first reading of a chunk is stored in full
+        ms = int(s[0:64], 2)
+        pos = 64
+        temperature_reader = xor_reader()
+        temperature = next(temperature_reader)
+        gas = signed()
+        humidity_reader = xor_reader()
+        humidity = next(humidity_reader)
+        status = signed()
+        yield ms / 1000, temperature, gas, humidity, status
+
+        delta = 0
+        for _ in range(self.count - 1):
+            delta += signed()
+            ms += delta
+            temperature = next(temperature_reader)
+            gas += signed()
+            humidity = next(humidity_reader)
+            status += signed()
+            yield ms / 1000, temperature, gas, humidity, status
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+
+class ChunkWriter:
+    """The open chunk of a device: appends readings until it is sealed."""
+
+    __slots__ = ("writer", "first", "last", "count", "delta", "gas", "status",
+                 "temperature", "humidity")
+
+    def __init__(self):
+        self.writer = BitWriter()
+        self.first = self.last = 0
+        self.count = 0
+        self.delta = 0
+        self.gas = 0
+        self.status = 0
+        self.temperature = XorEncoder()
+        self.humidity = XorEncoder()
+
+    def append(self, ms: int, temperature: float, gas_level: int, humidity: float, status: int):
+        writer = self.writer
+        if self.count == 0:
+            self.first = ms
+            writer.write(ms, 64)
+        else:
+            delta = ms - self.last
+            write_signed(writer, delta - self.delta)
+            self.delta = delta
+        self.temperature.write(writer, temperature)
+        write_signed(writer, gas_level - self.gas)
+        self.humidity.write(writer, humidity)
+        write_signed(writer, status - self.status)
+        self.last = ms
+        self.gas = gas_level
+        self.status = status
+        self.count += 1
+
+    def chunk(self) -> Chunk:
+        """The readings written so far (a copy; appends may continue)."""
+        return Chunk(self.first, self.last, self.count, self.writer.getvalue())
+
+
+class CompressedSeries:
+    """
+    One device's chunks, oldest first; the newest is open for appends.
+
+    Readings older than the newest one (spool flushes, another worker's
+    readings) cannot be appended to a delta-of-delta chunk. They are kept
+    in a sorted buffer instead, sealed into chunks of their own when full,
+    and merged back in by time when reading.
+    """
+
+    def __init__(self, chunk_points: int = COMPRESSED_CHUNK_POINTS):
+        self.chunk_points = chunk_points
+        self.sealed: Deque[Chunk] = deque()
+        self.open = ChunkWriter()
+        self.last_ms: Optional[int] = None
+        self.late: List[Tuple[int, float, int, float, int]] = []  # Sorted by ms
+        self.late_sealed: List[Chunk] = []
+
+    def append(self, ms: int, temperature: float, gas_level: int, humidity: float, status: int):
+        if self.last_ms is not None and ms < self.last_ms:
+            self._append_late(ms, temperature, gas_level, humidity, status)
+            return
+        self.last_ms = ms
+        self.open.append(ms, temperature, gas_level, humidity, status)
+        if self.open.count >= self.chunk_points:
+            self.sealed.append(self.open.chunk())
+            self.open = ChunkWriter()
+
+    def _append_late(self, ms: int, temperature: float, gas_level: int, humidity: float,
+                     status: int):
+        insort(self.late, (ms, temperature, gas_level, humidity, status))
+        if len(self.late) >= self.chunk_points:
+            writer = ChunkWriter()
+            for point in self.late:
+                writer.append(*point)
+            self.late_sealed.append(writer.chunk())
+            self.late = []
+
+    def trim(self, cutoff_ms: int) -> int:
+        """Drop sealed chunks that end before the cutoff. Returns readings dropped."""
+        dropped = 0
+        while self.sealed and self.sealed[0].last < cutoff_ms:
+            dropped += self.sealed.popleft().count
+        kept = [chunk for chunk in self.late_sealed if chunk.last >= cutoff_ms]
+        dropped += sum(chunk.count for chunk in self.late_sealed) - sum(chunk.count for chunk in kept)
+        self.late_sealed = kept
+        return dropped
+
+    def chunks(self) -> List[Chunk]:
+        chunks = list(self.sealed)
+        if self.open.count:
+            chunks.append(self.open.chunk())
+        return chunks
+
+    def points(self, start_ms: Optional[int] = None,
+               end_ms: Optional[int] = None) -> Iterator[Point]:
+        """Stream readings with start <= time <= end, oldest first."""
+        streams = [chunk_points(self.chunks(), start_ms, end_ms)]
+        if self.late_sealed or self.late:
+            streams += [chunk_points([chunk], start_ms, end_ms) for chunk in self.late_sealed]
+            # Copied now: appends may insert into the buffer while the caller iterates
+            streams.append([
+                (ms / 1000, *rest) for ms, *rest in self.late
+                if (start_ms is None or ms >= start_ms) and (end_ms is None or ms <= end_ms)
+            ])
+            return heapq.merge(*streams, key=lambda point: point[0])
+        return streams[0]
+
+    @property
+    def nbytes(self) -> int:
+        # A buffered late reading is a tuple of five numbers (~160 bytes)
+        return (sum(chunk.nbytes for chunk in self.sealed)
+                + sum(chunk.nbytes for chunk in self.late_sealed)
+                + len(self.open.writer.buffer) + 8 + 160 * len(self.late))
+
+    def __len__(self) -> int:
+        return (sum(chunk.count for chunk in self.sealed) + self.open.count
+                + sum(chunk.count for chunk in self.late_sealed) + len(self.late))
+
+
+def chunk_points(chunks: List[Chunk], start_ms: Optional[int] = None,
+                 end_ms: Optional[int] = None) -> Iterator[Point]:
+    """Readings of time-ordered chunks with start <= time <= end, oldest first."""
+    start = None if start_ms is None else start_ms / 1000
+    end = None if end_ms is None else end_ms / 1000
+    for chunk in chunks:
+        if start_ms is not None and chunk.last < start_ms:
+            continue
+        if end_ms is not None and chunk.first > end_ms:
+            break
+        for point in chunk.points():
+            if start is not None and point[0] < start:
+                continue
+            if end is not None and point[0] > end:
+                return
+            yield point
+
+
+class CompressedHistory:
+    """Per-device compressed series with time-based retention."""
+
+    def __init__(self, retention_days: float = COMPRESSED_HISTORY_DAYS,
+                 chunk_points: int = COMPRESSED_CHUNK_POINTS):
+        self.retention_ms = int(retention_days * 86400 * 1000)
+        self.chunk_points = chunk_points
+        self.series: Dict[str, CompressedSeries] = {}
+        # Readings from this time on are all held (None until the first one)
+        self.since: Optional[float] = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return sum(series.nbytes for series in self.series.values())
+
+    def append(self, timestamp: float, temperature: float, gas_level: int,
+               humidity: float, status: str, device_id: str = DEFAULT_DEVICE):
+        if self.retention_ms <= 0:
+            return  # Disabled
+        series = self.series.get(device_id)
+        if series is None:
+            series = self.series[device_id] = CompressedSeries(self.chunk_points)
+        sealed = len(series.sealed)
+        ms = round(timestamp * 1000)
+        series.append(ms, temperature, gas_level, humidity, STATUS_INDEX[status])
+        self.size += 1
+        if self.since is None:
+            self.since = timestamp
+        if len(series.sealed) != sealed:
+            # A chunk was just sealed: a good moment to enforce retention
+            cutoff = ms - self.retention_ms
+            self.size -= series.trim(cutoff)
+            if cutoff / 1000 > self.since:
+                self.since = cutoff / 1000
+
+    def oldest_timestamp(self) -> Optional[float]:
+        """Time from which every reading is held, or None when empty."""
+        return self.since
+
+    def points(self, start: Optional[float] = None, end: Optional[float] = None,
+               device_id: Optional[str] = None) -> Iterator[Tuple[float, float, int, float, int, str]]:
+        """Stream (timestamp, temperature, gas, humidity, status, device) oldest first."""
+        # Rounded the same way as stored timestamps
+        start_ms = None if start is None else round(start * 1000)
+        end_ms = None if end is None else round(end * 1000)
+
+        def tagged(name: str, series: CompressedSeries):
+            for point in series.points(start_ms, end_ms):
+                yield point + (name,)
+
+        if device_id is not None:
+            series = self.series.get(device_id)
+            return tagged(device_id, series) if series is not None else iter(())
+        # Devices are stored apart; merge their streams back into time order
+        return heapq.merge(*(tagged(name, series) for name, series in self.series.items()),
+                           key=lambda point: point[0])
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              limit: Optional[int] = None, device_id: Optional[str] = None) -> List[Dict]:
+        """Readings in a time range, oldest first (the most recent `limit`), like TimeSeriesRing."""
+        rows = deque(self.points(start, end, device_id), maxlen=limit)
+        fromtimestamp = datetime.fromtimestamp
+        return [
+            {
+                "device_id": device,
+                "temperature": temperature,
+                "gas_level": gas_level,
+                "humidity": humidity,
+                "status": STATUS_CODES[status],
+                "timestamp": fromtimestamp(timestamp, timezone.utc).isoformat()
+            }
+            for timestamp, temperature, gas_level, humidity, status, device in rows
+        ]
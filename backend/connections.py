@@ -0,0 +1,585 @@
+"""
+WebSocket connection management for SmartSense.
+
+Each dashboard gets a bounded outbound queue drained by its own sender task,
+so a slow or stalled client never delays the others (or the POST that
+triggered the broadcast).
+
+Clients receive every device by default. After subscribing to specific
+devices they are indexed per device, so fanning out a reading only touches
+the clients watching that device (plus the catch-all clients).
+
+Clients may also cap their update rate. Between ticks the server keeps only
+the latest reading per device and sends one frame per tick, so slow wall
+displays cost one frame per interval no matter how fast readings arrive.
+
+Every broadcast reading carries a sequence number and is kept in a bounded
+replay buffer. A new client first gets a snapshot of the latest readings; a
+client reconnecting with the last sequence number it saw gets exactly the
+readings it missed, as one frame.
+
+Clients may pick a compact frame format (see frames.py). Each frame is
+encoded once per format and shared by every client using it.
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import time
+from collections import deque
+from itertools import islice
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket
+
+from frames import binary_frame, deflate, encode_record, epoch_seconds
+from logger import log
+from metrics import REGISTRY
+
+# Outbound messages buffered per client before the slow-client policy applies
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+
+# What to do when a client's queue is full:
+# - drop_oldest: discard the oldest queued message
+# - latest: discard everything queued and keep only the newest message
+# - disconnect: close the client (it can reconnect and start fresh)
+WS_SLOW_CLIENT_POLICY = os.getenv("WS_SLOW_CLIENT_POLICY", "drop_oldest")
+
+# Seconds a single send may take before the client is considered dead
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+SLOW_CLIENT_POLICIES = ("drop_oldest", "latest", "disconnect")
+
+# Close code sent to clients disconnected for falling behind ("try again later")
+CLOSE_TRY_AGAIN_LATER = 1013
+
+# Highest update rate a client may request (updates per second)
+WS_MAX_RATE_HZ = float(os.getenv("WS_MAX_RATE_HZ", "100"))
+
+# Broadcast readings kept for clients resuming after a disconnect (0 disables
+# snapshots and resume)
+WS_REPLAY_SIZE = int(os.getenv("WS_REPLAY_SIZE", "10000"))
+
+# Latest readings sent to a client when it connects
+WS_SNAPSHOT_SIZE = int(os.getenv("WS_SNAPSHOT_SIZE", "20"))
+
+BROADCAST_SECONDS = REGISTRY.histogram(
+    "smartsense_ws_broadcast_seconds", "Time to fan a broadcast out to client queues"
+)
+DROPPED_MESSAGES = REGISTRY.counter(
+    "smartsense_ws_dropped_messages_total", "Messages discarded by the slow-client policy"
+)
+SLOW_CLIENT_EVICTIONS = REGISTRY.counter(
+    "smartsense_ws_evictions_total", "Clients disconnected for falling behind or stalling"
+)
+
+
+class ReplayBuffer:
+    """
+    Numbers broadcast readings and keeps the most recent ones.
+
+    The epoch identifies this server process: sequence numbers from another
+    process (a restart, or another worker) cannot be resumed from.
+    """
+
+    def __init__(self, capacity: int = WS_REPLAY_SIZE, snapshot_size: int = WS_SNAPSHOT_SIZE):
+        self.snapshot_size = snapshot_size
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        # Readings are kept as dicts and only serialized when a frame needs them
+        self.readings: Deque[dict] = deque(maxlen=capacity)
+        # Frames built since the last reading, shared by clients (re)connecting together
+        self._frames: Dict[Optional[int], str] = {}
+
+    def add(self, reading: dict) -> int:
+        """Number a reading and keep it. Returns its sequence number."""
+        self.seq += 1
+        self.readings.append(reading)
+        if self._frames:
+            self._frames.clear()
+        return self.seq
+
+    @staticmethod
+    def serialize(reading: dict, seq: int) -> str:
+        # Splice the number into the serialized reading rather than copying the dict
+        return json.dumps(reading)[:-1] + f', "seq": {seq}}}'
+
+    def frame_for(self, last_seq: Optional[int] = None, epoch: Optional[str] = None) -> str:
+        """
+        The first frame for a connecting client.
+
+        Readings after last_seq if they are all still buffered ("replay"),
+        otherwise the latest snapshot_size readings ("snapshot"). Both carry
+        the current epoch and sequence number to resume from next time.
+        """
+        resumable = (last_seq is not None and epoch == self.epoch
+                     and self.seq - len(self.readings) <= last_seq <= self.seq)
+        key = last_seq if resumable else None
+        frame = self._frames.get(key)
+        if frame is None:
+            count = min(self.seq - last_seq if resumable else self.snapshot_size,
+                        len(self.readings))
+            recent = list(islice(reversed(self.readings), count))
+            recent.reverse()
+            first = self.seq - count + 1
+            messages = ",".join(self.serialize(reading, first + i)
+                                for i, reading in enumerate(recent))
+            kind = "replay" if resumable else "snapshot"
+            frame = self._frames[key] = (
+                f'{{"type": "{kind}", "epoch": "{self.epoch}", "seq": {self.seq}, '
+                f'"readings": [{messages}]}}'
+            )
+        return frame
+
+
+# A frame as sent: JSON text, or bytes for binary / compressed formats
+Message = Union[str, bytes]
+
+
+class Outgoing:
+    """A reading being broadcast, encoded lazily and at most once per format."""
+
+    __slots__ = ("reading", "seq", "previous", "_json", "_full", "_delta")
+
+    def __init__(self, reading: dict, seq: int, previous: Optional[Tuple[dict, int]]):
+        self.reading = reading
+        self.seq = seq
+        # The device's previous broadcast reading and its seq, the base for delta records
+        self.previous = previous
+        self._json: Optional[str] = None
+        self._full: Optional[bytes] = None
+        self._delta: Optional[bytes] = None
+
+    @property
+    def device_id(self) -> str:
+        return self.reading["device_id"]
+
+    def json(self) -> str:
+        if self._json is None:
+            self._json = (ReplayBuffer.serialize(self.reading, self.seq) if self.seq
+                          else json.dumps(self.reading))
+        return self._json
+
+    def full(self) -> bytes:
+        if self._full is None:
+            self._full = encode_record(self.reading, self.seq,
+                                       epoch_seconds(self.reading["timestamp"]))
+        return self._full
+
+    def delta(self) -> bytes:
+        if self.previous is None:
+            return self.full()
+        if self._delta is None:
+            previous, previous_seq = self.previous
+            base = (previous, previous_seq, epoch_seconds(previous["timestamp"]))
+            self._delta = encode_record(self.reading, self.seq,
+                                        epoch_seconds(self.reading["timestamp"]), base)
+        return self._delta
+
+
+class Frames:
+    """The frames for one group of readings, built once per (format, compression)."""
+
+    def __init__(self, items: List[Outgoing]):
+        self.items = items
+        self.built: Dict[Tuple[str, bool], Message] = {}
+        self._devices: Optional[Set[str]] = None
+
+    def for_client(self, client: "ClientConnection") -> Message:
+        kind = client.format
+        if kind == "delta":
+            if self._devices is None:
+                self._devices = {item.device_id for item in self.items}
+            # Deltas only apply on top of the previous reading of each device
+            if not self._devices <= client.synced:
+                kind = "binary"
+                client.synced |= self._devices
+        return self.build(kind, client.compress)
+
+    def build(self, kind: str, compress: bool = False) -> Message:
+        key = (kind, compress)
+        frame = self.built.get(key)
+        if frame is None:
+            items = self.items
+            if kind == "json":
+                frame = (items[0].json() if len(items) == 1
+                         else "[" + ",".join(item.json() for item in items) + "]")
+            elif kind == "delta":
+                frame = binary_frame(item.delta() for item in items)
+            else:
+                frame = binary_frame(item.full() for item in items)
+            if compress:
+                frame = deflate(frame.encode() if isinstance(frame, str) else frame)
+            self.built[key] = frame
+        return frame
+
+
+class ClientConnection:
+    """A connected WebSocket client with its own outbound queue and sender task."""
+
+    def __init__(self, websocket: WebSocket, max_queue: int, policy: str,
+                 send_timeout: float):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.queue: Deque[Message] = deque()
+        self.dropped = 0
+        self.closing = False
+        self.send_started: Optional[float] = None
+        # None means "all devices"; otherwise the device IDs subscribed to
+        self.devices: Optional[Set[str]] = None
+        # Rate limiting: minimum seconds between frames (0 = every reading)
+        self.min_interval = 0.0
+        # Latest reading per device (serialized, or still to encode), waiting for the next tick
+        self.latest: Dict[str, Union[str, Outgoing]] = {}
+        # Frame format (see frames.py) and whether frames are deflated
+        self.format = "json"
+        self.compress = False
+        # Delta clients: devices whose previous reading this client has received
+        self.synced: Set[str] = set()
+        self.task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def enqueue(self, message: Message):
+        """Queue a message for this client, applying the slow-client policy."""
+        if self.closing:
+            return
+
+        # A send stuck longer than send_timeout means the peer is gone
+        if (self.send_started is not None
+                and time.monotonic() - self.send_started > self.send_timeout):
+            log.warning("⚠️  Client send timed out, evicting")
+            SLOW_CLIENT_EVICTIONS.inc()
+            self.closing = True
+            if self.task:
+                self.task.cancel()
+            return
+
+        if len(self.queue) >= self.max_queue:
+            if self.format == "delta" and self.policy != "disconnect":
+                # Queued deltas build on each other: dropping any breaks the
+                # rest, so drop them all and resync with full records
+                self.dropped += len(self.queue) + 1
+                DROPPED_MESSAGES.inc(len(self.queue) + 1)
+                self.queue.clear()
+                self.synced.clear()
+                return
+            if self.policy == "disconnect":
+                self.dropped += len(self.queue) + 1
+                DROPPED_MESSAGES.inc(len(self.queue) + 1)
+                SLOW_CLIENT_EVICTIONS.inc()
+                self.queue.clear()
+                self.closing = True
+                self._wakeup.set()
+                return
+            if self.policy == "latest":
+                self.dropped += len(self.queue)
+                DROPPED_MESSAGES.inc(len(self.queue))
+                self.queue.clear()
+            else:
+                self.queue.popleft()
+                self.dropped += 1
+                DROPPED_MESSAGES.inc()
+
+        self.queue.append(message)
+        self._wakeup.set()
+
+    def offer(self, device_id: str, message: Union[str, Outgoing]):
+        """Deliver a reading: queued directly, or conflated when rate limited."""
+        if not self.min_interval:
+            self.enqueue(message if isinstance(message, str) else self._frame([message]))
+            return
+        if self.closing:
+            return
+        self.latest[device_id] = message
+        self._wakeup.set()
+
+    def set_rate(self, max_hz: Optional[float]):
+        """Cap updates per second; None or 0 removes the cap."""
+        if not max_hz or max_hz <= 0:
+            self.min_interval = 0.0
+            # Whatever was conflated goes out on the normal path
+            for message in self.latest.values():
+                self.enqueue(self._frame([message]))
+            self.latest.clear()
+        else:
+            self.min_interval = 1.0 / min(max_hz, WS_MAX_RATE_HZ)
+            self.synced.clear()  # Conflation skips readings, so deltas can't apply
+
+    def _frame(self, messages: List[Union[str, Outgoing]]) -> Message:
+        """A frame for this client only (conflated or leftover readings, never deltas)."""
+        if all(isinstance(message, Outgoing) for message in messages):
+            kind = "json" if self.format == "json" else "binary"
+            return Frames(messages).build(kind, self.compress)
+        texts = [m if isinstance(m, str) else m.json() for m in messages]
+        if len(texts) == 1:
+            return texts[0]
+        # Readings are already JSON; join them instead of re-serializing
+        return "[" + ",".join(texts) + "]"
+
+    def _take_latest_frame(self) -> Message:
+        """One frame holding the latest reading of every updated device."""
+        messages = list(self.latest.values())
+        self.latest.clear()
+        return self._frame(messages)
+
+    async def _send(self, message: Message):
+        self.send_started = time.monotonic()
+        if isinstance(message, bytes):
+            await self.websocket.send_bytes(message)
+        else:
+            await self.websocket.send_text(message)
+        self.send_started = None
+
+    async def run(self, on_exit: Callable[["ClientConnection"], None]):
+        """Sender loop: drain the queue until the client goes away."""
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+
+                while self.queue:
+                    await self._send(self.queue.popleft())
+
+                if self.latest:
+                    await self._send(self._take_latest_frame())
+                    # Hold off until the next tick; readings conflate meanwhile
+                    await asyncio.sleep(self.min_interval)
+
+                if self.closing:
+                    log.warning("⚠️  Client too slow, disconnecting")
+                    self.send_started = time.monotonic()
+                    await self.websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Error sending to client: %s", e)
+        finally:
+            on_exit(self)
+
+
+class ConnectionManager:
+    """Manages WebSocket connections for real-time data broadcasting."""
+
+    def __init__(self, max_queue: int = WS_QUEUE_SIZE,
+                 policy: str = WS_SLOW_CLIENT_POLICY,
+                 send_timeout: float = WS_SEND_TIMEOUT,
+                 replay_size: int = WS_REPLAY_SIZE):
+        if policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(
+                f"Unknown slow-client policy '{policy}' "
+                f"(expected one of: {', '.join(SLOW_CLIENT_POLICIES)})"
+            )
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        # Clients receiving every device, and per-device subscriber index
+        self.all_devices: Set[ClientConnection] = set()
+        self.subscribers: Dict[str, Set[ClientConnection]] = {}
+        self.replay = ReplayBuffer(replay_size) if replay_size > 0 else None
+        # Last broadcast reading per device and its seq: the base for delta frames
+        self.previous: Dict[str, Tuple[dict, int]] = {}
+
+    async def connect(self, websocket: WebSocket, last_seq: Optional[int] = None,
+                      epoch: Optional[str] = None, frame_format: str = "json",
+                      compress: bool = False):
+        """
+        Accept a client and queue its snapshot (or, when resuming from
+        last_seq, the readings it missed) ahead of any new broadcast.
+        """
+        await websocket.accept()
+        client = ClientConnection(websocket, self.max_queue, self.policy, self.send_timeout)
+        client.format = frame_format
+        client.compress = compress
+        if self.replay is not None:
+            client.enqueue(self.replay.frame_for(last_seq, epoch))
+        self.active_connections[websocket] = client
+        self.all_devices.add(client)
+        client.task = asyncio.create_task(client.run(self._evict))
+        log.info("Client connected. Total connections: %d", len(self.active_connections))
+
+    def disconnect(self, websocket: WebSocket):
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return  # Already evicted by its sender task
+        self._unindex(client)
+        if client.task and not client.task.done():
+            client.task.cancel()
+        log.info("Client disconnected. Total connections: %d", len(self.active_connections))
+
+    def _evict(self, client: ClientConnection):
+        """Drop a client whose sender task has stopped (dead, slow or closed)."""
+        if self.active_connections.get(client.websocket) is client:
+            del self.active_connections[client.websocket]
+            self._unindex(client)
+            log.info("Client evicted. Total connections: %d", len(self.active_connections))
+
+    def _unindex(self, client: ClientConnection):
+        """Remove a client from the subscription indexes."""
+        self.all_devices.discard(client)
+        for device_id in client.devices or ():
+            watchers = self.subscribers.get(device_id)
+            if watchers is not None:
+                watchers.discard(client)
+                if not watchers:
+                    del self.subscribers[device_id]
+
+    def subscribe(self, websocket: WebSocket, devices: Iterable[str]):
+        """
+        Watch the given devices. "*" switches back to receiving every device.
+
+        The first subscription replaces the default of receiving everything.
+        """
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        devices = set(devices)
+        if "*" in devices:
+            self._unindex(client)
+            client.devices = None
+            client.synced.clear()
+            self.all_devices.add(client)
+            return
+
+        # Readings of newly watched devices may have been skipped meanwhile
+        client.synced -= devices
+
+        if client.devices is None:
+            self.all_devices.discard(client)
+            client.devices = set()
+        for device_id in devices:
+            client.devices.add(device_id)
+            self.subscribers.setdefault(device_id, set()).add(client)
+
+    def unsubscribe(self, websocket: WebSocket, devices: Iterable[str]):
+        """Stop watching the given devices ("*" stops everything)."""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        devices = set(devices)
+        client.synced -= devices
+        if "*" in devices:
+            self._unindex(client)
+            client.devices = set()
+            client.synced.clear()
+            return
+        if client.devices is None:
+            return  # Catch-all clients have no per-device subscriptions
+        for device_id in devices & client.devices:
+            client.devices.discard(device_id)
+            watchers = self.subscribers[device_id]
+            watchers.discard(client)
+            if not watchers:
+                del self.subscribers[device_id]
+
+    def has_subscribers(self, device_id: str) -> bool:
+        """Whether any client explicitly watches this device."""
+        return device_id in self.subscribers
+
+    def set_rate(self, websocket: WebSocket, max_hz: Optional[float]):
+        """Cap a client's update rate (None or 0 for every reading)."""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            client.set_rate(max_hz)
+
+    def send(self, websocket: WebSocket, message: str):
+        """Queue a message for a single client."""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            client.enqueue(message)
+
+    async def broadcast(self, message: str, device_id: Optional[str] = None):
+        """
+        Queue message for interested clients without waiting on any socket.
+
+        With a device_id, only catch-all clients and that device's subscribers
+        receive it; without one, every client does.
+        """
+        start = time.perf_counter()
+        if device_id is None:
+            for client in list(self.active_connections.values()):
+                client.enqueue(message)
+        else:
+            for client in list(self.all_devices):
+                client.offer(device_id, message)
+            for client in list(self.subscribers.get(device_id, ())):
+                client.offer(device_id, message)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    def remember(self, reading: dict) -> int:
+        """Number a reading and keep it for snapshots, resume and deltas. Returns its seq."""
+        seq = self.replay.add(reading) if self.replay is not None else 0
+        self.previous[reading["device_id"]] = (reading, seq)
+        return seq
+
+    def _outgoing(self, reading: dict) -> Outgoing:
+        previous = self.previous.get(reading["device_id"])
+        return Outgoing(reading, self.remember(reading), previous)
+
+    async def broadcast_reading(self, reading: dict):
+        """Fan out a single reading to the clients watching its device."""
+        if not self.active_connections:
+            self.remember(reading)  # Encoded later only if someone resumes
+            return
+        start = time.perf_counter()
+        item = self._outgoing(reading)
+        frames = Frames([item])
+        device_id = item.device_id
+        for client in list(self.all_devices):
+            if client.min_interval:
+                client.offer(device_id, item)
+            else:
+                client.enqueue(frames.for_client(client))
+        for client in list(self.subscribers.get(device_id, ())):
+            if client.min_interval:
+                client.offer(device_id, item)
+            else:
+                client.enqueue(frames.for_client(client))
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    async def broadcast_batch(self, readings: List[dict]):
+        """
+        Fan out a multi-device batch of readings.
+
+        Streaming catch-all clients get the whole batch as one frame; device
+        subscribers get one frame per watched device. Rate-limited clients
+        only keep the newest reading per device. Each reading is encoded at
+        most once per format and frames are joined from those encodings.
+        """
+        if not self.active_connections:
+            for reading in readings:
+                self.remember(reading)
+            return
+        start = time.perf_counter()
+        items = [self._outgoing(reading) for reading in readings]
+        by_device: Dict[str, List[Outgoing]] = {}
+        for item in items:
+            by_device.setdefault(item.device_id, []).append(item)
+
+        combined = Frames(items)
+        for client in list(self.all_devices):
+            if client.min_interval:
+                for device_id, group in by_device.items():
+                    client.offer(device_id, group[-1])
+            else:
+                client.enqueue(combined.for_client(client))
+
+        for device_id, group in by_device.items():
+            watchers = self.subscribers.get(device_id)
+            if not watchers:
+                continue
+            group_frames = Frames(group)
+            for client in list(watchers):
+                if client.min_interval:
+                    client.offer(device_id, group[-1])
+                else:
+                    client.enqueue(group_frames.for_client(client))
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    def queue_depths(self) -> List[int]:
+        """Messages currently waiting in each client's queue."""
+        return [len(client.queue) for client in self.active_connections.values()]
@@ -0,0 +1,189 @@
+"""
+Bulk export formats for SmartSense history (GET /export).
+
+Readings are encoded a batch of rows at a time and streamed, so an export
+of weeks of history needs no more memory than one batch:
+
+- csv: a header line, then timestamp,device_id,temperature,gas_level,humidity,status
+- ndjson: one reading object per line, shaped like /history's readings
+- columnar: compact binary, Parquet-style: each batch is a row group with
+  every column stored contiguously, ~37 bytes per reading
+
+Columnar layout (all numbers little-endian):
+
+    magic "SSCOL1\\n"
+    row group: rows u32 | new devices u32 | (length u8 | device_id UTF-8) * new devices
+               timestamp f64 * rows  (epoch seconds)
+               temperature f64 * rows
+               gas_level i64 * rows
+               humidity f64 * rows
+               status u8 * rows      (0 SAFE, 1 WARNING, 2 DANGER)
+               device u32 * rows     (index into the device dictionary)
+    end: a row group with 0 rows and 0 new devices
+
+Device IDs are dictionary-encoded: a row group lists only the devices not
+seen in earlier groups, and a device's index is its position in the
+dictionary built up so far. decode_columnar() reads the format back.
+"""
+
+import csv
+import io
+import json
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from history import STATUS_CODES
+
+# Readings per streamed chunk (and per columnar row group)
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "5000"))
+
+COLUMNS = ("timestamp", "device_id", "temperature", "gas_level", "humidity", "status")
+
+COLUMNAR_MAGIC = b"SSCOL1\n"
+GROUP_HEAD = struct.Struct("<II")
+DEVICE_LENGTH = struct.Struct("<B")
+
+# (type code, bytes per value) of each columnar column, in file order
+COLUMN_TYPES = (("d", 8), ("d", 8), ("q", 8), ("d", 8), ("B", 1), ("I", 4))
+
+# (timestamp, temperature, gas_level, humidity, status code, device ID)
+Row = Tuple[float, float, int, float, int, str]
+
+
+def batched(rows: Iterable[Row], size: int = EXPORT_BATCH_ROWS) -> Iterator[List[Row]]:
+    """Group rows into lists of at most `size`."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def pack_column(typecode: str, values: Iterable) -> bytes:
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+class CsvEncoder:
+    media_type = "text/csv"
+    extension = "csv"
+
+    def header(self) -> bytes:
+        return (",".join(COLUMNS) + "\r\n").encode()
+
+    def encode(self, rows: List[Row]) -> bytes:
+        buffer = io.StringIO()
+        fromtimestamp = datetime.fromtimestamp
+        csv.writer(buffer).writerows(
+            (fromtimestamp(timestamp, timezone.utc).isoformat(), device, temperature, gas_level,
+             humidity, STATUS_CODES[status])
+            for timestamp, temperature, gas_level, humidity, status, device in rows
+        )
+        return buffer.getvalue().encode()
+
+    def footer(self) -> bytes:
+        return b""
+
+
+class NdjsonEncoder:
+    media_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def header(self) -> bytes:
+        return b""
+
+    def encode(self, rows: List[Row]) -> bytes:
+        dumps = json.dumps
+        fromtimestamp = datetime.fromtimestamp
+        return "".join(
+            dumps({
+                "device_id": device,
+                "temperature": temperature,
+                "gas_level": gas_level,
+                "humidity": humidity,
+                "status": STATUS_CODES[status],
+                "timestamp": fromtimestamp(timestamp, timezone.utc).isoformat()
+            }) + "\n"
+            for timestamp, temperature, gas_level, humidity, status, device in rows
+        ).encode()
+
+    def footer(self) -> bytes:
+        return b""
+
+
+class ColumnarEncoder:
+    media_type = "application/octet-stream"
+    extension = "sscol"
+
+    def __init__(self):
+        self.devices: Dict[str, int] = {}
+
+    def header(self) -> bytes:
+        return COLUMNAR_MAGIC
+
+    def encode(self, rows: List[Row]) -> bytes:
+        timestamps, temperatures, gas_levels, humidities, statuses, devices = zip(*rows)
+        known = self.devices
+        new = []
+        indexes = []
+        for device in devices:
+            index = known.get(device)
+            if index is None:
+                index = known[device] = len(known)
+                new.append(device.encode("utf-8"))
+            indexes.append(index)
+        parts = [GROUP_HEAD.pack(len(rows), len(new))]
+        for name in new:
+            parts.append(DEVICE_LENGTH.pack(len(name)) + name)
+        columns = (timestamps, temperatures, gas_levels, humidities, statuses, indexes)
+        for (typecode, _), values in zip(COLUMN_TYPES, columns):
+            parts.append(pack_column(typecode, values))
+        return b"".join(parts)
+
+    def footer(self) -> bytes:
+        return GROUP_HEAD.pack(0, 0)
+
+
+ENCODERS = {
+    "csv": CsvEncoder,
+    "ndjson": NdjsonEncoder,
+    "columnar": ColumnarEncoder,
+}
+
+FORMATS = tuple(ENCODERS)
+
+
+def decode_columnar(data: bytes) -> Iterator[Row]:
+    """Rows of a columnar export, in order."""
+    if not data.startswith(COLUMNAR_MAGIC):
+        raise ValueError("Not a SmartSense columnar export")
+    pos = len(COLUMNAR_MAGIC)
+    dictionary: List[str] = []
+    while True:
+        rows, new = GROUP_HEAD.unpack_from(data, pos)
+        pos += GROUP_HEAD.size
+        if rows == 0:
+            return
+        for _ in range(new):
+            length = data[pos]
+            dictionary.append(data[pos + 1:pos + 1 + length].decode("utf-8"))
+            pos += 1 + length
+        columns = []
+        for typecode, size in COLUMN_TYPES:
+            column = array(typecode, data[pos:pos + rows * size])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            pos += rows * size
+        timestamps, temperatures, gas_levels, humidities, statuses, devices = columns
+        for index in range(rows):
+            yield (timestamps[index], temperatures[index], gas_levels[index],
+                   humidities[index], statuses[index], dictionary[devices[index]])
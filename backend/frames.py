@@ -0,0 +1,171 @@
+"""
+Compact WebSocket frame formats for SmartSense dashboards.
+
+Clients choose a format when connecting to /ws:
+
+- json (default): one reading object, or an array of them, as text
+- binary: packed records, ~40 bytes per reading instead of ~130
+- delta: binary records holding only the fields that changed since the
+  previous reading of the same device (the first one per device is full)
+
+and may add ?compress=deflate to get each frame raw-deflated as a binary
+message (inflate with DecompressionStream("deflate-raw") in browsers).
+
+Every frame is encoded once per format and shared by all clients using
+that format, unlike transport-level permessage-deflate which compresses
+each frame again for every connection.
+
+Binary frame: FRAME_BINARY, then records back to back. Record:
+
+    flags u8 | device_id length u8 | device_id (ASCII)
+    full record:  seq u64 | timestamp f64 (epoch seconds)
+    delta record: seq - previous seq u32 | timestamp - previous, in ms, i32
+    temperature f32 | gas_level i32 | humidity f32 | status u8
+
+The DELTA flag marks a record relative to the device's previous one; only
+the value fields whose flag bit is set are present, in that order. All
+numbers are little-endian; temperature and humidity are float32.
+
+Reading timestamps are UTC in every format: ISO 8601 with a +00:00 offset
+in JSON frames and in decoded binary records, epoch seconds on the wire.
+"""
+
+import struct
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from history import STATUS_CODES, STATUS_INDEX
+
+FORMATS = ("json", "binary", "delta")
+COMPRESSIONS = ("deflate",)
+
+# First byte of an (uncompressed) binary frame; JSON frames start with "{" or "["
+FRAME_BINARY = b"\x01"
+
+RECORD_HEAD = struct.Struct("<BB")
+FULL_HEAD = struct.Struct("<Qd")
+DELTA_HEAD = struct.Struct("<Ii")
+
+TEMPERATURE = 0x01
+GAS_LEVEL = 0x02
+HUMIDITY = 0x04
+STATUS = 0x08
+DELTA = 0x80
+
+# (flag, reading key, packed format) in wire order
+FIELDS = (
+    (TEMPERATURE, "temperature", struct.Struct("<f")),
+    (GAS_LEVEL, "gas_level", struct.Struct("<i")),
+    (HUMIDITY, "humidity", struct.Struct("<f")),
+    (STATUS, "status", struct.Struct("<B")),
+)
+
+FLOAT32_FIELDS = ("temperature", "humidity")
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+UINT32_MAX = 2 ** 32 - 1
+
+# A device's previous reading with its seq and timestamp: the base of a delta
+Base = Tuple[dict, int, float]
+
+DEFLATE_LEVEL = 6
+
+
+def epoch_seconds(timestamp: str) -> float:
+    """A reading's ISO timestamp as epoch seconds."""
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def encode_record(reading: dict, seq: int, when: float, base: Optional[Base] = None) -> bytes:
+    """
+    Pack one reading. With a base (the device's previous reading), only the
+    fields that differ from it are included.
+    """
+    previous = None
+    if base is not None:
+        seq_gap = seq - base[1]
+        # Whole milliseconds on both sides, so decoders never accumulate rounding
+        ms_gap = round(when * 1000) - round(base[2] * 1000)
+        if 0 <= seq_gap <= UINT32_MAX and INT32_MIN <= ms_gap <= INT32_MAX:
+            previous = base[0]
+    values = {
+        "temperature": reading["temperature"],
+        # Clamped: gas levels outside int32 are not physical readings
+        "gas_level": min(max(reading["gas_level"], INT32_MIN), INT32_MAX),
+        "humidity": reading["humidity"],
+        "status": STATUS_INDEX[reading["status"]],
+    }
+    if previous is None:
+        flags = 0
+        parts = [FULL_HEAD.pack(seq, when)]
+    else:
+        flags = DELTA
+        parts = [DELTA_HEAD.pack(seq_gap, ms_gap)]
+    for flag, key, packer in FIELDS:
+        if previous is None or previous[key] != reading[key]:
+            flags |= flag
+            parts.append(packer.pack(values[key]))
+    device = reading["device_id"].encode()
+    return RECORD_HEAD.pack(flags, len(device)) + device + b"".join(parts)
+
+
+def binary_frame(records: Iterable[bytes]) -> bytes:
+    return FRAME_BINARY + b"".join(records)
+
+
+def deflate(payload: bytes) -> bytes:
+    """Raw deflate (no zlib header), as DecompressionStream("deflate-raw") expects."""
+    compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def inflate(payload: bytes) -> bytes:
+    return zlib.decompress(payload, -15)
+
+
+def decode_binary_frame(data: bytes, state: Optional[Dict[str, dict]] = None) -> List[dict]:
+    """
+    Unpack a binary frame into readings (for Python clients and benchmarks).
+
+    `state` holds each device's last reading and is needed for delta frames;
+    pass the same dict for every frame of a connection.
+    """
+    if data[:1] != FRAME_BINARY:
+        raise ValueError("Not a binary frame")
+    state = {} if state is None else state
+    readings = []
+    offset = 1
+    while offset < len(data):
+        flags, length = RECORD_HEAD.unpack_from(data, offset)
+        offset += RECORD_HEAD.size
+        device_id = data[offset:offset + length].decode()
+        offset += length
+        if flags & DELTA:
+            if device_id not in state:
+                raise ValueError(f"Delta record for '{device_id}' without a previous reading")
+            seq_gap, ms_gap = DELTA_HEAD.unpack_from(data, offset)
+            offset += DELTA_HEAD.size
+            reading = dict(state[device_id])
+            seq = reading["seq"] + seq_gap
+            ms = reading["_ms"] + ms_gap
+        else:
+            seq, when = FULL_HEAD.unpack_from(data, offset)
+            offset += FULL_HEAD.size
+            reading = {}
+            ms = round(when * 1000)
+        for flag, key, packer in FIELDS:
+            if flags & flag:
+                (value,) = packer.unpack_from(data, offset)
+                offset += packer.size
+                if key == "status":
+                    value = STATUS_CODES[value]
+                elif key in FLOAT32_FIELDS:
+                    # Shortest decimal that survives float32 (40.1, not 40.099998...)
+                    value = float(f"{value:.7g}")
+                reading[key] = value
+        reading.update(device_id=device_id, seq=seq,
+                       timestamp=datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat())
+        state[device_id] = dict(reading, _ms=ms)
+        readings.append(reading)
+    return readings
@@ -0,0 +1,235 @@
+"""
+In-memory sensor history for SmartSense.
+
+Readings are kept in a fixed-capacity ring buffer made of contiguous typed
+arrays (one per column), so memory is allocated once up front and never grows.
+Rows are kept in time order (a late reading is slotted in behind the newer
+ones, if at most HISTORY_LATE_ROWS of them), which lets range queries
+binary-search on time.
+Device IDs are interned to small integer codes so they fit a typed column too.
+"""
+
+import os
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+# Number of readings kept before the oldest ones are overwritten
+HISTORY_CAPACITY = int(os.getenv("HISTORY_CAPACITY", "100000"))
+
+# Most newer rows a late reading is slotted in behind; one that would land
+# further back is left to storage (bounds the rows shifted per insert)
+HISTORY_LATE_ROWS = int(os.getenv("HISTORY_LATE_ROWS", "1000"))
+
+STATUS_CODES = ("SAFE", "WARNING", "DANGER")
+STATUS_INDEX = {status: code for code, status in enumerate(STATUS_CODES)}
+
+DEFAULT_DEVICE = "default"
+
+
+class TimeSeriesRing:
+    """Fixed-capacity columnar ring buffer of sensor readings."""
+
+    def __init__(self, capacity: int = HISTORY_CAPACITY, late_rows: int = HISTORY_LATE_ROWS):
+        if capacity <= 0:
+            raise ValueError("History capacity must be positive")
+        self.capacity = capacity
+        self.late_rows = late_rows
+        self.late = 0  # Late readings too far back to slot in
+        # Preallocate every column so memory use is fixed from the start
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.temperature = array("d", bytes(8 * capacity))
+        self.humidity = array("d", bytes(8 * capacity))
+        self.gas_level = array("q", bytes(8 * capacity))
+        self.status = array("b", bytes(capacity))
+        self.device = array("i", bytes(4 * capacity))
+        self.device_codes: Dict[str, int] = {}
+        self.device_names: List[str] = []
+        self.start = 0  # Physical index of the oldest reading
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        """Total bytes held by the column arrays."""
+        columns = (self.timestamps, self.temperature, self.humidity,
+                   self.gas_level, self.status, self.device)
+        return sum(column.itemsize * len(column) for column in columns)
+
+    def device_code(self, device_id: str) -> int:
+        """Intern a device ID as a small integer code."""
+        code = self.device_codes.get(device_id)
+        if code is None:
+            code = len(self.device_names)
+            self.device_codes[device_id] = code
+            self.device_names.append(device_id)
+        return code
+
+    def append(self, timestamp: float, temperature: float, gas_level: int,
+               humidity: float, status: str, device_id: str = DEFAULT_DEVICE):
+        """Add a reading, overwriting the oldest one when full."""
+        if self.size and timestamp < self.timestamps[(self.start + self.size - 1) % self.capacity]:
+            self._insert(timestamp, temperature, gas_level, humidity, status, device_id)
+            return
+
+        full = self.size == self.capacity
+        index = self.start if full else (self.start + self.size) % self.capacity
+
+        # Write the row before making it visible: a value a column cannot hold
+        # raises here (gas_level first, the only int64 one) with nothing committed
+        status_code = STATUS_INDEX[status]
+        self.gas_level[index] = gas_level
+        self.timestamps[index] = timestamp
+        self.temperature[index] = temperature
+        self.humidity[index] = humidity
+        self.status[index] = status_code
+        self.device[index] = self.device_code(device_id)
+
+        if full:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+
+    def _insert(self, timestamp: float, temperature: float, gas_level: int,
+                humidity: float, status: str, device_id: str):
+        """
+        Slot a reading older than the newest one into time order, shifting the
+        newer rows up a place (whole slices at a time, so cheap when few are newer).
+        """
+        position = self.bisect_right(timestamp)
+        if self.size - position > self.late_rows or (position == 0 and self.size == self.capacity):
+            self.late += 1  # Too far back (or older than everything a full ring holds)
+            return
+        # Build the row first so a value a column cannot hold raises with nothing moved
+        row = (
+            array("d", (timestamp,)),
+            array("d", (temperature,)),
+            array("d", (humidity,)),
+            array("q", (gas_level,)),
+            array("b", (STATUS_INDEX[status],)),
+            array("i", (self.device_code(device_id),))
+        )
+        if self.size == self.capacity:
+            # Drop the oldest reading to make room
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+            position -= 1
+        columns = (self.timestamps, self.temperature, self.humidity,
+                   self.gas_level, self.status, self.device)
+        sources = self._segments(position, self.size)
+        targets = self._segments(position, self.size + 1)
+        for column, value in zip(columns, row):
+            # The new row followed by the rows it goes in front of
+            shifted = value
+            for lo, hi in sources:
+                shifted.extend(column[lo:hi])
+            offset = 0
+            for lo, hi in targets:
+                column[lo:hi] = shifted[offset:offset + hi - lo]
+                offset += hi - lo
+        self.size += 1
+
+    def oldest_timestamp(self) -> Optional[float]:
+        """Time of the oldest reading still held, or None when empty."""
+        return self.timestamps[self.start] if self.size else None
+
+    def _time_at(self, position: int) -> float:
+        """Timestamp at a logical position (0 = oldest)."""
+        return self.timestamps[(self.start + position) % self.capacity]
+
+    def bisect_left(self, timestamp: float) -> int:
+        """First logical position with time >= timestamp."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, timestamp: float) -> int:
+        """First logical position with time > timestamp."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start: Optional[float] = None, end: Optional[float] = None,
+              limit: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Logical [first, last) positions of readings with start <= time <= end.
+
+        When limit is set, only the most recent `limit` readings are kept.
+        """
+        first = 0 if start is None else self.bisect_left(start)
+        last = self.size if end is None else self.bisect_right(end)
+        if last < first:
+            last = first
+        if limit is not None and last - first > limit:
+            first = last - limit
+        return first, last
+
+    def _segments(self, first: int, last: int) -> List[Tuple[int, int]]:
+        """Physical [begin, end) slices covering logical positions [first, last)."""
+        if first >= last:
+            return []
+        begin = (self.start + first) % self.capacity
+        end = begin + (last - first)
+        if end <= self.capacity:
+            return [(begin, end)]
+        return [(begin, self.capacity), (0, end - self.capacity)]
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              limit: Optional[int] = None, device_id: Optional[str] = None) -> List[Dict]:
+        """
+        Readings in a time range, oldest first, as broadcast-style dicts.
+
+        With device_id set, only that device's readings are returned (the most
+        recent `limit` of them).
+        """
+        if device_id is not None:
+            code = self.device_codes.get(device_id)
+            if code is None:
+                return []
+            first, last = self.range(start, end)
+        else:
+            code = None
+            first, last = self.range(start, end, limit)
+
+        rows = deque(maxlen=limit) if code is not None and limit else []
+        # Slice whole contiguous runs of each column instead of indexing per row
+        for lo, hi in self._segments(first, last):
+            columns = zip(
+                self.timestamps[lo:hi],
+                self.temperature[lo:hi],
+                self.gas_level[lo:hi],
+                self.humidity[lo:hi],
+                self.status[lo:hi],
+                self.device[lo:hi]
+            )
+            if code is None:
+                rows.extend(columns)
+            else:
+                rows.extend(row for row in columns if row[5] == code)
+
+        fromtimestamp = datetime.fromtimestamp
+        names = self.device_names
+        return [
+            {
+                "device_id": names[device],
+                "temperature": temperature,
+                "gas_level": gas_level,
+                "humidity": humidity,
+                "status": STATUS_CODES[status],
+                "timestamp": fromtimestamp(timestamp, timezone.utc).isoformat()
+            }
+            for timestamp, temperature, gas_level, humidity, status, device in rows
+        ]
@@ -0,0 +1,374 @@
+"""
+Load Generator for SmartSense Safety Monitoring System
+Simulates many devices posting to /data while dashboards listen on /ws, and
+measures ingest throughput plus end-to-end latency (POST -> WebSocket receipt).
+
+Usage:
+    python load_test.py --spawn                      # start a local server and test it
+    python load_test.py --devices 2000 --rate 2      # against a running server
+    python load_test.py --url http://127.0.0.1:8000 --subscribers 50 --duration 60
+    python load_test.py --spawn --workers 4          # multi-worker, over the worker bus
+
+Every device posts on its own schedule over a shared pool of keep-alive
+connections. Latency is measured from each reading's scheduled send time, so
+a server that falls behind shows up as latency instead of a lower send rate.
+Results are saved to load_results/ and compared with the previous run.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import websockets
+
+RESULTS_DIR = "load_results"
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of samples (None when empty)."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def make_reading(rng: random.Random, device_id: str) -> bytes:
+    """A plausible reading with occasional WARNING / DANGER spikes."""
+    spike = rng.random()
+    if spike > 0.95:
+        temperature, gas_level = 46 + rng.random() * 10, 1010 + rng.random() * 100
+    elif spike > 0.85:
+        temperature, gas_level = 36 + rng.random() * 8, 310 + rng.random() * 150
+    else:
+        temperature, gas_level = 28 + rng.random() * 6, 150 + rng.random() * 100
+    return json.dumps({
+        "device_id": device_id,
+        "temperature": round(temperature, 1),
+        "gas_level": int(gas_level),
+        "humidity": round(40 + rng.random() * 30, 1)
+    }).encode()
+
+
+class HttpConnection:
+    """Minimal HTTP/1.1 keep-alive client for posting JSON bodies."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def post(self, path: str, body: bytes,
+                   content_type: str = "application/json") -> int:
+        """Send one POST and return the status code (reconnects once if dropped)."""
+        status, _ = await self.request(path, body, content_type)
+        return status
+
+    async def request(self, path: str, body: bytes,
+                      content_type: str = "application/json") -> Tuple[int, bytes]:
+        """Send one POST and return the status code and response body."""
+        for attempt in range(2):
+            if self.writer is None:
+                await self._connect()
+            try:
+                self.writer.write(
+                    f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                head = await self.reader.readuntil(b"\r\n\r\n")
+                status = int(head.split(b" ", 2)[1])
+                length = 0
+                for line in head.split(b"\r\n")[1:]:
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                return status, await self.reader.readexactly(length)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt:
+                    raise
+        return 0, b""
+
+
+class LoadTest:
+    """Devices posting readings and subscribers timing their arrival."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        url = urlparse(args.url)
+        self.host = url.hostname or "127.0.0.1"
+        self.port = url.port or 80
+        self.ws_url = f"ws://{self.host}:{self.port}/ws"
+        self.devices = [f"load-{i:05d}" for i in range(args.devices)]
+        # Scheduled send time of every reading, per device, in order
+        self.sent: Dict[str, List[float]] = {device: [] for device in self.devices}
+        self.measure_from = 0.0
+        self.stop_at = 0.0
+        self.finished = False
+        self.posted = 0
+        self.errors = 0
+        self.http_latencies: List[float] = []
+        self.ws_latencies: List[float] = []
+        self.ws_received = 0
+        self.ws_unmatched = 0
+
+    async def device(self, device_id: str, pool: "asyncio.Queue[HttpConnection]"):
+        """Post readings at the configured rate until the test ends."""
+        rng = random.Random(device_id)
+        interval = 1.0 / self.args.rate
+        scheduled = time.perf_counter() + rng.random() * interval
+        while scheduled < self.stop_at:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            body = make_reading(rng, device_id)
+            self.sent[device_id].append(scheduled)
+            connection = await pool.get()
+            try:
+                status = await connection.post("/data", body)
+            except (OSError, asyncio.IncompleteReadError):
+                status = 0
+            finally:
+                pool.put_nowait(connection)
+            if scheduled >= self.measure_from:
+                self.http_latencies.append(time.perf_counter() - scheduled)
+                if status == 200:
+                    self.posted += 1
+                else:
+                    self.errors += 1
+            scheduled += interval
+
+    async def subscriber(self, ready: asyncio.Event, connected: List[int]):
+        """Receive broadcasts and match each one to its send time."""
+        # The n-th reading seen for a device is that device's n-th post
+        seen: Dict[str, int] = {}
+        async with websockets.connect(self.ws_url, max_size=None) as ws:
+            connected[0] += 1
+            if connected[0] == self.args.subscribers:
+                ready.set()
+            while True:
+                try:
+                    message = await asyncio.wait_for(ws.recv(), timeout=0.2)
+                except asyncio.TimeoutError:
+                    if self.finished:
+                        return
+                    continue
+                now = time.perf_counter()
+                payload = json.loads(message)
+                readings = payload if isinstance(payload, list) else [payload]
+                for reading in readings:
+                    if "type" in reading:
+                        continue  # Control acks, not readings
+                    device_id = reading.get("device_id")
+                    sent = self.sent.get(device_id)
+                    if sent is None:
+                        continue  # Another client's device
+                    index = seen.get(device_id, 0)
+                    seen[device_id] = index + 1
+                    if index >= len(sent):
+                        self.ws_unmatched += 1
+                        continue
+                    if sent[index] >= self.measure_from:
+                        self.ws_received += 1
+                        self.ws_latencies.append(now - sent[index])
+
+    async def run(self) -> Dict:
+        args = self.args
+        ready = asyncio.Event()
+        connected = [0]
+        subscribers = [asyncio.create_task(self.subscriber(ready, connected))
+                       for _ in range(args.subscribers)]
+        if subscribers:
+            await asyncio.wait_for(ready.wait(), timeout=30)
+
+        pool: "asyncio.Queue[HttpConnection]" = asyncio.Queue()
+        for _ in range(args.connections):
+            pool.put_nowait(HttpConnection(self.host, self.port))
+
+        start = time.perf_counter()
+        self.measure_from = start + args.warmup
+        self.stop_at = self.measure_from + args.duration
+        await asyncio.gather(*(self.device(device_id, pool) for device_id in self.devices))
+        sending_done = time.perf_counter()
+        # Give in-flight broadcasts a moment to arrive
+        await asyncio.sleep(args.drain)
+        self.finished = True
+        await asyncio.gather(*subscribers, return_exceptions=True)
+        while not pool.empty():
+            pool.get_nowait().close()
+
+        measured = min(sending_done, self.stop_at) - self.measure_from
+        expected = sum(
+            1 for device in self.devices for t in self.sent[device] if t >= self.measure_from
+        ) * args.subscribers
+        return {
+            "throughput": self.posted / measured if measured > 0 else 0.0,
+            "posted": self.posted,
+            "errors": self.errors,
+            "http_ms": self.summarize(self.http_latencies),
+            "ws_ms": self.summarize(self.ws_latencies),
+            "ws_received": self.ws_received,
+            "ws_expected": expected,
+            "ws_unmatched": self.ws_unmatched,
+        }
+
+    @staticmethod
+    def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+        summary = {}
+        for pct in (50, 95, 99):
+            value = percentile(samples, pct)
+            summary[f"p{pct}"] = None if value is None else round(value * 1000, 3)
+        summary["max"] = round(max(samples) * 1000, 3) if samples else None
+        return summary
+
+
+def spawn_server(port: int, workers: int = 1,
+                 env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    """Start a local uvicorn instance (no storage, quiet logs) for the test."""
+    env = dict(os.environ, STORAGE_BACKEND="none", LOG_LEVEL="WARNING", CAPTURE="false",
+               **(env or {}))
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning"]
+    if workers > 1:
+        # A private bus and auth database so a running server is not disturbed
+        scratch = tempfile.mkdtemp(prefix="smartsense-load-")
+        env["BUS_URL"] = (f"tcp://127.0.0.1:{port + 1}" if sys.platform == "win32"
+                          else f"unix://{os.path.join(scratch, 'bus.sock')}")
+        env["SESSION_BACKEND"] = "sqlite"
+        env["SESSION_DB"] = os.path.join(scratch, "auth.db")
+        command += ["--workers", str(workers)]
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("uvicorn exited during startup")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("uvicorn did not start within 30 seconds")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results: Dict, directory: str = RESULTS_DIR) -> Optional[Dict]:
+    """Write this run to the results directory and return the previous run."""
+    os.makedirs(directory, exist_ok=True)
+    runs = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    previous = None
+    if runs:
+        with open(os.path.join(directory, runs[-1])) as f:
+            previous = json.load(f)
+    path = os.path.join(directory, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results saved to {path}")
+    return previous
+
+
+def format_ms(summary: Dict) -> str:
+    return "  ".join(
+        f"{key} {'-' if value is None else f'{value:.1f}'}" for key, value in summary.items()
+    )
+
+
+def print_report(results: Dict, previous: Optional[Dict]):
+    r = results["results"]
+    print("-" * 70)
+    print(f"Ingest:      {r['throughput']:,.0f} readings/s "
+          f"({r['posted']:,} ok, {r['errors']:,} errors)")
+    print(f"POST (ms):   {format_ms(r['http_ms'])}")
+    print(f"POST->WS ms: {format_ms(r['ws_ms'])}")
+    print(f"WS received: {r['ws_received']:,} of {r['ws_expected']:,} expected")
+
+    if previous:
+        p = previous["results"]
+        print("-" * 70)
+        print(f"Compared with {previous.get('started')} ({previous.get('revision') or 'unknown'}):")
+        print(f"  throughput {p['throughput']:,.0f} -> {r['throughput']:,.0f} readings/s")
+        for key in ("http_ms", "ws_ms"):
+            old, new = p[key].get("p99"), r[key].get("p99")
+            if old is not None and new is not None:
+                print(f"  {key[:-3]} p99 {old:.1f} -> {new:.1f} ms")
+    print("=" * 70)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="SmartSense load generator")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Backend base URL")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Start a local uvicorn instance on the URL's port")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for --spawn (shared over the worker bus)")
+    parser.add_argument("--devices", type=int, default=1000, help="Simulated devices")
+    parser.add_argument("--rate", type=float, default=1.0, help="Readings/s per device")
+    parser.add_argument("--connections", type=int, default=50,
+                        help="Keep-alive HTTP connections shared by the devices")
+    parser.add_argument("--subscribers", type=int, default=10, help="/ws clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds first")
+    parser.add_argument("--drain", type=float, default=1.0,
+                        help="Seconds to wait for broadcasts after sending stops")
+    parser.add_argument("--output", default=RESULTS_DIR, help="Results directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("=" * 70)
+    print("🏭 SmartSense Load Test")
+    print("=" * 70)
+    print(f"{args.devices} devices x {args.rate} Hz over {args.connections} connections, "
+          f"{args.subscribers} WebSocket subscribers, {args.duration:.0f}s")
+
+    server = spawn_server(urlparse(args.url).port or 80, args.workers) if args.spawn else None
+    try:
+        started = datetime.now().isoformat(timespec="seconds")
+        results = asyncio.run(LoadTest(args).run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    record = {
+        "started": started,
+        "revision": git_revision(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    previous = save_results(record, args.output)
+    print_report(record, previous)
+
+
+if __name__ == "__main__":
+    main()
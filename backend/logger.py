@@ -0,0 +1,124 @@
+"""
+Non-blocking logging for SmartSense.
+
+Log calls on the event loop only put the raw record on a bounded queue; a
+background thread formats and writes it, so slow stdout (e.g. a pipe into
+Docker logs) never stalls ingestion. Output is plain text or JSON lines.
+Per-reading logs can be sampled to keep volume down at high ingest rates.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# "text" or "json"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+# Fraction of per-reading logs to emit (1 = all, 0.01 = 1 in 100, 0 = none)
+LOG_READING_SAMPLE = float(os.getenv("LOG_READING_SAMPLE", "1"))
+
+# Records buffered for the writer thread before new ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+log = logging.getLogger("smartsense")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `fields` passed via `extra` are included."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records untouched so all formatting happens on the writer thread."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ReadingSampler:
+    """Deterministic sampler: emits `rate` of calls, evenly spaced."""
+
+    def __init__(self, rate: float = LOG_READING_SAMPLE):
+        self.rate = rate
+        self._credit = 0.0
+
+    def __call__(self) -> bool:
+        if self.rate >= 1:
+            return True
+        if self.rate <= 0:
+            return False
+        self._credit += self.rate
+        if self._credit >= 1:
+            self._credit -= 1
+            return True
+        return False
+
+
+sample_reading = ReadingSampler()
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT,
+                  stream: Optional[TextIO] = None) -> DeferredQueueHandler:
+    """Route the smartsense logger through a queue to a writer thread."""
+    global _listener
+    stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DeferredQueueHandler(log_queue)
+    log.handlers = [handler]
+    log.setLevel(level)
+    log.propagate = False
+
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -3,17 +3,89 @@ SmartSense Industrial Safety Monitoring System - Backend
 Run with: uvicorn main:app --reload
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+import asyncio
 import json
-from datetime import datetime, timedelta
+import math
+import os
+from datetime import datetime, timezone
 import hashlib
 import secrets
+import time
 from functools import lru_cache
+from itertools import islice
+from contextlib import asynccontextmanager
 
-app = FastAPI(title="SmartSense Safety Monitor API")
+from alerts import ALERT_MAX_AGE, AlertDispatcher, AlertTracker, create_sinks
+from bus import DEFAULT_BUS_URL, create_bus
+from capture import open_capture
+from compressed_history import CompressedHistory
+from connections import WS_SNAPSHOT_SIZE, ConnectionManager
+from export import ENCODERS, EXPORT_BATCH_ROWS, FORMATS as EXPORT_FORMATS, Row, batched
+from frames import COMPRESSIONS, FORMATS
+from logger import log, sample_reading, setup_logging
+from metrics import CONTENT_TYPE, REGISTRY
+from history import DEFAULT_DEVICE, STATUS_INDEX, TimeSeriesRing
+from rollups import (CHART_OVERSAMPLE, CHART_RAW_LIMIT, METRICS, RollupStore, chart_columns,
+                     lttb, metric_average, reading_bucket, regroup)
+from rules import RULES_FILE, RULES_RELOAD_INTERVAL, load_rules
+from sessions import SESSION_SWEEP_INTERVAL, SESSION_TTL, create_session_store, run_store
+from stats import StatsTracker
+from storage import NullStorage, create_storage, decode_device_id, encode_device_id, record_to_reading
+from users import create_user_store
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background services and restore recent history from disk."""
+    storage.start()
+    records = await run_in_threadpool(storage.query, None, None, history.capacity)
+    for index, record in enumerate(records):
+        reading = record_to_reading(record)
+        if index >= len(records) - WS_SNAPSHOT_SIZE:
+            manager.remember(reading)  # So the first dashboards get a snapshot
+        history.append(record[0], reading["temperature"], reading["gas_level"],
+                       reading["humidity"], reading["status"], reading["device_id"])
+        compressed.append(record[0], reading["temperature"], reading["gas_level"],
+                          reading["humidity"], reading["status"], reading["device_id"])
+        stats.add(reading["device_id"], record[0], reading["temperature"],
+                  reading["gas_level"], reading["humidity"], reading["status"])
+        rollups.add(record[0], reading["temperature"], reading["gas_level"],
+                    reading["humidity"], reading["status"], reading["device_id"])
+        LATEST_READINGS[reading["device_id"]] = reading
+        LATEST_TIMES[reading["device_id"]] = record[0]
+        # Known device states, so a restart doesn't re-raise alerts already sent
+        alert_tracker.observe(reading, record[0])
+    if len(history):
+        log.info("💾 Restored %d readings from storage", len(history))
+    background = [
+        asyncio.create_task(watch_rules()),
+        asyncio.create_task(sweep_sessions()),
+    ]
+    await bus.start(apply_remote_readings)
+    await alerts.start()
+    if capture is not None:
+        log.info("🎙️  Capturing ingest payloads to %s", capture.path)
+    yield
+    await alerts.stop()
+    await bus.stop()
+    for task in background:
+        task.cancel()
+    # Flush pending readings to disk before exiting
+    await run_in_threadpool(storage.stop)
+    if capture is not None:
+        await run_in_threadpool(capture.stop)
+
+
+app = FastAPI(title="SmartSense Safety Monitor API", lifespan=lifespan)
+
+setup_logging()
 
 # Enable CORS for React frontend
 app.add_middleware(
@@ -25,38 +97,37 @@ app.add_middleware(
 )
 
 
-class ConnectionManager:
-    """Manages WebSocket connections for real-time data broadcasting."""
-    
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        print(f"Client connected. Total connections: {len(self.active_connections)}")
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        print(f"Client disconnected. Total connections: {len(self.active_connections)}")
-
-    async def broadcast(self, message: str):
-        """Send message to all connected clients."""
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error sending to client: {e}")
-
-
 manager = ConnectionManager()
+history = TimeSeriesRing()
+# Months of readings, compressed; serves /history ranges older than the ring
+compressed = CompressedHistory()
+storage = create_storage()
+stats = StatsTracker()
+# Min/max/avg buckets at 10 s to 1 h resolution, so /chart never reads raw history
+rollups = RollupStore()
+rule_engine = load_rules(RULES_FILE)
+# Shares readings with other worker processes (no-op with a single worker)
+bus = create_bus()
+# Status transitions per device, escalated to webhook/email/SCADA sinks off the ingest path
+alert_tracker = AlertTracker()
+alerts = AlertDispatcher(create_sinks())
+# Raw /data, /data/batch and /ingest payloads for replay.py (CAPTURE=true)
+capture = open_capture("backend")
 
 
 class SensorData(BaseModel):
     """Pydantic model for incoming sensor data from ESP32."""
-    temperature: float
-    gas_level: int
-    humidity: float
+    # NaN/inf would poison running sums in stats and rollups, so they are rejected
+    temperature: float = Field(allow_inf_nan=False)
+    # Bounded so it fits every integer column (int32 in binary /ws frames)
+    gas_level: int = Field(ge=-2 ** 31, le=2 ** 31 - 1)
+    humidity: float = Field(allow_inf_nan=False)
+    device_id: str = Field(
+        DEFAULT_DEVICE, min_length=1, max_length=32, pattern=r"^[A-Za-z0-9_.:-]+$"
+    )
+    # Epoch seconds when the reading was taken (e.g. by a gateway that spooled
+    # it through an outage); defaults to when it is received
+    timestamp: Optional[float] = Field(None, allow_inf_nan=False)
 
 
 class LoginRequest(BaseModel):
@@ -87,8 +158,8 @@ class SignupResponse(BaseModel):
     user: Optional[dict] = None
 
 
-# In-memory user database (demo only - use real DB in production)
-USERS = {
+# Demo accounts (use a real user database in production)
+DEMO_USERS = {
     "admin": {
         "email": "admin@smartsense.io",
         "password_hash": hashlib.sha256("admin123".encode()).hexdigest(),
@@ -103,30 +174,365 @@ USERS = {
     }
 }
 
-# Track emails to prevent duplicates
-EMAIL_TO_USERNAME = {
-    "admin@smartsense.io": "admin",
-    "user@smartsense.io": "user"
-}
+# User accounts; shared between workers when SESSION_BACKEND=sqlite
+USERS = create_user_store(DEMO_USERS)
+
+# Login sessions keyed by token, with TTL expiry and a per-user index
+TOKENS = create_session_store()
+
+# Latest reading per device, keyed by device_id, and when it was taken
+LATEST_READINGS: Dict[str, dict] = {}
+LATEST_TIMES: Dict[str, float] = {}
+
+# Upper bound on readings accepted by a single /data/batch request or /ingest frame
+MAX_BATCH_SIZE = 5000
+
+# Distinct device IDs accepted; each one costs memory in every per-device
+# store (rollups, stats, compressed history), so new IDs past this are rejected
+MAX_DEVICES = int(os.getenv("MAX_DEVICES", "20000"))
+
+# Oldest client timestamp honoured, in seconds before receipt (older ones are
+# clamped to it; timestamps in the future are clamped to the time of receipt)
+READING_MAX_AGE = float(os.getenv("READING_MAX_AGE", str(7 * 86400)))
+
+# Devices connected to the /ingest channel
+INGEST_CLIENTS: Set[WebSocket] = set()
+
+# Upper bound on readings returned by a single /history request
+MAX_HISTORY_LIMIT = 10000
+
+# Widest /chart request, in points
+MAX_CHART_WIDTH = 5000
+
+# Close code for /ws connections asking for an unknown frame format
+WS_POLICY_VIOLATION = 1008
+
+# Transport-level permessage-deflate: compresses every frame again for each
+# client; "false" saves that CPU when dashboards use ?compress=deflate instead
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+
+# Ingest instrumentation (served by GET /metrics)
+READINGS_TOTAL = REGISTRY.counter(
+    "smartsense_readings_total", "Readings accepted, by classified status", "status"
+)
+READINGS_REJECTED = REGISTRY.counter(
+    "smartsense_readings_rejected_total", "Readings that failed validation"
+)
+INGEST_SECONDS = REGISTRY.histogram(
+    "smartsense_ingest_seconds", "POST /data handling time after the body is read"
+)
+BATCH_INGEST_SECONDS = REGISTRY.histogram(
+    "smartsense_batch_ingest_seconds", "POST /data/batch handling time after the body is read"
+)
+INGEST_FRAME_SECONDS = REGISTRY.histogram(
+    "smartsense_ingest_frame_seconds", "/ingest frame handling time, excluding the ack send"
+)
+VALIDATION_SECONDS = REGISTRY.histogram(
+    "smartsense_validation_seconds", "Time to validate one reading",
+    (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001)
+)
+
+
+def device_allowed(device_id: str, new_devices: Set[str] = frozenset()) -> bool:
+    """Whether a reading's device is known, or there is room for another (MAX_DEVICES)."""
+    return (device_id in LATEST_READINGS or device_id in new_devices
+            or len(LATEST_READINGS) + len(new_devices) < MAX_DEVICES)
+
 
-# Simple in-memory token storage (use Redis/DB in production)
-TOKENS = {}
+def reading_time(data: SensorData, received_at: float) -> float:
+    """When a reading was taken: its own timestamp, clamped, or the time of receipt."""
+    if data.timestamp is None:
+        return received_at
+    return min(max(data.timestamp, received_at - READING_MAX_AGE), received_at)
 
 
-def determine_status(temperature: float, gas_level: int) -> str:
+def determine_status(data: SensorData, taken_at: float) -> str:
     """
-    Determine safety status based on sensor thresholds.
+    Determine safety status by running the reading through the alert rules.
     
-    Thresholds:
+    Rules come from rules.json (hot-reloaded). Default thresholds:
     - DANGER: Temperature > 45°C OR Gas > 1000 PPM
     - WARNING: Temperature > 35°C OR Gas > 300 PPM
     - SAFE: All readings within normal range
     """
-    if temperature > 45 or gas_level > 1000:
-        return "DANGER"
-    elif temperature > 35 or gas_level > 300:
-        return "WARNING"
-    return "SAFE"
+    status, _ = rule_engine.evaluate(
+        data.device_id, data.temperature, data.gas_level, data.humidity, taken_at
+    )
+    return status
+
+
+def build_reading(data: SensorData, timestamp: str, taken_at: float) -> dict:
+    """Classify a validated reading and build the payload sent to clients."""
+    return {
+        "device_id": data.device_id,
+        "temperature": data.temperature,
+        "gas_level": data.gas_level,
+        "humidity": data.humidity,
+        "status": determine_status(data, taken_at),
+        "timestamp": timestamp
+    }
+
+
+def reload_rules() -> bool:
+    """Recompile the rules file; keep the current rules if it is invalid."""
+    global rule_engine
+    try:
+        engine = load_rules(RULES_FILE)
+    except (OSError, ValueError) as e:
+        log.error("❌ Rules not reloaded, keeping previous rules: %s", e)
+        return False
+    # Hysteresis, rate and EWMA state of unchanged rules survives the reload
+    engine.adopt_state(rule_engine)
+    rule_engine = engine
+    log.info("📐 Loaded %d alert rules", len(rule_engine.rules))
+    return True
+
+
+async def watch_rules():
+    """Reload the rules whenever the rules file changes."""
+    last_mtime = os.path.getmtime(RULES_FILE) if os.path.exists(RULES_FILE) else None
+    while True:
+        await asyncio.sleep(RULES_RELOAD_INTERVAL)
+        mtime = os.path.getmtime(RULES_FILE) if os.path.exists(RULES_FILE) else None
+        if mtime != last_mtime:
+            last_mtime = mtime
+            reload_rules()
+
+
+def store_reading(reading: dict, timestamp: float):
+    """Record an accepted reading in the in-memory history and durable storage."""
+    device_id = reading["device_id"]
+    # A late reading (flushed from a gateway's spool) must not replace a newer one
+    if LATEST_TIMES.get(device_id, timestamp) <= timestamp:
+        LATEST_READINGS[device_id] = reading
+        LATEST_TIMES[device_id] = timestamp
+    history.append(
+        timestamp,
+        reading["temperature"],
+        reading["gas_level"],
+        reading["humidity"],
+        reading["status"],
+        reading["device_id"]
+    )
+    compressed.append(
+        timestamp,
+        reading["temperature"],
+        reading["gas_level"],
+        reading["humidity"],
+        reading["status"],
+        reading["device_id"]
+    )
+    stats.add(
+        reading["device_id"],
+        timestamp,
+        reading["temperature"],
+        reading["gas_level"],
+        reading["humidity"],
+        reading["status"]
+    )
+    rollups.add(
+        timestamp,
+        reading["temperature"],
+        reading["gas_level"],
+        reading["humidity"],
+        reading["status"],
+        reading["device_id"]
+    )
+    # Queued for the storage writer thread; never waits on disk
+    storage.append((
+        timestamp,
+        reading["temperature"],
+        reading["gas_level"],
+        reading["humidity"],
+        STATUS_INDEX[reading["status"]],
+        encode_device_id(reading["device_id"])
+    ))
+
+
+def track_alerts(readings: List[dict], times: List[float], received_at: float,
+                 local: bool = True):
+    """
+    Feed readings to the transition tracker and queue any confirmed alerts.
+
+    Every worker tracks every reading, but only the worker that received the
+    reading dispatches its alert, so each transition is sent once. Readings
+    taken more than ALERT_MAX_AGE seconds before they arrived (a gateway's
+    spool flushed after an outage) are history, not news: they are left out,
+    so the live readings that follow are compared with the state before.
+    """
+    cutoff = received_at - ALERT_MAX_AGE
+    for reading, taken_at in zip(readings, times):
+        if taken_at < cutoff:
+            continue
+        alert = alert_tracker.observe(reading, taken_at)
+        if alert is not None and local:
+            alerts.submit(alert)
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """Parse a query time given as epoch seconds or an ISO 8601 string."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid time '{value}' (use epoch seconds or ISO 8601)"
+        )
+
+
+def parse_batch_body(body: bytes, content_type: str = "") -> List[Any]:
+    """
+    Split a /data/batch body into raw reading objects.
+
+    Accepts either a JSON array of readings or NDJSON (one reading per line).
+    NDJSON is used when the content type says so or the body is not an array.
+    """
+    text = body.decode("utf-8").strip()
+    if not text:
+        return []
+    if "ndjson" in content_type or not text.startswith("["):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    items = json.loads(text)
+    if not isinstance(items, list):
+        raise ValueError("Expected a JSON array of readings")
+    return items
+
+
+def process_batch(items: List[Any], now: datetime) -> Dict[str, Any]:
+    """
+    Validate and classify a batch of raw readings in a single pass.
+
+    Invalid items are reported individually and never reject the whole batch.
+    Returns the accepted readings, when each was taken, and per-item results.
+    """
+    timestamp = now.isoformat()
+    received_at = now.timestamp()
+    readings = []
+    times = []
+    results = []
+    new_devices: Set[str] = set()  # Not stored until the whole batch is classified
+
+    for index, item in enumerate(items):
+        start = time.perf_counter()
+        try:
+            data = SensorData.model_validate(item)
+        except ValidationError as e:
+            READINGS_REJECTED.inc()
+            results.append({
+                "index": index,
+                "accepted": False,
+                "error": e.errors(include_url=False)[0]["msg"]
+            })
+            continue
+        VALIDATION_SECONDS.observe(time.perf_counter() - start)
+        if not device_allowed(data.device_id, new_devices):
+            READINGS_REJECTED.inc()
+            results.append({
+                "index": index,
+                "accepted": False,
+                "error": f"Too many devices (limit {MAX_DEVICES})"
+            })
+            continue
+        if data.device_id not in LATEST_READINGS:
+            new_devices.add(data.device_id)
+
+        taken_at = reading_time(data, received_at)
+        reading = build_reading(
+            data,
+            timestamp if taken_at == received_at else datetime.fromtimestamp(taken_at, timezone.utc).isoformat(),
+            taken_at
+        )
+        READINGS_TOTAL.inc(1, reading["status"])
+        readings.append(reading)
+        times.append(taken_at)
+        results.append({"index": index, "accepted": True, "status": reading["status"]})
+
+    return {"readings": readings, "times": times, "results": results}
+
+
+async def ingest_batch(items: List[Any]) -> Dict[str, Any]:
+    """
+    Validate, classify, store and broadcast a batch of raw readings.
+
+    Shared by POST /data/batch and the /ingest channel. A single accepted
+    reading is broadcast exactly like POST /data; larger batches go out as
+    coalesced frames.
+    """
+    now = datetime.now(timezone.utc)
+    batch = process_batch(items, now)
+    readings = batch["readings"]
+    times = batch["times"]
+
+    received_at = now.timestamp()
+    for reading, taken_at in zip(readings, times):
+        store_reading(reading, taken_at)
+    track_alerts(readings, times, received_at)
+
+    await broadcast_readings(readings)
+    if readings:
+        await publish_readings(readings, times, received_at)
+    return batch
+
+
+async def broadcast_readings(readings: List[dict]):
+    """Send readings to this worker's WebSocket clients."""
+    if len(readings) == 1:
+        await manager.broadcast_reading(readings[0])
+    elif readings:
+        # One coalesced frame for the whole batch instead of one per reading
+        await manager.broadcast_batch(readings)
+
+
+async def publish_readings(readings: List[dict], times: List[float], received_at: float):
+    """Share accepted readings with the other worker processes, if any."""
+    if bus.active:
+        await bus.publish(json.dumps(
+            {"received_at": received_at, "times": times, "readings": readings}
+        ).encode())
+
+
+async def apply_remote_readings(payload: bytes):
+    """
+    Apply readings accepted by another worker.
+
+    They are run through the rules too, so stateful rules (hysteresis,
+    duration) see every reading of a device whichever worker received it.
+    The status decided by the receiving worker is kept. Readings from new
+    devices past MAX_DEVICES are skipped, as they are on local ingest.
+    """
+    message = json.loads(payload)
+    received_at = message["received_at"]
+    readings = []
+    times = []
+    for reading, taken_at in zip(message["readings"], message["times"]):
+        if not device_allowed(reading["device_id"]):
+            continue
+        rule_engine.evaluate(reading["device_id"], reading["temperature"],
+                             reading["gas_level"], reading["humidity"], taken_at)
+        store_reading(reading, taken_at)
+        readings.append(reading)
+        times.append(taken_at)
+    if len(readings) < len(message["readings"]):
+        READINGS_REJECTED.inc(len(message["readings"]) - len(readings))
+    if not readings:
+        return
+    track_alerts(readings, times, received_at, local=False)
+    await broadcast_readings(readings)
+
+
+async def sweep_sessions():
+    """Periodically drop expired sessions so unverified logins don't pile up."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        removed = await run_store(TOKENS.sweep)
+        if removed:
+            log.info("🧹 Removed %d expired sessions (%d active)", removed, len(TOKENS))
 
 
 def generate_token() -> str:
@@ -151,14 +557,14 @@ async def login(credentials: LoginRequest):
     username = credentials.username.lower()
     
     # Check if user exists
-    if username not in USERS:
+    user = await run_store(USERS.get, username)
+    if user is None:
         return LoginResponse(
             success=False,
             message="Invalid username or password"
         )
     
     # Verify password
-    user = USERS[username]
     password_hash = hash_password(credentials.password)
     
     if user["password_hash"] != password_hash:
@@ -169,13 +575,14 @@ async def login(credentials: LoginRequest):
     
     # Generate token
     token = generate_token()
-    TOKENS[token] = {
+    now = time.time()
+    await run_store(TOKENS.create, token, {
         "username": username,
         "name": user["name"],
         "role": user["role"],
-        "created_at": datetime.now(),
-        "expires_at": datetime.now() + timedelta(hours=24)
-    }
+        "created_at": now,
+        "expires_at": now + SESSION_TTL
+    })
     
     return LoginResponse(
         success=True,
@@ -225,14 +632,14 @@ async def signup(data: SignupRequest):
         )
     
     # Check if username already exists
-    if username in USERS:
+    if await run_store(USERS.get, username) is not None:
         return SignupResponse(
             success=False,
             message="Username already exists"
         )
     
     # Check if email already exists
-    if email in EMAIL_TO_USERNAME:
+    if await run_store(USERS.email_taken, email):
         return SignupResponse(
             success=False,
             message="Email already registered"
@@ -242,14 +649,18 @@ async def signup(data: SignupRequest):
     password_hash = hash_password(password)
     user_name = username.capitalize()  # Use capitalized username as display name
     
-    USERS[username] = {
+    created = await run_store(USERS.add, username, {
         "email": email,
         "password_hash": password_hash,
         "name": user_name,
         "role": "operator"  # New users get operator role
-    }
-    
-    EMAIL_TO_USERNAME[email] = username
+    })
+    if not created:
+        # Taken by a concurrent signup (possibly on another worker)
+        return SignupResponse(
+            success=False,
+            message="Username already exists"
+        )
     
     return SignupResponse(
         success=True,
@@ -266,25 +677,28 @@ async def signup(data: SignupRequest):
 @app.post("/logout")
 async def logout(token: str):
     """Logout endpoint to invalidate token."""
-    if token in TOKENS:
-        del TOKENS[token]
+    if await run_store(TOKENS.delete, token):
         return {"success": True, "message": "Logout successful"}
     return {"success": False, "message": "Invalid token"}
 
 
+@app.post("/logout-all")
+async def logout_all(token: str):
+    """Invalidate every session of the token's user (logout everywhere)."""
+    token_data = await run_store(TOKENS.get, token)
+    if token_data is None:
+        return {"success": False, "message": "Invalid or expired token"}
+    removed = await run_store(TOKENS.delete_user, token_data["username"])
+    return {"success": True, "message": f"Logged out of {removed} session(s)"}
+
+
 @app.post("/verify-token")
 async def verify_token(token: str):
     """Verify if a token is valid."""
-    if token not in TOKENS:
+    token_data = await run_store(TOKENS.get, token)
+    if token_data is None:
         return {"valid": False, "message": "Invalid or expired token"}
     
-    token_data = TOKENS[token]
-    
-    # Check if token is expired
-    if datetime.now() > token_data["expires_at"]:
-        del TOKENS[token]
-        return {"valid": False, "message": "Token expired"}
-    
     return {
         "valid": True,
         "user": {
@@ -305,8 +719,29 @@ async def root():
     }
 
 
-@app.post("/data")
-async def receive_sensor_data(data: SensorData):
+def validate_reading(body: bytes) -> SensorData:
+    """Parse and validate a /data body, timing the validation for /metrics."""
+    start = time.perf_counter()
+    try:
+        data = SensorData.model_validate_json(body)
+    except ValidationError as e:
+        READINGS_REJECTED.inc()
+        # Same 422 shape FastAPI produces for a declared body parameter
+        errors = e.errors(include_url=False)
+        for error in errors:
+            error["loc"] = ("body",) + tuple(error["loc"])
+            if isinstance(error.get("input"), float) and not math.isfinite(error["input"]):
+                error["input"] = str(error["input"])  # NaN/inf cannot be echoed as JSON
+        raise RequestValidationError(errors)
+    VALIDATION_SECONDS.observe(time.perf_counter() - start)
+    return data
+
+
+@app.post("/data", openapi_extra={"requestBody": {
+    "required": True,
+    "content": {"application/json": {"schema": SensorData.model_json_schema()}}
+}})
+async def receive_sensor_data(request: Request):
     """
     Receive sensor data from ESP32 and broadcast to all WebSocket clients.
     
@@ -314,40 +749,520 @@ async def receive_sensor_data(data: SensorData):
     {
         "temperature": 32.5,
         "gas_level": 250,
-        "humidity": 65.0
+        "humidity": 65.0,
+        "device_id": "station-1",  (optional, defaults to "default")
+        "timestamp": 1760000000.0  (optional, epoch seconds when taken)
     }
     """
-    status = determine_status(data.temperature, data.gas_level)
-    
-    response = {
-        "temperature": data.temperature,
-        "gas_level": data.gas_level,
-        "humidity": data.humidity,
-        "status": status,
-        "timestamp": datetime.now().isoformat()
-    }
-    
-    # Broadcast to all connected WebSocket clients
-    await manager.broadcast(json.dumps(response))
+    body = await request.body()
+    if capture is not None:
+        capture.record("data", body)
+    start = time.perf_counter()
+    data = validate_reading(body)
+    if not device_allowed(data.device_id):
+        READINGS_REJECTED.inc()
+        raise HTTPException(status_code=429, detail=f"Too many devices (limit {MAX_DEVICES})")
+    now = datetime.now(timezone.utc)
+    received_at = now.timestamp()
+    taken_at = reading_time(data, received_at)
+    if taken_at == received_at:
+        timestamp = now.isoformat()
+    else:
+        timestamp = datetime.fromtimestamp(taken_at, timezone.utc).isoformat()
+    response = build_reading(data, timestamp, taken_at)
+    status = response["status"]
+    READINGS_TOTAL.inc(1, status)
+    store_reading(response, taken_at)
+    track_alerts([response], [taken_at], received_at)
     
-    print(f"📊 Data received - Temp: {data.temperature}°C, Gas: {data.gas_level} PPM, "
-          f"Humidity: {data.humidity}% -> Status: {status}")
+    # Broadcast to clients watching this device, then to the other workers
+    await manager.broadcast_reading(response)
+    await publish_readings([response], [taken_at], received_at)
     
+    # Formatting and writing happen on the logger thread; sampled at high rates
+    if sample_reading():
+        log.info("📊 Data received [%s] - Temp: %s°C, Gas: %s PPM, Humidity: %s%% -> Status: %s",
+                 data.device_id, data.temperature, data.gas_level, data.humidity, status,
+                 extra={"fields": response})
+
+    INGEST_SECONDS.observe(time.perf_counter() - start)
     return response
 
 
+@app.post("/data/batch")
+async def receive_sensor_data_batch(request: Request):
+    """
+    Receive many sensor readings in one request (e.g. from a gateway).
+
+    The body is either a JSON array of readings or NDJSON
+    (Content-Type: application/x-ndjson). All accepted readings are
+    broadcast to WebSocket clients as a single JSON array frame (a lone
+    reading goes out as a plain object, like POST /data).
+
+    Response:
+    {
+        "accepted": 2,
+        "rejected": 1,
+        "results": [{"index": 0, "accepted": true, "status": "SAFE"}, ...]
+    }
+    """
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    if capture is not None:
+        capture.record("batch", body, content_type=content_type)
+    start = time.perf_counter()
+    try:
+        items = parse_batch_body(body, content_type)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed batch body: {e}")
+
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large ({len(items)} > {MAX_BATCH_SIZE} readings)"
+        )
+
+    batch = await ingest_batch(items)
+    readings = batch["readings"]
+
+    accepted = len(readings)
+    rejected = len(items) - accepted
+    log.info("📦 Batch received - %d accepted, %d rejected", accepted, rejected,
+             extra={"fields": {"accepted": accepted, "rejected": rejected}})
+
+    BATCH_INGEST_SECONDS.observe(time.perf_counter() - start)
+
+    return {"accepted": accepted, "rejected": rejected, "results": batch["results"]}
+
+
+@app.get("/history")
+async def get_history(
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    limit: int = Query(1000, ge=1, le=MAX_HISTORY_LIMIT),
+    device: Optional[str] = None
+):
+    """
+    Return stored readings between `from` and `to` (inclusive), oldest first.
+
+    Times are epoch seconds or ISO 8601 strings; both are optional. When more
+    than `limit` readings match, the most recent `limit` are returned.
+    Pass `device` to return a single device's readings.
+    Ranges older than the in-memory buffer are read from the compressed
+    history, or from durable storage if they predate that too.
+    """
+    start_time = parse_time(start)
+    end_time = parse_time(end)
+    oldest = history.oldest_timestamp()
+    compressed_oldest = compressed.oldest_timestamp()
+
+    if start_time is None or (oldest is not None and start_time >= oldest):
+        readings = history.query(start_time, end_time, limit, device)
+    elif compressed_oldest is not None and start_time >= compressed_oldest:
+        readings = compressed.query(start_time, end_time, limit, device)
+    else:
+        records = await run_in_threadpool(storage.query, start_time, end_time, limit, device)
+        readings = [record_to_reading(record) for record in records]
+    return {
+        "count": len(readings),
+        "capacity": history.capacity,
+        "stored": len(history),
+        "readings": readings
+    }
+
+
+async def export_batches(start: Optional[float], end: Optional[float],
+                         device: Optional[str]) -> AsyncIterator[List[Row]]:
+    """
+    Readings in a time range, oldest first, EXPORT_BATCH_ROWS at a time.
+
+    Ranges the compressed history holds are decoded from memory on the event
+    loop, yielding between batches; anything older is scanned from durable
+    storage in the threadpool.
+    """
+    compressed_oldest = compressed.oldest_timestamp()
+    in_memory = compressed_oldest is not None and (
+        (start is not None and start >= compressed_oldest) or isinstance(storage, NullStorage)
+    )
+    if in_memory:
+        for batch in batched(compressed.points(start, end, device)):
+            yield batch
+            await asyncio.sleep(0)  # Let ingest run between batches
+        return
+    records = storage.scan(start, end, device, EXPORT_BATCH_ROWS)
+    async for batch in iterate_in_threadpool(records):
+        yield [
+            (timestamp, temperature, gas_level, humidity, status, decode_device_id(field))
+            for timestamp, temperature, gas_level, humidity, status, field in batch
+        ]
+
+
+@app.get("/export")
+async def export_history(
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    device: Optional[str] = None,
+    format: str = "csv"
+):
+    """
+    Stream every reading between `from` and `to` (inclusive), oldest first.
+
+    ?format=csv (default), ndjson or columnar (see export.py). Unlike
+    /history there is no limit: the response is sent in chunks as it is
+    read, so memory use does not grow with the size of the export.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown format '{format}' (use {', '.join(EXPORT_FORMATS)})"
+        )
+    start_time = parse_time(start)
+    end_time = parse_time(end)
+    encoder = ENCODERS[format]()
+
+    async def body():
+        header = encoder.header()
+        if header:
+            yield header
+        async for batch in export_batches(start_time, end_time, device):
+            yield encoder.encode(batch)
+        footer = encoder.footer()
+        if footer:
+            yield footer
+
+    filename = f"smartsense-{datetime.now():%Y%m%d-%H%M%S}.{encoder.extension}"
+    return StreamingResponse(body(), media_type=encoder.media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"'
+    })
+
+
+def raw_buckets(start: float, end: float, device: str,
+                limit: int = CHART_RAW_LIMIT) -> Optional[List[list]]:
+    """
+    A device's readings in a range as buckets of one, or None if they are no
+    longer in memory or there are more than `limit` of them.
+    """
+    compressed_oldest = compressed.oldest_timestamp()
+    if compressed_oldest is not None and start >= compressed_oldest:
+        # Decoding stops one reading past the limit
+        points = list(islice(compressed.points(start, end, device), limit + 1))
+        if len(points) > limit:
+            return None
+        return [reading_bucket(timestamp, temperature, gas_level, humidity, status)
+                for timestamp, temperature, gas_level, humidity, status, _ in points]
+    oldest = history.oldest_timestamp()
+    if oldest is not None and start >= oldest:
+        readings = history.query(start, end, limit + 1, device)
+        if len(readings) > limit:
+            return None
+        return [reading_bucket(datetime.fromisoformat(reading["timestamp"]).timestamp(),
+                               reading["temperature"], reading["gas_level"],
+                               reading["humidity"], STATUS_INDEX[reading["status"]])
+                for reading in readings]
+    return None
+
+
+@app.get("/chart")
+async def get_chart(
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    device: str = DEFAULT_DEVICE,
+    width: int = Query(800, ge=10, le=MAX_CHART_WIDTH),
+    lttb_metric: Optional[str] = Query(None, alias="lttb")
+):
+    """
+    Chart series for one device: at most `width` points between `from` and
+    `to` (default: the last hour), each with min/max/avg per metric.
+
+    Points come from the finest rollup tier that covers the range in a few
+    buckets per point (raw readings for short ranges, up to
+    CHART_RAW_LIMIT of them), merged down to
+    `width`. ?lttb=temperature (or gas_level, humidity) thins them with LTTB
+    on that metric's average instead, which keeps the shape of the line
+    where merging would flatten it.
+    """
+    if lttb_metric is not None and lttb_metric not in METRICS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown lttb metric '{lttb_metric}' (use {', '.join(METRICS)})"
+        )
+    end_time = parse_time(end)
+    if end_time is None:
+        end_time = datetime.now().timestamp()
+    start_time = parse_time(start)
+    if start_time is None:
+        start_time = end_time - 3600
+    if start_time >= end_time:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+
+    points = width * CHART_OVERSAMPLE
+    tier = rollups.pick(device, start_time, end_time, points)
+    buckets = None
+    resolution = 0
+    if tier is None or (end_time - start_time) / points < rollups.tiers[0][0]:
+        # Finer than the finest tier: raw readings, if still held in memory
+        # and not too many to decode (the finest tier is used otherwise)
+        buckets = raw_buckets(start_time, end_time, device)
+    if buckets is None and tier is not None:
+        buckets = tier.buckets(start_time, end_time)
+        resolution = tier.seconds
+    buckets = buckets or []
+
+    if lttb_metric and len(buckets) > width:
+        buckets = lttb(buckets, width, metric_average(lttb_metric))
+    else:
+        buckets = regroup(buckets, width)
+    return {
+        "device": device,
+        "from": start_time,
+        "to": end_time,
+        "resolution": resolution,
+        "lttb": lttb_metric,
+        "count": len(buckets),
+        **chart_columns(buckets)
+    }
+
+
+@app.get("/rules")
+async def get_rules():
+    """Alert rules currently in effect."""
+    return {"file": RULES_FILE, "count": len(rule_engine.rules), "rules": rule_engine.rules}
+
+
+@app.post("/rules/reload")
+async def post_rules_reload():
+    """Reload the rules file now instead of waiting for the file watcher."""
+    if not reload_rules():
+        raise HTTPException(status_code=400, detail="Rules file is invalid; previous rules kept")
+    return {"success": True, "count": len(rule_engine.rules)}
+
+
+@app.get("/alerts")
+async def get_alerts():
+    """Recently confirmed status-transition alerts (newest first) and their deliveries."""
+    return {
+        "sinks": [sink.name for sink in alerts.sinks],
+        "pending": alerts.pending(),
+        "alerts": list(reversed(alerts.recent))
+    }
+
+
+@app.get("/stats")
+async def get_stats(device: Optional[str] = None):
+    """
+    Rolling 1m / 15m / 1h aggregates per device.
+
+    For each window: reading count, min/max/mean/stddev of temperature,
+    gas_level and humidity, and seconds spent in WARNING and DANGER.
+    Maintained incrementally on ingest, so this never scans history.
+    """
+    return {"devices": stats.snapshot(datetime.now().timestamp(), device)}
+
+
+@app.get("/devices")
+async def get_devices():
+    """Latest reading for every device that has reported."""
+    return {"count": len(LATEST_READINGS), "devices": LATEST_READINGS}
+
+
+@app.get("/devices/{device_id}")
+async def get_device(device_id: str):
+    """Latest reading for one device."""
+    reading = LATEST_READINGS.get(device_id)
+    if reading is None:
+        raise HTTPException(status_code=404, detail=f"Unknown device '{device_id}'")
+    return reading
+
+
+REGISTRY.gauge("smartsense_ws_connections", "Open WebSocket connections",
+               lambda: len(manager.active_connections))
+REGISTRY.gauge("smartsense_ws_queue_depth_max", "Deepest client send queue",
+               lambda: max(manager.queue_depths(), default=0))
+REGISTRY.gauge("smartsense_ws_queued_messages", "Messages waiting in all client send queues",
+               lambda: sum(manager.queue_depths()))
+REGISTRY.gauge("smartsense_ingest_connections", "Devices connected to /ingest",
+               lambda: len(INGEST_CLIENTS))
+REGISTRY.gauge("smartsense_sessions", "Live login sessions in the token store",
+               lambda: len(TOKENS))
+REGISTRY.gauge("smartsense_devices", "Devices that have reported a reading",
+               lambda: len(LATEST_READINGS))
+REGISTRY.gauge("smartsense_history_readings", "Readings held in the in-memory history",
+               lambda: len(history))
+REGISTRY.gauge("smartsense_history_late_skipped", "Late readings too far back for the in-memory history",
+               lambda: history.late)
+REGISTRY.gauge("smartsense_alert_queue_depth", "Alert deliveries waiting for a worker",
+               alerts.pending)
+REGISTRY.gauge("smartsense_compressed_history_readings", "Readings held in the compressed history",
+               lambda: len(compressed))
+REGISTRY.gauge("smartsense_compressed_history_bytes", "Memory used by compressed history chunks",
+               lambda: compressed.nbytes)
+REGISTRY.gauge("smartsense_rollup_buckets", "Chart rollup buckets held across devices and tiers",
+               rollups.bucket_count)
+REGISTRY.gauge("smartsense_rollup_bytes", "Memory used by sealed chart rollup buckets",
+               lambda: rollups.nbytes)
+REGISTRY.gauge("smartsense_rollup_late_skipped", "Late readings older than every rollup bucket held",
+               rollups.late_count)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for ingest, classification, fan-out and sessions."""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+def handle_client_message(websocket: WebSocket, text: str):
+    """
+    Handle a control message sent by a dashboard over /ws.
+
+    Supported messages:
+    {"type": "subscribe", "devices": ["station-1", "station-2"]}
+    {"type": "unsubscribe", "devices": ["station-2"]}
+    {"type": "rate", "max_hz": 1}
+    Use "*" to mean every device and max_hz 0 (or null) for every reading.
+    Anything else (e.g. keep-alive pings) is ignored.
+    """
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return
+    if not isinstance(message, dict):
+        return
+
+    if message.get("type") == "rate":
+        max_hz = message.get("max_hz")
+        if max_hz is not None and (isinstance(max_hz, bool) or not isinstance(max_hz, (int, float))):
+            return
+        manager.set_rate(websocket, max_hz)
+        manager.send(websocket, json.dumps({"type": "rate", "max_hz": max_hz or 0}))
+        return
+
+    devices = message.get("devices")
+    if not isinstance(devices, list) or not all(isinstance(d, str) for d in devices):
+        return
+
+    if message.get("type") == "subscribe":
+        manager.subscribe(websocket, devices)
+    elif message.get("type") == "unsubscribe":
+        manager.unsubscribe(websocket, devices)
+    else:
+        return
+
+    client = manager.active_connections.get(websocket)
+    if client is not None:
+        watching = ["*"] if client.devices is None else sorted(client.devices)
+        manager.send(websocket, json.dumps({"type": "subscribed", "devices": watching}))
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time data streaming to frontend."""
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, max_hz: Optional[float] = None,
+                             last_seq: Optional[int] = None, epoch: Optional[str] = None,
+                             format: str = "json", compress: Optional[str] = None):
+    """
+    WebSocket endpoint for real-time data streaming to frontend.
+
+    The first frame is {"type": "snapshot", "epoch", "seq", "readings": [...]}
+    with the latest readings; every reading after it carries its "seq".
+    Reconnect with ?last_seq=N&epoch=E to get {"type": "replay", ...} with
+    exactly the readings missed since N instead (or a fresh snapshot if they
+    are no longer buffered).
+
+    Connect with ?max_hz=1 (or send a "rate" message) to receive at most
+    that many frames per second, each with the latest reading per device.
+
+    ?format=binary or ?format=delta selects packed readings, and
+    ?compress=deflate deflates every frame (see frames.py). Snapshots and
+    control replies are always JSON text.
+    """
+    if format not in FORMATS or (compress is not None and compress not in COMPRESSIONS):
+        await websocket.close(code=WS_POLICY_VIOLATION)
+        return
+    await manager.connect(websocket, last_seq, epoch, format, compress is not None)
+    if max_hz:
+        manager.set_rate(websocket, max_hz)
     try:
         while True:
-            # Keep connection alive, data is pushed via broadcast
-            await websocket.receive_text()
+            # Data is pushed via broadcast; incoming text is control messages
+            handle_client_message(websocket, await websocket.receive_text())
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
+
+@app.websocket("/ingest")
+async def ingest_endpoint(websocket: WebSocket, device_id: Optional[str] = None,
+                          ack: bool = True):
+    """
+    Persistent ingest channel for devices and gateways.
+
+    Each frame (text or binary) holds one reading, a JSON array of readings
+    or NDJSON, and is handled like POST /data/batch without paying for an
+    HTTP request per reading. Readings without a device_id take the one
+    given in ?device_id=. Unless ?ack=0, every frame is answered with
+    {"type": "ack", "seq": 1, "accepted": 100, "rejected": 0, "errors": []}
+    where seq counts frames on this connection and errors lists only the
+    rejected items.
+    """
+    await websocket.accept()
+    INGEST_CLIENTS.add(websocket)
+    log.info("📥 Ingest channel opened (%s). Total: %d",
+             device_id or "multi-device", len(INGEST_CLIENTS))
+    seq = 0
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            body = message.get("bytes") or (message.get("text") or "").encode()
+            if capture is not None:
+                capture.record("ingest", body, device=device_id or "")
+            seq += 1
+            start = time.perf_counter()
+            try:
+                items = parse_batch_body(body)
+                if len(items) > MAX_BATCH_SIZE:
+                    raise ValueError(f"Batch too large ({len(items)} > {MAX_BATCH_SIZE} readings)")
+            except (UnicodeDecodeError, ValueError) as e:
+                if ack:
+                    await websocket.send_text(json.dumps(
+                        {"type": "error", "seq": seq, "detail": f"Malformed frame: {e}"}
+                    ))
+                continue
+
+            if device_id:
+                for item in items:
+                    if isinstance(item, dict):
+                        item.setdefault("device_id", device_id)
+            batch = await ingest_batch(items)
+            INGEST_FRAME_SECONDS.observe(time.perf_counter() - start)
+
+            if ack:
+                accepted = len(batch["readings"])
+                await websocket.send_text(json.dumps({
+                    "type": "ack",
+                    "seq": seq,
+                    "accepted": accepted,
+                    "rejected": len(items) - accepted,
+                    "errors": [result for result in batch["results"] if not result["accepted"]]
+                }))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        INGEST_CLIENTS.discard(websocket)
+        log.info("📥 Ingest channel closed after %d frames. Total: %d", seq, len(INGEST_CLIENTS))
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # WORKERS=4 python main.py: one process per core, sharing readings over
+    # the worker bus and sessions / accounts through the SQLite auth database
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        os.environ.setdefault("BUS_URL", DEFAULT_BUS_URL)
+        os.environ.setdefault("SESSION_BACKEND", "sqlite")
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers,
+                    ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000,
+                    ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
@@ -0,0 +1,134 @@
+"""
+Prometheus metrics for SmartSense.
+
+Counters and fixed-bucket histograms are plain Python numbers updated on the
+event loop thread, so recording a sample is a few attribute updates with no
+locks and no allocation. Gauges that describe current state (open sockets,
+queue depths, session count) are computed by callbacks only when /metrics is
+scraped, so they cost nothing on the hot path.
+"""
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Starlette appends "; charset=utf-8" to text responses
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Default latency buckets (seconds): 50 us to 1 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Monotonic count, optionally split by one label."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values: Dict[str, float] = {} if label else {"": 0}
+
+    def inc(self, amount: float = 1, label_value: str = ""):
+        values = self.values
+        values[label_value] = values.get(label_value, 0) + amount
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        if not self.label:
+            yield self.name, self.values[""]
+            return
+        for value, count in sorted(self.values.items()):
+            yield f'{self.name}{{{self.label}="{_escape(value)}"}}', count
+
+
+class Histogram:
+    """Distribution of observations over fixed upper-bound buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Per-bucket (not cumulative) counts; the last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{_format_value(bound)}"}}', cumulative
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+
+class CallbackMetric:
+    """Gauge (or counter) whose value is read from a callback at scrape time."""
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float],
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        yield self.name, self.callback()
+
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label: Optional[str] = None) -> Counter:
+        return self.register(Counter(name, help, label))
+
+    def histogram(self, name: str, help: str,
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, callback))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {_format_value(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+# Process-wide registry served by GET /metrics
+REGISTRY = Registry()
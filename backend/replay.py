@@ -0,0 +1,333 @@
+"""
+Capture Replay for SmartSense Safety Monitoring System
+Feeds captures recorded with CAPTURE=true (see capture.py) back through the
+serial line parser or into a backend, with the original inter-arrival times.
+
+Usage:
+    python replay.py captures/gateway-*.ndjson.gz --parse                  # parser only
+    python replay.py capture.ndjson.gz --parse --output parsed.ndjson      # save results
+    python replay.py capture.ndjson.gz --parse --expect parsed.ndjson      # regression check
+    python replay.py capture.ndjson.gz --spawn                             # local server, 1x
+    python replay.py capture.ndjson.gz --url http://127.0.0.1:8000 --speed 10
+    python replay.py capture.ndjson.gz --spawn --speed 0 --connections 20  # full speed
+
+--speed 1 keeps the captured timing, N plays N times faster and 0 sends
+everything as fast as the target accepts it. Several captures (e.g. one
+per worker) are merged by time, each shifted by when it started.
+
+Into a backend, serial lines are parsed, stamped and posted to /data/batch
+in batches the way the reader's uplink does (UPLINK_BATCH_SIZE readings, or
+whatever arrived within UPLINK_LINGER captured seconds), /data and
+/data/batch bodies are posted unchanged and /ingest frames are sent on an
+/ingest connection. The report gives
+throughput, request latency and how far sends slipped behind the captured
+schedule (the target could not keep up).
+"""
+
+import argparse
+import asyncio
+import heapq
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode, urlparse
+
+import websockets
+
+from arduino_reader import SensorLineParser
+from capture import decode_payload, read_capture
+from load_test import HttpConnection, percentile, spawn_server
+from uplink import UPLINK_BATCH_SIZE, UPLINK_LINGER
+
+
+def shifted(records: Iterator[dict], offset: float, source: str) -> Iterator[dict]:
+    """A capture's records on the merged timeline, tagged with the capture's source."""
+    for record in records:
+        record["t"] += offset
+        record["source"] = source
+        yield record
+
+
+def load_records(paths: List[str]) -> Iterator[dict]:
+    """
+    Records of one or more captures, merged in time order. `t` is relative
+    to its own capture's start, so each capture is shifted by how much later
+    than the first one it started.
+    """
+    captures = []
+    for path in paths:
+        try:
+            header, records = read_capture(path)
+            started = datetime.fromisoformat(header["started"]).timestamp()
+        except (OSError, ValueError) as e:
+            print(f"❌ {e}")
+            sys.exit(2)
+        print(f"📼 {path}: {header['source']} capture started {header['started']}")
+        captures.append((started, header["source"], records))
+    first = min((started for started, _, _ in captures), default=0.0)
+    streams = [shifted(records, started - first, source) for started, source, records in captures]
+    return heapq.merge(*streams, key=lambda record: record["t"])
+
+
+def paced(records: Iterator[dict], speed: float) -> Iterator[Tuple[dict, float]]:
+    """Yield (record, seconds behind schedule), sleeping to keep the captured timing."""
+    start = time.perf_counter()
+    for record in records:
+        if speed <= 0:
+            yield record, 0.0
+            continue
+        due = start + record["t"] / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield record, max(0.0, time.perf_counter() - due)
+
+
+def parse_serial(records: Iterator[dict], speed: float) -> Tuple[List[Optional[dict]], float]:
+    """Run every serial line through the parser; results in capture order."""
+    parsers: Dict[str, SensorLineParser] = {}
+    results: List[Optional[dict]] = []
+    busy = 0.0
+    for record, _ in paced((r for r in records if r["kind"] == "serial"), speed):
+        device = record.get("device", "")
+        parser = parsers.get(device)
+        if parser is None:
+            parser = parsers[device] = SensorLineParser()  # One per board, like the gateway
+        line = decode_payload(record["data"])
+        start = time.perf_counter()
+        reading = parser.parse(line)
+        busy += time.perf_counter() - start
+        results.append(None if reading is None else dict(reading, device=device))
+    return results, busy
+
+
+def compare(results: List[Optional[dict]], path: str) -> int:
+    """Differences between parse results and a saved run (printed, and counted)."""
+    with open(path) as f:
+        expected = [json.loads(line) for line in f]
+    differences = abs(len(expected) - len(results))
+    shown = 0
+    for index, (got, want) in enumerate(zip(results, expected)):
+        if got != want:
+            differences += 1
+            if shown < 10:
+                print(f"   line {index}: expected {want}, got {got}")
+                shown += 1
+    if len(expected) != len(results):
+        print(f"   expected {len(expected)} lines, replay produced {len(results)}")
+    return differences
+
+
+def run_parse(args: argparse.Namespace) -> int:
+    start = time.perf_counter()
+    results, busy = parse_serial(load_records(args.captures), args.speed)
+    elapsed = time.perf_counter() - start
+    parsed = sum(1 for result in results if result is not None)
+    print(f"\n🔎 {len(results)} serial lines: {parsed} readings, {len(results) - parsed} unparsed")
+    if results:
+        print(f"   parser: {busy / len(results) * 1e6:.2f} us per line "
+              f"({len(results) / busy if busy else 0:,.0f} lines/s), replay took {elapsed:.2f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        print(f"💾 Results saved to {args.output}")
+    if args.expect:
+        differences = compare(results, args.expect)
+        if differences:
+            print(f"❌ {differences} differences from {args.expect}")
+            return 1
+        print(f"✅ Identical to {args.expect}")
+    return 0
+
+
+class BackendReplay:
+    """Sends capture records to a backend over a pool of keep-alive connections."""
+
+    def __init__(self, url: str, connections: int, batch_size: int = UPLINK_BATCH_SIZE,
+                 linger: float = UPLINK_LINGER):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 80
+        self.connections = connections
+        self.batch_size = batch_size
+        self.linger = linger
+        self.parsers: Dict[str, SensorLineParser] = {}
+        # Parsed serial readings waiting to go out as one batch, like the uplink's queue
+        self.pending: List[dict] = []
+        self.pending_since = 0.0  # Capture time of the first of them
+        # /ingest connection per captured ?device_id=, as [lock, socket]
+        self.channels: Dict[str, list] = {}
+        self.latencies: List[float] = []
+        self.lags: List[float] = []
+        self.outcomes: Counter = Counter()
+
+    def serial_reading(self, record: dict) -> Optional[dict]:
+        """A serial line as the reading the reader would have queued on its uplink."""
+        device = record.get("device", "")
+        parser = self.parsers.get(device)
+        if parser is None:
+            parser = self.parsers[device] = SensorLineParser()
+        reading = parser.parse(decode_payload(record["data"]))
+        if reading is None:
+            return None
+        # Only the gateway names its boards; arduino_reader sends no device_id ("default")
+        if record.get("source") == "gateway":
+            reading["device_id"] = device
+        reading["timestamp"] = time.time()  # Stamped when read, like Uplink.submit()
+        return reading
+
+    def take_batch(self, t: float) -> dict:
+        """The pending serial readings as one record to post to /data/batch."""
+        batch = {"t": t, "kind": "serial", "readings": self.pending}
+        self.pending = []
+        return batch
+
+    async def send_ingest(self, record: dict) -> str:
+        """One /ingest frame; waits for its ack like a device does."""
+        device = record.get("device", "")
+        channel = self.channels.get(device)
+        if channel is None:
+            channel = self.channels[device] = [asyncio.Lock(), None]
+        async with channel[0]:
+            if channel[1] is None:
+                query = f"?{urlencode({'device_id': device})}" if device else ""
+                channel[1] = await websockets.connect(f"ws://{self.host}:{self.port}/ingest{query}")
+            await channel[1].send(decode_payload(record["data"]))
+            ack = json.loads(await channel[1].recv())
+        return ack.get("type", "?")
+
+    async def send(self, record: dict, connection: HttpConnection) -> str:
+        kind = record["kind"]
+        if kind == "serial":
+            return str(await connection.post("/data/batch", json.dumps(record["readings"]).encode(),
+                                             "application/json"))
+        if kind == "data":
+            return str(await connection.post("/data", decode_payload(record["data"])))
+        if kind == "batch":
+            return str(await connection.post("/data/batch", decode_payload(record["data"]),
+                                             record.get("content_type") or "application/json"))
+        if kind == "ingest":
+            return await self.send_ingest(record)
+        return "unknown kind"
+
+    async def run(self, records: Iterator[dict], speed: float) -> float:
+        pool: asyncio.Queue = asyncio.Queue()
+        for _ in range(self.connections):
+            pool.put_nowait(HttpConnection(self.host, self.port))
+        tasks = set()
+
+        async def deliver(record: dict, connection: HttpConnection):
+            start = time.perf_counter()
+            try:
+                outcome = await self.send(record, connection)
+            except (OSError, asyncio.IncompleteReadError, websockets.WebSocketException) as e:
+                outcome = type(e).__name__
+            else:
+                self.latencies.append(time.perf_counter() - start)
+            finally:
+                pool.put_nowait(connection)
+            self.outcomes[f"{record['kind']} {outcome}"] += 1
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def dispatch(record: dict):
+            # Waiting for a free connection is where an overloaded target shows up as lag
+            connection = await pool.get()
+            if speed > 0:
+                self.lags.append(max(0.0, loop.time() - (start + record["t"] / speed)))
+            task = asyncio.create_task(deliver(record, connection))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        for record in records:
+            if speed > 0:
+                delay = start + record["t"] / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if self.pending and record["t"] - self.pending_since >= self.linger:
+                await dispatch(self.take_batch(record["t"]))
+            if record["kind"] != "serial":
+                await dispatch(record)
+                continue
+            reading = self.serial_reading(record)
+            if reading is None:
+                self.outcomes["serial unparsed"] += 1
+                continue
+            if not self.pending:
+                self.pending_since = record["t"]
+            self.pending.append(reading)
+            if len(self.pending) >= self.batch_size:
+                await dispatch(self.take_batch(record["t"]))
+        if self.pending:
+            await dispatch(self.take_batch(self.pending_since + self.linger))
+        await asyncio.gather(*tasks)
+        elapsed = loop.time() - start
+
+        while not pool.empty():
+            pool.get_nowait().close()
+        for _, socket in self.channels.values():
+            if socket is not None:
+                await socket.close()
+        return elapsed
+
+
+def run_backend(args: argparse.Namespace) -> int:
+    replay = BackendReplay(args.url, args.connections)
+    server = spawn_server(urlparse(args.url).port or 80) if args.spawn else None
+    try:
+        elapsed = asyncio.run(replay.run(load_records(args.captures), args.speed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    sent = sum(replay.outcomes.values())
+    speed = "full speed" if args.speed <= 0 else f"{args.speed:g}x"
+    print(f"\n🚀 {sent} records replayed at {speed} in {elapsed:.2f}s "
+          f"({sent / elapsed if elapsed else 0:,.0f} records/s) over {args.connections} connections")
+    for outcome, count in sorted(replay.outcomes.items()):
+        print(f"   {outcome}: {count}")
+    if replay.latencies:
+        print(f"   latency p50 {percentile(replay.latencies, 50) * 1e3:.1f} ms, "
+              f"p99 {percentile(replay.latencies, 99) * 1e3:.1f} ms")
+    if replay.lags:
+        print(f"   behind schedule: p99 {percentile(replay.lags, 99) * 1e3:.1f} ms, "
+              f"max {max(replay.lags) * 1e3:.1f} ms")
+    failed = sum(count for outcome, count in replay.outcomes.items()
+                 if not outcome.endswith((" 200", " ack", " unparsed")))
+    return 1 if failed else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="SmartSense capture replay")
+    parser.add_argument("captures", nargs="+", help="Capture files (.ndjson.gz)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = captured timing, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--parse", action="store_true",
+                        help="Run serial lines through the parser instead of a backend")
+    parser.add_argument("--output", help="With --parse: save results as NDJSON")
+    parser.add_argument("--expect", help="With --parse: compare with saved results")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Backend base URL")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Start a local server on --url's port for the replay")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="Concurrent HTTP connections (1 keeps strict capture order)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("=" * 70)
+    print("📼 SmartSense Capture Replay")
+    print("=" * 70)
+    sys.exit(run_parse(args) if args.parse else run_backend(args))
+
+
+if __name__ == "__main__":
+    main()
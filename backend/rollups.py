@@ -0,0 +1,301 @@
+"""
+Multi-resolution rollups for SmartSense charts.
+
+Every reading updates one bucket per tier for its device: min/max/sum/count
+of temperature, gas level and humidity, plus the worst status seen. With
+the default tiers (10 s for 6 hours, 1 min for a day, 15 min for a week and
+1 h for 90 days) that is four bucket updates per reading, and a chart of
+any range reads about as many buckets as it has pixels instead of every
+reading in the range:
+
+- RollupStore.pick() chooses the finest tier that spans the range in at
+  most CHART_OVERSAMPLE buckets per point
+- regroup() then merges neighbouring buckets down to the chart width, or
+  lttb() (Largest-Triangle-Three-Buckets) thins them to it while keeping
+  the visual shape of one metric
+
+Sealed buckets are kept in typed arrays per device and tier (~85 bytes
+each); the newest bucket is a plain list updated in place.
+"""
+
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from history import STATUS_CODES, STATUS_INDEX
+
+# Tiers as bucket seconds:buckets kept per device, finest first
+# (10 s for 6 hours, 1 min for 1 day, 15 min for 7 days, 1 h for 90 days)
+ROLLUP_TIERS = os.getenv("ROLLUP_TIERS", "10:2160,60:1440,900:672,3600:2160")
+
+# Buckets (or readings) read per chart point, then merged or thinned by LTTB
+CHART_OVERSAMPLE = int(os.getenv("CHART_OVERSAMPLE", "4"))
+
+# Most raw readings decoded for one chart; busier ranges use the finest tier
+CHART_RAW_LIMIT = int(os.getenv("CHART_RAW_LIMIT", "20000"))
+
+METRICS = ("temperature", "gas_level", "humidity")
+
+# [start, count, status code, then min, max, sum of each metric in METRICS order]
+Bucket = List
+VALUES = 9
+
+
+def parse_tiers(spec: str) -> List[Tuple[int, int]]:
+    """ROLLUP_TIERS as (seconds, buckets) pairs, finest first."""
+    tiers = []
+    for part in spec.split(","):
+        seconds, _, buckets = part.strip().partition(":")
+        tiers.append((int(seconds), int(buckets)))
+    if not tiers or any(seconds <= 0 or buckets <= 0 for seconds, buckets in tiers):
+        raise ValueError(f"Invalid ROLLUP_TIERS '{spec}' (expected seconds:buckets,...)")
+    return sorted(tiers)
+
+
+def merge_reading(bucket: Bucket, temperature: float, gas_level: float,
+                  humidity: float, status: int):
+    """Add one reading to a bucket in place."""
+    bucket[1] += 1
+    if status > bucket[2]:
+        bucket[2] = status
+    if temperature < bucket[3]:
+        bucket[3] = temperature
+    if temperature > bucket[4]:
+        bucket[4] = temperature
+    bucket[5] += temperature
+    if gas_level < bucket[6]:
+        bucket[6] = gas_level
+    if gas_level > bucket[7]:
+        bucket[7] = gas_level
+    bucket[8] += gas_level
+    if humidity < bucket[9]:
+        bucket[9] = humidity
+    if humidity > bucket[10]:
+        bucket[10] = humidity
+    bucket[11] += humidity
+
+
+def merge_buckets(buckets: List[Bucket]) -> Bucket:
+    """One bucket covering several consecutive ones (starting at the first)."""
+    first = buckets[0]
+    merged = [first[0], sum(b[1] for b in buckets), max(b[2] for b in buckets)]
+    for offset in range(3, 3 + VALUES, 3):
+        merged.append(min(b[offset] for b in buckets))
+        merged.append(max(b[offset + 1] for b in buckets))
+        merged.append(sum(b[offset + 2] for b in buckets))
+    return merged
+
+
+class RollupSeries:
+    """One device's buckets at one resolution, oldest first; the newest is open."""
+
+    def __init__(self, seconds: int, capacity: int):
+        self.seconds = seconds
+        self.capacity = capacity
+        self.index = array("q")  # Bucket start // seconds
+        self.count = array("I")
+        self.status = array("b")
+        self.values = [array("d") for _ in range(VALUES)]
+        self.open: Optional[Bucket] = None  # Same layout, but starting with its index
+        # Every bucket from this time on is held (None: everything since the first reading)
+        self.since: Optional[float] = None
+        self.late = 0  # Readings older than every bucket still held
+
+    def __len__(self) -> int:
+        return len(self.index) + (self.open is not None)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.index) * (8 + self.count.itemsize + 1 + 8 * VALUES)
+
+    def add(self, timestamp: float, temperature: float, gas_level: float,
+            humidity: float, status: int):
+        index = int(timestamp // self.seconds)
+        bucket = self.open
+        if bucket is not None and index == bucket[0]:
+            merge_reading(bucket, temperature, gas_level, humidity, status)
+        elif bucket is None or index > bucket[0]:
+            if bucket is not None:
+                self._seal(bucket)
+            self.open = [index, 1, status, temperature, temperature, temperature,
+                         gas_level, gas_level, gas_level, humidity, humidity, humidity]
+        else:
+            self._add_late(index, temperature, gas_level, humidity, status)
+
+    def _seal(self, bucket: Bucket):
+        self.index.append(bucket[0])
+        self.count.append(bucket[1])
+        self.status.append(bucket[2])
+        for column, value in zip(self.values, bucket[3:]):
+            column.append(value)
+        excess = len(self.index) - self.capacity
+        # Trim in steps of a quarter of the capacity, so deletes stay amortized O(1)
+        if excess > self.capacity // 4:
+            for column in (self.index, self.count, self.status, *self.values):
+                del column[:excess]
+            self.since = self.index[0] * self.seconds
+
+    def _add_late(self, index: int, temperature: float, gas_level: float,
+                  humidity: float, status: int):
+        """A reading for a sealed or missing bucket (spool flush, another worker's reading)."""
+        position = bisect_left(self.index, index)
+        if position == len(self.index) or self.index[position] != index:
+            if self.since is not None and index * self.seconds < self.since:
+                self.late += 1  # Its bucket has been trimmed away
+                return
+            # A gap the reading falls in: give it a bucket of its own
+            self.index.insert(position, index)
+            self.count.insert(position, 1)
+            self.status.insert(position, status)
+            for column, value in zip(self.values, (temperature, temperature, temperature,
+                                                   gas_level, gas_level, gas_level,
+                                                   humidity, humidity, humidity)):
+                column.insert(position, value)
+            return
+        bucket = self._bucket(position)
+        merge_reading(bucket, temperature, gas_level, humidity, status)
+        self.count[position] = bucket[1]
+        self.status[position] = bucket[2]
+        for column, value in zip(self.values, bucket[3:]):
+            column[position] = value
+
+    def _bucket(self, position: int) -> Bucket:
+        return [self.index[position], self.count[position], self.status[position],
+                *(column[position] for column in self.values)]
+
+    def buckets(self, start: float, end: float) -> List[Bucket]:
+        """Buckets overlapping [start, end], oldest first, with start times in seconds."""
+        first = int(start // self.seconds)
+        last = int(end // self.seconds)
+        lo = bisect_left(self.index, first)
+        hi = bisect_right(self.index, last)
+        seconds = self.seconds
+        rows = zip(self.index[lo:hi], self.count[lo:hi], self.status[lo:hi],
+                   *(column[lo:hi] for column in self.values))
+        result = [[index * seconds, *rest] for index, *rest in rows]
+        bucket = self.open
+        if bucket is not None and first <= bucket[0] <= last:
+            result.append([bucket[0] * seconds, *bucket[1:]])
+        return result
+
+
+class RollupStore:
+    """Rollup tiers for every device, updated as readings arrive."""
+
+    def __init__(self, tiers: Iterable[Tuple[int, int]] = parse_tiers(ROLLUP_TIERS)):
+        self.tiers = list(tiers)
+        self.devices: Dict[str, List[RollupSeries]] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(s.nbytes for series in self.devices.values() for s in series)
+
+    def bucket_count(self) -> int:
+        return sum(len(s) for series in self.devices.values() for s in series)
+
+    def late_count(self) -> int:
+        """Reading-tier updates skipped because their bucket was already trimmed."""
+        return sum(s.late for series in self.devices.values() for s in series)
+
+    def add(self, timestamp: float, temperature: float, gas_level: float,
+            humidity: float, status: str, device_id: str):
+        """Feed one reading into every tier of its device."""
+        series = self.devices.get(device_id)
+        if series is None:
+            series = self.devices[device_id] = [
+                RollupSeries(seconds, buckets) for seconds, buckets in self.tiers
+            ]
+        code = STATUS_INDEX[status]
+        for tier in series:
+            tier.add(timestamp, temperature, gas_level, humidity, code)
+
+    def pick(self, device_id: str, start: float, end: float,
+             points: int) -> Optional[RollupSeries]:
+        """
+        The finest tier that still holds `start` and spans the range in at
+        most `points` buckets (the coarsest one that holds it otherwise).
+        None for an unknown device.
+        """
+        series = self.devices.get(device_id)
+        if series is None:
+            return None
+        held = [tier for tier in series if tier.since is None or start >= tier.since] or series[-1:]
+        for tier in held:
+            if (end - start) / tier.seconds <= points:
+                return tier
+        return held[-1]
+
+
+def reading_bucket(timestamp: float, temperature: float, gas_level: float,
+                   humidity: float, status: int) -> Bucket:
+    """A raw reading as a bucket of one."""
+    return [timestamp, 1, status, temperature, temperature, temperature,
+            gas_level, gas_level, gas_level, humidity, humidity, humidity]
+
+
+def regroup(buckets: List[Bucket], points: int) -> List[Bucket]:
+    """Merge runs of neighbouring buckets so at most `points` remain."""
+    if len(buckets) <= points:
+        return buckets
+    size = -(-len(buckets) // points)
+    return [merge_buckets(buckets[i:i + size]) for i in range(0, len(buckets), size)]
+
+
+def lttb(buckets: List[Bucket], points: int, value: Callable[[Bucket], float]) -> List[Bucket]:
+    """
+    Largest-Triangle-Three-Buckets: keep the first and last bucket and, from
+    each of `points` - 2 equal runs in between, the one that forms the largest
+    triangle with the previously kept bucket and the average of the next run.
+    """
+    n = len(buckets)
+    if points >= n or points < 3:
+        return buckets
+    xs = [bucket[0] for bucket in buckets]
+    ys = [value(bucket) for bucket in buckets]
+    every = (n - 2) / (points - 2)
+    kept = [buckets[0]]
+    a = 0
+    for i in range(points - 2):
+        # Average point of the next run (the last bucket for the final run)
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        span = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / span
+        avg_y = sum(ys[next_start:next_end]) / span
+
+        ax, ay = xs[a], ys[a]
+        chosen, largest = -1, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > largest:
+                chosen, largest = j, area
+        kept.append(buckets[chosen])
+        a = chosen
+    kept.append(buckets[-1])
+    return kept
+
+
+def metric_average(metric: str) -> Callable[[Bucket], float]:
+    """Bucket -> mean of one metric, for lttb()."""
+    offset = 3 + 3 * METRICS.index(metric)
+    return lambda bucket: bucket[offset + 2] / bucket[1]
+
+
+def chart_columns(buckets: List[Bucket]) -> Dict:
+    """Buckets as the /chart payload: one array per column."""
+    columns: Dict = {
+        "t": [bucket[0] for bucket in buckets],
+        "readings": [bucket[1] for bucket in buckets],
+        "status": [STATUS_CODES[bucket[2]] for bucket in buckets],
+    }
+    for i, metric in enumerate(METRICS):
+        offset = 3 + 3 * i
+        # Sums are kept as floats; gas levels are reported whole like readings
+        extreme = int if metric == "gas_level" else float
+        columns[metric] = {
+            "min": [extreme(bucket[offset]) for bucket in buckets],
+            "max": [extreme(bucket[offset + 1]) for bucket in buckets],
+            "avg": [round(bucket[offset + 2] / bucket[1], 2) for bucket in buckets],
+        }
+    return columns
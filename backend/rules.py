@@ -0,0 +1,259 @@
+"""
+Alert rules engine for SmartSense.
+
+Rules are loaded from a JSON config (rules.json) and compiled once into a
+plain Python function per device, so evaluating a reading runs straight-line
+generated code instead of interpreting rule objects. Supported rule types:
+
+- threshold: metric compared with a value, with optional hysteresis ("clear")
+- rate: rate of change of a metric per second between consecutive readings
+- anomaly: EWMA mean/variance with a z-score limit
+
+Rules apply to every device unless they list "devices". A device-specific
+rule with the same name as a global rule replaces it for those devices.
+
+On reload, per-device state (hysteresis, last reading for rates, EWMA) is
+carried over for every rule whose state_key() is unchanged.
+"""
+
+import json
+import math
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+RULES_FILE = os.getenv("RULES_FILE", "rules.json")
+
+# Seconds between checks of the rules file for changes
+RULES_RELOAD_INTERVAL = float(os.getenv("RULES_RELOAD_INTERVAL", "2"))
+
+STATUS_LEVELS = {"SAFE": 0, "WARNING": 1, "DANGER": 2}
+STATUS_NAMES = ("SAFE", "WARNING", "DANGER")
+
+METRICS = ("temperature", "gas_level", "humidity")
+OPERATORS = (">", ">=", "<", "<=")
+RULE_TYPES = ("threshold", "rate", "anomaly")
+
+# Used when no rules file exists
+DEFAULT_RULES: List[Dict[str, Any]] = [
+    {"name": "temperature-danger", "type": "threshold", "metric": "temperature",
+     "op": ">", "value": 45, "status": "DANGER"},
+    {"name": "gas-danger", "type": "threshold", "metric": "gas_level",
+     "op": ">", "value": 1000, "status": "DANGER"},
+    {"name": "temperature-warning", "type": "threshold", "metric": "temperature",
+     "op": ">", "value": 35, "status": "WARNING"},
+    {"name": "gas-warning", "type": "threshold", "metric": "gas_level",
+     "op": ">", "value": 300, "status": "WARNING"},
+]
+
+# (evaluate function, factory for a fresh per-device state list, state_key() of each slot)
+Program = Tuple[Callable, Callable[[], list], Tuple[tuple, ...]]
+
+
+def _number(rule: Dict, key: str, default: Optional[float] = None) -> float:
+    value = rule.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"Rule '{rule.get('name')}': '{key}' must be a number")
+    try:
+        value = float(value)
+    except OverflowError:
+        value = math.inf
+    # repr() of inf or nan is not valid Python in the generated code
+    if not math.isfinite(value):
+        raise ValueError(f"Rule '{rule.get('name')}': '{key}' must be a finite number")
+    return value
+
+
+def validate_rule(rule: Any) -> Dict:
+    """Check a rule definition and fill in defaults."""
+    if not isinstance(rule, dict):
+        raise ValueError("Each rule must be an object")
+    name = rule.get("name")
+    if not isinstance(name, str) or not name:
+        raise ValueError("Each rule needs a non-empty 'name'")
+
+    rule_type = rule.get("type", "threshold")
+    if rule_type not in RULE_TYPES:
+        raise ValueError(f"Rule '{name}': unknown type '{rule_type}'")
+    if rule.get("metric") not in METRICS:
+        raise ValueError(f"Rule '{name}': metric must be one of {', '.join(METRICS)}")
+
+    status = rule.get("status", "WARNING" if rule_type == "anomaly" else None)
+    if status not in ("WARNING", "DANGER"):
+        raise ValueError(f"Rule '{name}': status must be WARNING or DANGER")
+
+    devices = rule.get("devices")
+    if devices is not None and (
+            not isinstance(devices, list) or not all(isinstance(d, str) for d in devices)):
+        raise ValueError(f"Rule '{name}': 'devices' must be a list of device IDs")
+
+    checked = {"name": name, "type": rule_type, "metric": rule["metric"],
+               "status": status, "devices": devices}
+
+    if rule_type in ("threshold", "rate"):
+        op = rule.get("op", ">")
+        if op not in OPERATORS:
+            raise ValueError(f"Rule '{name}': op must be one of {' '.join(OPERATORS)}")
+        checked["op"] = op
+        checked["value"] = _number(rule, "value")
+        if rule_type == "threshold" and rule.get("clear") is not None:
+            checked["clear"] = _number(rule, "clear")
+    else:
+        checked["alpha"] = _number(rule, "alpha", 0.1)
+        checked["z"] = _number(rule, "z", 3.0)
+        checked["warmup"] = int(_number(rule, "warmup", 30))
+        if not 0 < checked["alpha"] <= 1:
+            raise ValueError(f"Rule '{name}': alpha must be in (0, 1]")
+    return checked
+
+
+def state_key(rule: Dict) -> tuple:
+    """What a rule's per-device state depends on; equal keys can share state across reloads."""
+    if rule["type"] == "threshold":
+        return (rule["name"], "threshold", rule["metric"], rule["op"], rule["value"], rule["clear"])
+    if rule["type"] == "rate":
+        return (rule["name"], "rate", rule["metric"])
+    return (rule["name"], "anomaly", rule["metric"], rule["alpha"])
+
+
+def compile_rules(rules: List[Dict]) -> Program:
+    """
+    Generate and compile one evaluate() function for a list of rules.
+
+    The function takes (temperature, gas_level, humidity, timestamp, state)
+    and returns (level, fired_rule_names). Stateful rules (hysteresis, rate,
+    anomaly) keep their state in numbered slots of the per-device state list.
+    """
+    lines = [
+        "def evaluate(temperature, gas_level, humidity, timestamp, state):",
+        "    level = 0",
+        "    fired = None",
+    ]
+    initial: List[Callable[[], Any]] = []
+    keys: List[tuple] = []
+
+    for rule in rules:
+        metric = rule["metric"]
+
+        if rule["type"] == "threshold" and "clear" not in rule:
+            lines.append(f"    hit = {metric} {rule['op']} {rule['value']!r}")
+
+        elif rule["type"] == "threshold":
+            # Hysteresis: once active, stay active until the clear level is crossed
+            slot = len(initial)
+            initial.append(lambda: False)
+            keys.append(state_key(rule))
+            lines += [
+                f"    if state[{slot}]:",
+                f"        hit = state[{slot}] = {metric} {rule['op']} {rule['clear']!r}",
+                "    else:",
+                f"        hit = state[{slot}] = {metric} {rule['op']} {rule['value']!r}",
+            ]
+
+        elif rule["type"] == "rate":
+            slot = len(initial)
+            initial.append(lambda: None)
+            keys.append(state_key(rule))
+            # A late reading (older than the last one) is not a new baseline
+            lines += [
+                f"    previous = state[{slot}]",
+                "    hit = (previous is not None and timestamp > previous[1] and",
+                f"           ({metric} - previous[0]) / (timestamp - previous[1])"
+                f" {rule['op']} {rule['value']!r})",
+                "    if previous is None or timestamp >= previous[1]:",
+                f"        state[{slot}] = ({metric}, timestamp)",
+            ]
+
+        else:
+            # EWMA anomaly: state is [count, mean, variance]
+            slot = len(initial)
+            initial.append(lambda: [0, 0.0, 0.0])
+            keys.append(state_key(rule))
+            alpha = rule["alpha"]
+            lines += [
+                f"    ewma = state[{slot}]",
+                f"    if ewma[0] >= {rule['warmup']!r} and ewma[2] > 0.0:",
+                f"        hit = abs({metric} - ewma[1]) > {rule['z']!r} * sqrt(ewma[2])",
+                "    else:",
+                "        hit = False",
+                "    if ewma[0] == 0:",
+                f"        ewma[1] = float({metric})",
+                f"    diff = {metric} - ewma[1]",
+                f"    ewma[1] += {alpha!r} * diff",
+                f"    ewma[2] = {1 - alpha!r} * (ewma[2] + {alpha!r} * diff * diff)",
+                "    ewma[0] += 1",
+            ]
+
+        level = STATUS_LEVELS[rule["status"]]
+        lines += [
+            "    if hit:",
+            "        if fired is None:",
+            "            fired = []",
+            # Names only ever appear as string literals, never as raw source
+            f"        fired.append({rule['name']!r})",
+            f"        if level < {level}:",
+            f"            level = {level}",
+        ]
+
+    lines.append("    return level, fired")
+    namespace: Dict[str, Any] = {"sqrt": math.sqrt}
+    try:
+        code = compile("\n".join(lines), "<rules>", "exec")
+    except SyntaxError as e:
+        raise ValueError(f"Rules did not compile: {e}") from e
+    exec(code, namespace)
+    return namespace["evaluate"], lambda: [make() for make in initial], tuple(keys)
+
+
+class RuleEngine:
+    """Compiled rules with per-device programs and per-device state."""
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = [validate_rule(rule) for rule in rules]
+        global_rules = [rule for rule in self.rules if rule["devices"] is None]
+        self.default_program = compile_rules(global_rules)
+
+        # Devices named by any rule get their own program
+        device_rules: Dict[str, Dict[str, Dict]] = {}
+        for rule in self.rules:
+            for device_id in rule["devices"] or ():
+                device_rules.setdefault(device_id, {})[rule["name"]] = rule
+        self.device_programs: Dict[str, Program] = {}
+        for device_id, overrides in device_rules.items():
+            merged = [overrides.pop(rule["name"], rule) for rule in global_rules]
+            self.device_programs[device_id] = compile_rules(merged + list(overrides.values()))
+
+        self.states: Dict[str, list] = {}
+
+    def evaluate(self, device_id: str, temperature: float, gas_level: int,
+                 humidity: float, timestamp: float) -> Tuple[str, Optional[List[str]]]:
+        """Status for a reading plus the names of the rules that fired (or None)."""
+        evaluate, make_state, _ = self.device_programs.get(device_id, self.default_program)
+        state = self.states.get(device_id)
+        if state is None:
+            state = self.states[device_id] = make_state()
+        level, fired = evaluate(temperature, gas_level, humidity, timestamp, state)
+        return STATUS_NAMES[level], fired
+
+    def adopt_state(self, previous: "RuleEngine"):
+        """Take over per-device state from the engine being replaced, rule by rule."""
+        for device_id, old_state in previous.states.items():
+            old_keys = previous.device_programs.get(device_id, previous.default_program)[2]
+            old_slots = dict(zip(old_keys, old_state))
+            _, make_state, keys = self.device_programs.get(device_id, self.default_program)
+            state = make_state()
+            for slot, key in enumerate(keys):
+                if key in old_slots:
+                    state[slot] = old_slots[key]
+            self.states[device_id] = state
+
+
+def load_rules(path: str = RULES_FILE) -> RuleEngine:
+    """Build an engine from a rules file, or the built-in defaults if it is missing."""
+    if not os.path.exists(path):
+        return RuleEngine(DEFAULT_RULES)
+    with open(path) as f:
+        config = json.load(f)
+    rules = config.get("rules") if isinstance(config, dict) else None
+    if not isinstance(rules, list):
+        raise ValueError(f"{path}: expected an object with a 'rules' list")
+    return RuleEngine(rules)
@@ -0,0 +1,246 @@
+"""
+Multi-Port Serial Gateway for SmartSense Safety Monitoring System
+Reads every sensor board attached to this PC in one process and forwards all
+readings to the backend through a single shared uplink.
+
+Usage:
+    python serial_gateway.py                     # every port that looks like an Arduino
+    python serial_gateway.py COM3 COM4           # only these ports
+    GATEWAY_PORTS=/dev/ttyUSB0,/dev/ttyUSB1 python serial_gateway.py
+
+All ports are read by one thread: on Linux/macOS a selector wakes it only
+when some port has data, so idle boards cost nothing; where serial handles
+cannot be selected (Windows) ports are polled on a short tick instead.
+Ports are rescanned periodically, so boards can be plugged in and removed
+while the gateway runs.
+
+Each reading is tagged with a device ID: the GATEWAY_DEVICE_IDS mapping if
+given (e.g. "COM3=line-1,COM4=line-2"), else the board's USB serial number,
+else the port name.
+
+With CAPTURE=true every raw line is also recorded, tagged with its device
+ID, to captures/ for replay.py (see capture.py).
+"""
+
+import os
+import re
+import selectors
+import sys
+import time
+from typing import Dict, List, Optional
+
+import serial
+import serial.tools.list_ports
+
+from arduino_reader import SensorLineParser, SerialLineReader, is_arduino_port
+from capture import CaptureWriter, open_capture
+from uplink import Uplink
+
+GATEWAY_BAUD = int(os.getenv("GATEWAY_BAUD", "115200"))
+
+# Comma-separated ports to read; empty means every port that looks like an Arduino
+GATEWAY_PORTS = [p.strip() for p in os.getenv("GATEWAY_PORTS", "").split(",") if p.strip()]
+
+# "PORT=device-id" pairs, comma-separated
+GATEWAY_DEVICE_IDS = dict(
+    pair.split("=", 1) for pair in os.getenv("GATEWAY_DEVICE_IDS", "").split(",") if "=" in pair
+)
+
+# Seconds between scans for plugged / unplugged boards
+GATEWAY_SCAN_INTERVAL = float(os.getenv("GATEWAY_SCAN_INTERVAL", "2"))
+
+# Seconds between status lines
+GATEWAY_REPORT_INTERVAL = float(os.getenv("GATEWAY_REPORT_INTERVAL", "10"))
+
+# Poll tick for ports that cannot be registered with a selector
+POLL_INTERVAL = 0.01
+
+MAX_DEVICE_ID = 32
+
+
+def make_device_id(name: str) -> str:
+    """A backend-valid device ID (letters, digits, _ . : -) from a port or serial number."""
+    name = name.rsplit("/", 1)[-1]
+    return re.sub(r"[^A-Za-z0-9_.:-]", "-", name)[:MAX_DEVICE_ID] or "serial"
+
+
+class Board:
+    """One open serial port with its own line buffer and cached line format."""
+
+    def __init__(self, port: str, device_id: str, connection: serial.Serial):
+        self.port = port
+        self.device_id = device_id
+        self.connection = connection
+        self.reader = SerialLineReader(connection)
+        self.parser = SensorLineParser()
+        self.readings = 0
+
+
+class SerialGateway:
+    """Reads many serial ports from a single loop and forwards readings to one uplink."""
+
+    def __init__(self, uplink: Uplink, ports: Optional[List[str]] = None,
+                 baud: int = GATEWAY_BAUD, device_ids: Optional[Dict[str, str]] = None,
+                 scan_interval: float = GATEWAY_SCAN_INTERVAL,
+                 capture: Optional[CaptureWriter] = None):
+        self.uplink = uplink
+        self.capture = capture
+        self.configured = list(ports or [])
+        self.baud = baud
+        self.device_ids = dict(device_ids or {})
+        self.scan_interval = scan_interval
+        self.selector = selectors.DefaultSelector()
+        self.boards: Dict[str, Board] = {}
+        # Boards whose handles the selector cannot watch
+        self.polled: List[Board] = []
+        self.readings = 0
+
+    def wanted_ports(self) -> Dict[str, Optional[str]]:
+        """Ports to read, mapped to the board's USB serial number when known."""
+        found = {port.device: port for port in serial.tools.list_ports.comports()}
+        if self.configured:
+            return {
+                name: getattr(found.get(name), "serial_number", None)
+                for name in self.configured
+            }
+        return {
+            name: port.serial_number for name, port in found.items() if is_arduino_port(port)
+        }
+
+    def scan(self):
+        """Open newly attached boards and close ones that disappeared."""
+        wanted = self.wanted_ports()
+        for port in list(self.boards):
+            if port not in wanted and not self.configured:
+                self.close(self.boards[port], "unplugged")
+
+        for port, serial_number in wanted.items():
+            if port in self.boards:
+                continue
+            try:
+                # timeout=0: reads return whatever is buffered, never block
+                connection = serial.Serial(port, self.baud, timeout=0)
+            except (serial.SerialException, OSError):
+                continue  # Not present (yet), or busy; retried on the next scan
+            device_id = self.device_ids.get(port) or make_device_id(serial_number or port)
+            board = Board(port, device_id, connection)
+            self.boards[port] = board
+            try:
+                self.selector.register(connection.fileno(), selectors.EVENT_READ, board)
+            except (AttributeError, ValueError, OSError):
+                self.polled.append(board)
+            print(f"✅ Opened {port} as device '{device_id}' ({len(self.boards)} boards)")
+
+    def close(self, board: Board, reason: str):
+        if self.boards.pop(board.port, None) is None:
+            return
+        if board in self.polled:
+            self.polled.remove(board)
+        else:
+            try:
+                self.selector.unregister(board.connection.fileno())
+            except (KeyError, ValueError, OSError):
+                pass
+        try:
+            board.connection.close()
+        except (serial.SerialException, OSError):
+            pass
+        print(f"🔌 Closed {board.port} ({reason}, {len(self.boards)} boards)")
+
+    def read(self, board: Board):
+        """Forward every complete reading buffered on a board's port."""
+        try:
+            lines = board.reader.read_lines()
+        except (serial.SerialException, OSError) as e:
+            self.close(board, f"read failed: {e}")
+            return
+        submit = self.uplink.submit
+        parse = board.parser.parse
+        if self.capture:
+            for line in lines:
+                if line:
+                    self.capture.record("serial", line, device=board.device_id)
+        for line in lines:
+            data = parse(line)
+            if data is not None:
+                data["device_id"] = board.device_id
+                submit(data)
+                board.readings += 1
+                self.readings += 1
+
+    def poll_once(self, timeout: float):
+        """Wait up to `timeout` for data on any port and process it."""
+        if self.selector.get_map():
+            for key, _ in self.selector.select(timeout if not self.polled else 0):
+                self.read(key.data)
+        if self.polled:
+            time.sleep(POLL_INTERVAL)
+            for board in list(self.polled):
+                try:
+                    waiting = board.connection.in_waiting
+                except (serial.SerialException, OSError) as e:
+                    self.close(board, f"read failed: {e}")
+                    continue
+                if waiting:
+                    self.read(board)
+        elif not self.selector.get_map():
+            time.sleep(timeout)
+
+    def run(self):
+        """Read until interrupted, rescanning ports and reporting periodically."""
+        next_scan = 0.0
+        next_report = time.monotonic() + GATEWAY_REPORT_INTERVAL
+        reported = 0
+        while True:
+            now = time.monotonic()
+            if now >= next_scan:
+                self.scan()
+                next_scan = now + self.scan_interval
+            if now >= next_report:
+                rate = (self.readings - reported) / GATEWAY_REPORT_INTERVAL
+                reported = self.readings
+                next_report = now + GATEWAY_REPORT_INTERVAL
+                print(f"📊 {len(self.boards)} boards, {rate:,.1f} readings/s | uplink: "
+                      f"{self.uplink.sent} sent, {len(self.uplink.spool)} spooled")
+            self.poll_once(max(0.0, min(next_scan, next_report) - time.monotonic()))
+
+    def stop(self):
+        for board in list(self.boards.values()):
+            self.close(board, "gateway stopped")
+        self.selector.close()
+
+
+def main():
+    """Run the gateway until Ctrl+C."""
+    print("\n" + "="*60)
+    print("🔌 SmartSense Serial Gateway - Multi-Board Streaming")
+    print("="*60 + "\n")
+
+    ports = sys.argv[1:] or GATEWAY_PORTS
+    if ports:
+        print(f"Reading configured ports: {', '.join(ports)}")
+    else:
+        print("Reading every port that looks like an Arduino (hot-plug enabled)")
+
+    uplink = Uplink()
+    uplink.start()
+    capture = open_capture("gateway")
+    if capture:
+        print(f"🎙️  Capturing raw lines to {capture.path}")
+    gateway = SerialGateway(uplink, ports, device_ids=GATEWAY_DEVICE_IDS, capture=capture)
+    print("(Press Ctrl+C to stop)\n")
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        print("\n\n🛑 Stopping gateway...")
+    finally:
+        gateway.stop()
+        uplink.stop()
+        print(f"📦 Uplink: {uplink.sent} sent, {len(uplink.spool)} spooled for next run")
+        if capture:
+            capture.stop()
+            print(f"🎙️  Captured {capture.written} lines to {capture.path}")
+
+
+if __name__ == "__main__":
+    main()
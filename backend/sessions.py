@@ -0,0 +1,263 @@
+"""
+Session (login token) storage for SmartSense.
+
+Sessions expire after a TTL. The in-memory store keeps a min-heap of expiry
+times so a background sweeper removes expired sessions without scanning every
+token, indexes tokens by user for "logout everywhere", and caps the number of
+sessions by evicting the ones closest to expiry. Lookups stay O(1).
+
+SessionStore is the interface. SqliteSessionStore implements it on a SQLite
+file so several worker processes on one host share sessions. Its calls can
+wait on the file lock, so the server runs them with run_store() on a
+dedicated thread instead of the event loop.
+"""
+
+import asyncio
+import heapq
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+# Session lifetime (seconds)
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(24 * 3600)))
+
+# Maximum live sessions; beyond this the soonest-expiring ones are evicted
+SESSION_MAX = int(os.getenv("SESSION_MAX", "100000"))
+
+# Seconds between background sweeps for expired sessions
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+
+# "memory" (one process) or "sqlite" (shared by all workers on this host)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+
+# SQLite file for shared sessions and user accounts
+SESSION_DB = os.getenv("SESSION_DB", os.path.join("data", "auth.db"))
+
+# Calls to SQLite-backed stores run here, one at a time, off the event loop
+AUTH_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="auth-db")
+
+
+async def run_store(call: Callable, *args) -> Any:
+    """
+    Call a session or user store method from async code: directly for
+    in-memory stores, on the auth DB thread for ones that block.
+    """
+    if call.__self__.blocking:
+        return await asyncio.get_running_loop().run_in_executor(AUTH_DB_EXECUTOR, call, *args)
+    return call(*args)
+
+
+class SessionStore(ABC):
+    """Interface for session backends."""
+
+    # True when calls may block on I/O (run them with run_store())
+    blocking = False
+
+    @abstractmethod
+    def create(self, token: str, session: dict):
+        """Store a session. It must include "username" and "expires_at" (epoch seconds)."""
+
+    @abstractmethod
+    def get(self, token: str) -> Optional[dict]:
+        """The session for a token, or None if unknown or expired."""
+
+    @abstractmethod
+    def delete(self, token: str) -> bool:
+        """Remove one session. Returns whether it existed."""
+
+    @abstractmethod
+    def delete_user(self, username: str) -> int:
+        """Remove every session of a user. Returns how many were removed."""
+
+    @abstractmethod
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Remove expired sessions. Returns how many were removed."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Live sessions (may lag behind other workers until the next sweep)."""
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local sessions with an expiry heap and a per-user index."""
+
+    def __init__(self, max_sessions: int = SESSION_MAX):
+        self.max_sessions = max_sessions
+        self.sessions: Dict[str, dict] = {}
+        self.by_user: Dict[str, Set[str]] = {}
+        # (expires_at, token); entries for deleted sessions are skipped lazily
+        self.expiry_heap: List[Tuple[float, str]] = []
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def create(self, token: str, session: dict):
+        while len(self.sessions) >= self.max_sessions and self._evict_one():
+            pass
+        self.sessions[token] = session
+        self.by_user.setdefault(session["username"], set()).add(token)
+        heapq.heappush(self.expiry_heap, (session["expires_at"], token))
+
+    def get(self, token: str) -> Optional[dict]:
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        if time.time() >= session["expires_at"]:
+            self._remove(token)
+            return None
+        return session
+
+    def delete(self, token: str) -> bool:
+        removed = self._remove(token) is not None
+        self._compact()
+        return removed
+
+    def delete_user(self, username: str) -> int:
+        tokens = list(self.by_user.get(username, ()))
+        for token in tokens:
+            self._remove(token)
+        self._compact()
+        return len(tokens)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, token = heapq.heappop(heap)
+            session = self.sessions.get(token)
+            if session is not None and session["expires_at"] == expires_at:
+                self._remove(token)
+                removed += 1
+        self._compact()
+        return removed
+
+    def _remove(self, token: str) -> Optional[dict]:
+        session = self.sessions.pop(token, None)
+        if session is not None:
+            tokens = self.by_user.get(session["username"])
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self.by_user[session["username"]]
+        return session
+
+    def _evict_one(self) -> bool:
+        """Evict the live session closest to expiry."""
+        heap = self.expiry_heap
+        while heap:
+            expires_at, token = heapq.heappop(heap)
+            session = self.sessions.get(token)
+            if session is not None and session["expires_at"] == expires_at:
+                self._remove(token)
+                self.evicted += 1
+                return True
+        return False
+
+    def _compact(self):
+        """Rebuild the heap once stale entries outnumber live sessions."""
+        if len(self.expiry_heap) > 2 * len(self.sessions) + 64:
+            self.expiry_heap = [
+                (session["expires_at"], token) for token, session in self.sessions.items()
+            ]
+            heapq.heapify(self.expiry_heap)
+
+
+def connect_db(path: str = SESSION_DB) -> sqlite3.Connection:
+    """Open the shared auth database (WAL mode so workers don't block each other)."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Sessions in a SQLite file shared by every worker process on the host.
+
+    Expiry and per-user lookups use indexes, so they stay cheap as the table
+    grows. The session cap is enforced by the periodic sweep, which also
+    recounts the table; len() returns that count, kept up to date with this
+    worker's own changes in between, so /metrics never runs COUNT(*).
+    """
+
+    blocking = True
+
+    def __init__(self, path: str = SESSION_DB, max_sessions: int = SESSION_MAX):
+        self.max_sessions = max_sessions
+        self.evicted = 0
+        self.db = connect_db(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username);
+            CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
+        """)
+        self.count = self._count()
+
+    def _count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def create(self, token: str, session: dict):
+        self.db.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+            (token, session["username"], session["expires_at"], json.dumps(session))
+        )
+        self.count += 1
+
+    def get(self, token: str) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT expires_at, data FROM sessions WHERE token = ?", (token,)
+        ).fetchone()
+        if row is None:
+            return None
+        if time.time() >= row[0]:
+            self.delete(token)
+            return None
+        return json.loads(row[1])
+
+    def delete(self, token: str) -> bool:
+        removed = self.db.execute("DELETE FROM sessions WHERE token = ?", (token,)).rowcount
+        self.count = max(self.count - removed, 0)
+        return removed > 0
+
+    def delete_user(self, username: str) -> int:
+        removed = self.db.execute("DELETE FROM sessions WHERE username = ?", (username,)).rowcount
+        self.count = max(self.count - removed, 0)
+        return removed
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        removed = self.db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        excess = self._count() - self.max_sessions
+        if excess > 0:
+            self.evicted += self.db.execute(
+                "DELETE FROM sessions WHERE token IN "
+                "(SELECT token FROM sessions ORDER BY expires_at LIMIT ?)", (excess,)
+            ).rowcount
+        self.count = self._count()
+        return removed
+
+
+def create_session_store(backend: str = SESSION_BACKEND) -> SessionStore:
+    """Build the session store selected by SESSION_BACKEND."""
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SqliteSessionStore()
+    raise ValueError(f"Unknown session backend '{backend}' (expected 'memory' or 'sqlite')")
@@ -1,95 +1,378 @@
 """
 Sensor Simulator for SmartSense Safety Monitoring System
-Simulates ESP32 sensor data by sending random POST requests every 2 seconds.
+Simulates a fleet of ESP32 sensors with realistic, reproducible dynamics and
+streams their readings to the backend in batches.
 
 Usage:
 1. First, start the backend server: uvicorn main:app --reload
 2. Then run this script: python simulate_sensors.py
+
+    python simulate_sensors.py                                  # one device every 2 s
+    python simulate_sensors.py --devices 5000 --period 1        # a fleet, in real time
+    python simulate_sensors.py --devices 20000 --speed 0 --duration 600   # as fast as possible
+    python simulate_sensors.py --devices 100 --duration 3600 --output day.ndjson
+    python simulate_sensors.py --devices 5000 --transport ingest          # over /ingest
+
+Readings are generated with NumPy a block of time steps at a time for every
+device at once, so thousands of devices cost little more than one:
+
+- temperature follows a mean-reverting random walk around a setpoint that
+  itself drifts slowly and follows a daily cycle
+- humidity has its own random walk, correlated with temperature (it falls
+  when a room warms up), plus shocks that share temperature's noise
+- gas level fluctuates around a per-device background; leak events ramp it
+  up for a while and then decay away
+
+The same --seed and options always produce the same readings, whatever the
+block size or speed.
 """
 
-import requests
-import random
+import argparse
+import asyncio
+import json
+import math
+import sys
 import time
+from collections import Counter
 from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
+
+import numpy as np
+import websockets
+
+from load_test import HttpConnection
+
+API_URL = "http://localhost:8000"
+
+# Temperature: stationary spread (°C) around the setpoint and how fast it reverts (s)
+TEMP_STD = 0.8
+TEMP_TIMESCALE = 300.0
+# Setpoint: slow random walk (°C spread, s) plus a daily cycle (°C amplitude)
+SETPOINT_STD = 2.0
+SETPOINT_TIMESCALE = 6 * 3600.0
+DAILY_AMPLITUDE = 2.0
+DAY = 86400.0
+
+# Humidity: % change per °C above the setpoint, spread (%), timescale (s)
+# and correlation of its shocks with temperature's
+HUMIDITY_PER_DEGREE = -1.5
+HUMIDITY_STD = 2.5
+HUMIDITY_TIMESCALE = 600.0
+HUMIDITY_CORRELATION = -0.6
+
+# Gas: background spread (PPM) and timescale (s)
+GAS_STD = 12.0
+GAS_TIMESCALE = 60.0
+
+# Leak events per device per hour; each ramps at LEAK_RAMP PPM/s for
+# LEAK_DURATION seconds, then decays with a LEAK_DECAY second time constant
+LEAK_RATE = 0.05
+LEAK_RAMP = (2.0, 15.0)
+LEAK_DURATION = (30.0, 240.0)
+LEAK_DECAY = 120.0
+
+# Time steps generated per NumPy block
+BLOCK_STEPS = 32
+
+# Seconds between progress lines for large fleets
+REPORT_INTERVAL = 10.0
+
+STATUS_EMOJI = {"SAFE": "✅", "WARNING": "⚠️", "DANGER": "🚨"}
+
+
+def reversion(timescale: float, dt: float, std: float) -> Tuple[float, float]:
+    """Exact discretization of a mean-reverting walk: (decay per step, shock scale)."""
+    decay = math.exp(-dt / timescale)
+    return decay, std * math.sqrt(1 - decay * decay)
+
+
+class FleetSimulator:
+    """Seeded sensor dynamics for many devices, generated in blocks of time steps."""
+
+    def __init__(self, devices: int, period: float = 2.0, seed: int = 42,
+                 leak_rate: float = LEAK_RATE, prefix: str = "sim"):
+        self.devices = devices
+        self.period = period
+        self.leak_probability = leak_rate * period / 3600
+        self.device_ids = [f"{prefix}-{i:05d}" for i in range(devices)]
+        # Separate streams, so each step draws the same numbers whatever the block size
+        setup, self.noise, self.events = (
+            np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(3)
+        )
+
+        # Each device's character
+        self.temp_base = setup.uniform(21.0, 29.0, devices)
+        self.humidity_base = setup.uniform(40.0, 60.0, devices)
+        self.gas_base = setup.uniform(120.0, 220.0, devices)
+        self.phase = setup.uniform(0.0, 2 * math.pi, devices)
+
+        # State
+        self.setpoint = np.zeros(devices)  # Offset from temp_base
+        self.temperature = self.temp_base.copy()
+        self.humidity = self.humidity_base.copy()
+        self.gas = self.gas_base.copy()
+        self.leak = np.zeros(devices)        # PPM added by a leak
+        self.leak_ramp = np.zeros(devices)   # PPM/s while ramping
+        self.leak_left = np.zeros(devices)   # Seconds of ramp remaining
+        self.step = 0
+        self.elapsed = 0.0
+
+        dt = period
+        self.setpoint_walk = reversion(SETPOINT_TIMESCALE, dt, SETPOINT_STD)
+        self.temp_walk = reversion(TEMP_TIMESCALE, dt, TEMP_STD)
+        self.humidity_walk = reversion(HUMIDITY_TIMESCALE, dt, HUMIDITY_STD)
+        self.gas_walk = reversion(GAS_TIMESCALE, dt, GAS_STD)
+        self.leak_decay = math.exp(-dt / LEAK_DECAY)
+
+    def block(self, steps: int = BLOCK_STEPS) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Advance `steps` periods. Returns sim times (steps,) and temperature,
+        gas_level and humidity arrays of shape (steps, devices), as the
+        sensors report them (0.1 °C, whole PPM, 0.1 %).
+        """
+        n, dt = self.devices, self.period
+        shocks = self.noise.standard_normal((steps, 4, n))
+        # One draw per step and device, laid out so block boundaries do not matter
+        events = self.events.random((steps, 3, n))
+        leak_starts = events[:, 0] < self.leak_probability
+        leak_ramps = LEAK_RAMP[0] + (LEAK_RAMP[1] - LEAK_RAMP[0]) * events[:, 1]
+        leak_durations = LEAK_DURATION[0] + (LEAK_DURATION[1] - LEAK_DURATION[0]) * events[:, 2]
+
+        times = dt * np.arange(self.step + 1, self.step + steps + 1)
+        temperature = np.empty((steps, n))
+        humidity = np.empty((steps, n))
+        gas = np.empty((steps, n))
+        mix = math.sqrt(1 - HUMIDITY_CORRELATION ** 2)
+        for k in range(steps):
+            z_setpoint, z_temp, z_humidity, z_gas = shocks[k]
+            decay, scale = self.setpoint_walk
+            self.setpoint = self.setpoint * decay + scale * z_setpoint
+            daily = DAILY_AMPLITUDE * np.sin(2 * math.pi * times[k] / DAY + self.phase)
+            target = self.temp_base + self.setpoint + daily
 
-API_URL = "http://localhost:8000/data"
-
-
-def generate_sensor_data():
-    """Generate realistic sensor readings with occasional spikes."""
-    
-    # Base values for normal operation
-    base_temp = 28 + random.random() * 10  # 28-38°C normally
-    base_gas = 150 + random.random() * 100  # 150-250 PPM normally
-    base_humidity = 40 + random.random() * 30  # 40-70% humidity
-    
-    # 10% chance of warning levels, 5% chance of danger levels
-    spike = random.random()
-    
-    if spike > 0.95:
-        # Danger scenario
-        temperature = 46 + random.random() * 10  # 46-56°C
-        gas_level = 510 + random.random() * 100  # 510-610 PPM
-        print("⚠️  SIMULATING DANGER SCENARIO")
-    elif spike > 0.85:
-        # Warning scenario
-        temperature = 36 + random.random() * 8  # 36-44°C
-        gas_level = 310 + random.random() * 150  # 310-460 PPM
-        print("⚡ SIMULATING WARNING SCENARIO")
-    else:
-        # Normal operation
-        temperature = base_temp
-        gas_level = base_gas
-    
-    return {
-        "temperature": round(temperature, 1),
-        "gas_level": int(gas_level),
-        "humidity": round(base_humidity, 1)
-    }
-
-
-def send_data(data):
-    """Send sensor data to the backend API."""
+            decay, scale = self.temp_walk
+            self.temperature = target + (self.temperature - target) * decay + scale * z_temp
+
+            decay, scale = self.humidity_walk
+            target = self.humidity_base + HUMIDITY_PER_DEGREE * (self.temperature - self.temp_base)
+            z_humidity = HUMIDITY_CORRELATION * z_temp + mix * z_humidity
+            self.humidity = target + (self.humidity - target) * decay + scale * z_humidity
+
+            decay, scale = self.gas_walk
+            self.gas = self.gas_base + (self.gas - self.gas_base) * decay + scale * z_gas
+
+            # Leaks: start only on devices without one ramping; ramp, then decay
+            new = leak_starts[k] & (self.leak_left <= 0)
+            if new.any():
+                self.leak_ramp = np.where(new, leak_ramps[k], self.leak_ramp)
+                self.leak_left = np.where(new, leak_durations[k], self.leak_left)
+            ramping = self.leak_left > 0
+            self.leak = np.where(ramping, self.leak + self.leak_ramp * np.minimum(dt, self.leak_left),
+                                 self.leak * self.leak_decay)
+            self.leak_left = np.maximum(self.leak_left - dt, 0.0)
+
+            temperature[k] = self.temperature
+            humidity[k] = self.humidity
+            gas[k] = self.gas + self.leak
+
+        self.step += steps
+        self.elapsed = float(times[-1])
+        return (times, np.round(temperature, 1), np.rint(np.maximum(gas, 0)).astype(np.int64),
+                np.round(np.clip(humidity, 0, 100), 1))
+
+    def encode(self, temperature: np.ndarray, gas: np.ndarray, humidity: np.ndarray) -> List[str]:
+        """One time step as /data JSON objects, one per device."""
+        return [
+            f'{{"device_id":"{device}","temperature":{t},"gas_level":{g},"humidity":{h}}}'
+            for device, t, g, h in zip(self.device_ids, temperature.tolist(),
+                                       gas.tolist(), humidity.tolist())
+        ]
+
+
+class Sender:
+    """Streams batches to /data/batch or /ingest over a few connections."""
+
+    def __init__(self, url: str, transport: str, connections: int):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 80
+        self.transport = transport
+        self.pool: asyncio.Queue = asyncio.Queue()
+        self.connections = connections
+        self.sent = 0
+        self.failed = 0
+        self.statuses: Counter = Counter()
+
+    async def start(self):
+        for _ in range(self.connections):
+            if self.transport == "ingest":
+                connection = await websockets.connect(f"ws://{self.host}:{self.port}/ingest")
+            else:
+                connection = HttpConnection(self.host, self.port)
+            self.pool.put_nowait(connection)
+
+    async def stop(self):
+        while not self.pool.empty():
+            connection = self.pool.get_nowait()
+            if self.transport == "ingest":
+                await connection.close()
+            else:
+                connection.close()
+
+    async def send(self, lines: List[str]) -> Optional[List[dict]]:
+        """Send one batch; returns per-reading results when the transport gives them."""
+        connection = await self.pool.get()
+        try:
+            if self.transport == "ingest":
+                await connection.send("[" + ",".join(lines) + "]")
+                ack = json.loads(await connection.recv())
+                self.sent += ack.get("accepted", 0)
+                self.failed += ack.get("rejected", len(lines))
+                return None
+            status, body = await connection.request(
+                "/data/batch", "\n".join(lines).encode(), "application/x-ndjson")
+        except (OSError, asyncio.IncompleteReadError, websockets.WebSocketException) as e:
+            self.failed += len(lines)
+            print(f"❌ Batch failed: {type(e).__name__}: {e}")
+            return None
+        finally:
+            self.pool.put_nowait(connection)
+        if status != 200:
+            self.failed += len(lines)
+            print(f"❌ Error: Server returned {status}")
+            return None
+        results = json.loads(body)["results"]
+        self.sent += len(results)
+        self.statuses.update(result["status"] for result in results if result["accepted"])
+        return results
+
+
+def print_step(lines: List[str], results: Optional[List[dict]]):
+    """Per-reading output for small fleets."""
+    for index, line in enumerate(lines):
+        data = json.loads(line)
+        status = results[index]["status"] if results and results[index]["accepted"] else "?"
+        print(f"{datetime.now().strftime('%H:%M:%S')} | {data['device_id']} | "
+              f"Temp: {data['temperature']:5.1f}°C | "
+              f"Gas: {data['gas_level']:4d} PPM | "
+              f"Humidity: {data['humidity']:5.1f}% | "
+              f"Status: {STATUS_EMOJI.get(status, '❓')} {status}")
+
+
+async def stream(simulator: FleetSimulator, args: argparse.Namespace):
+    """Generate blocks and send each time step on schedule (or as fast as possible)."""
+    sender = Sender(args.url, args.transport, args.connections)
     try:
-        response = requests.post(API_URL, json=data)
-        if response.status_code == 200:
-            result = response.json()
-            status_emoji = {
-                "SAFE": "✅",
-                "WARNING": "⚠️",
-                "DANGER": "🚨"
-            }.get(result["status"], "❓")
-            
-            print(f"{datetime.now().strftime('%H:%M:%S')} | "
-                  f"Temp: {data['temperature']:5.1f}°C | "
-                  f"Gas: {data['gas_level']:4d} PPM | "
-                  f"Humidity: {data['humidity']:5.1f}% | "
-                  f"Status: {status_emoji} {result['status']}")
-        else:
-            print(f"❌ Error: Server returned {response.status_code}")
-    except requests.exceptions.ConnectionError:
+        await sender.start()
+    except OSError:
         print("❌ Connection Error: Is the backend server running?")
         print("   Start it with: uvicorn main:app --reload")
-    except Exception as e:
-        print(f"❌ Error: {e}")
+        return
+    verbose = simulator.devices <= 10
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    generating = 0.0
+    generated = 0
+    last_report = start
+    reported = 0
+    try:
+        while args.duration is None or simulator.elapsed < args.duration:
+            t0 = time.perf_counter()
+            times, temperature, gas, humidity = simulator.block(args.block)
+            generating += time.perf_counter() - t0
+            for k, sim_time in enumerate(times):
+                if args.duration is not None and sim_time > args.duration:
+                    break
+                if args.speed > 0:
+                    delay = start + sim_time / args.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                t0 = time.perf_counter()
+                lines = simulator.encode(temperature[k], gas[k], humidity[k])
+                generating += time.perf_counter() - t0
+                generated += len(lines)
+                sends = [sender.send(lines[i:i + args.batch_size])
+                         for i in range(0, len(lines), args.batch_size)]
+                results = await asyncio.gather(*sends)
+                if verbose:
+                    print_step(lines, [r for batch in results if batch for r in batch] or None)
+                elif loop.time() - last_report >= REPORT_INTERVAL:
+                    now = loop.time()
+                    rate = (sender.sent - reported) / (now - last_report)
+                    reported, last_report = sender.sent, now
+                    print(f"📊 sim {sim_time:8.0f}s | {rate:10,.0f} readings/s | "
+                          f"{dict(sender.statuses)} | generator "
+                          f"{generating / generated * 1e6:.2f} us/reading")
+    finally:
+        await sender.stop()
+    elapsed = loop.time() - start
+    print(f"\n📦 {sender.sent} readings sent in {elapsed:.1f}s "
+          f"({sender.sent / elapsed if elapsed else 0:,.0f}/s), {sender.failed} failed; "
+          f"generator {generating:.2f}s CPU")
+    if sender.statuses:
+        print(f"   statuses: {dict(sender.statuses)}")
+
+
+def write_output(simulator: FleetSimulator, args: argparse.Namespace):
+    """Write readings to an NDJSON file (with sim time) instead of sending them."""
+    if args.duration is None:
+        print("❌ --output needs --duration")
+        sys.exit(2)
+    count = 0
+    start = time.perf_counter()
+    with open(args.output, "w") as f:
+        while simulator.elapsed < args.duration:
+            times, temperature, gas, humidity = simulator.block(args.block)
+            for k, sim_time in enumerate(times):
+                if sim_time > args.duration:
+                    break
+                prefix = f'{{"t":{sim_time:g},'
+                for line in simulator.encode(temperature[k], gas[k], humidity[k]):
+                    f.write(prefix + line[1:] + "\n")
+                count += simulator.devices
+    elapsed = time.perf_counter() - start
+    print(f"💾 {count} readings written to {args.output} in {elapsed:.2f}s "
+          f"({count / elapsed:,.0f}/s)")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="SmartSense fleet simulator")
+    parser.add_argument("--url", default=API_URL, help="Backend base URL")
+    parser.add_argument("--devices", type=int, default=1, help="Simulated devices")
+    parser.add_argument("--period", type=float, default=2.0, help="Seconds between readings")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (same seed, same data)")
+    parser.add_argument("--leak-rate", type=float, default=LEAK_RATE,
+                        help="Gas leak events per device per hour")
+    parser.add_argument("--duration", type=float, help="Simulated seconds (default: forever)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = real time, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Readings per batch")
+    parser.add_argument("--transport", choices=("http", "ingest"), default="http",
+                        help="POST /data/batch or the /ingest WebSocket")
+    parser.add_argument("--connections", type=int, default=4, help="Concurrent connections")
+    parser.add_argument("--block", type=int, default=BLOCK_STEPS,
+                        help="Time steps generated per block")
+    parser.add_argument("--output", help="Write NDJSON to this file instead of sending")
+    return parser.parse_args()
 
 
 def main():
-    """Main loop to continuously send simulated sensor data."""
+    """Simulate the fleet until the duration is reached or Ctrl+C."""
+    args = parse_args()
     print("=" * 70)
     print("🏭 SmartSense Sensor Simulator")
     print("=" * 70)
-    print("Sending simulated sensor data every 2 seconds...")
+    speed = "as fast as possible" if args.speed <= 0 else f"{args.speed:g}x real time"
+    print(f"{args.devices} devices, a reading every {args.period:g}s, seed {args.seed}, {speed}")
     print("Press Ctrl+C to stop\n")
-    print("-" * 70)
-    print(f"{'Time':^10} | {'Temperature':^12} | {'Gas Level':^10} | {'Humidity':^10} | Status")
-    print("-" * 70)
-    
+
+    simulator = FleetSimulator(args.devices, args.period, args.seed, args.leak_rate)
     try:
-        while True:
-            data = generate_sensor_data()
-            send_data(data)
-            time.sleep(2)
+        if args.output:
+            write_output(simulator, args)
+        else:
+            asyncio.run(stream(simulator, args))
     except KeyboardInterrupt:
         print("\n" + "=" * 70)
         print("Simulator stopped. Goodbye! 👋")
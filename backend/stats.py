@@ -0,0 +1,158 @@
+"""
+Rolling-window statistics for SmartSense.
+
+Each device keeps 1-minute, 15-minute and 1-hour windows that are updated
+incrementally as readings arrive, so /stats never scans history:
+- min/max come from monotonic deques (amortized O(1) per sample)
+- mean/stddev come from running sums of values and squares
+- time in WARNING/DANGER comes from running per-status durations
+"""
+
+import math
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+WINDOWS = (("1m", 60), ("15m", 15 * 60), ("1h", 60 * 60))
+
+METRICS = ("temperature", "gas_level", "humidity")
+
+STATUSES = ("SAFE", "WARNING", "DANGER")
+
+# (sequence, timestamp, temperature, gas_level, humidity, status)
+Sample = Tuple[int, float, float, float, float, str]
+
+
+class RollingWindow:
+    """Incrementally maintained aggregates over the last `seconds` of samples."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.samples: Deque[Sample] = deque()
+        self.sums = [0.0] * len(METRICS)
+        self.squares = [0.0] * len(METRICS)
+        # Per metric: (sequence, value) pairs, values increasing / decreasing
+        self.mins: List[Deque[Tuple[int, float]]] = [deque() for _ in METRICS]
+        self.maxs: List[Deque[Tuple[int, float]]] = [deque() for _ in METRICS]
+        # Seconds spent in each status between consecutive samples in the window
+        self.status_time = dict.fromkeys(STATUSES, 0.0)
+
+    def add(self, sample: Sample):
+        """Add a sample (samples must arrive in time order)."""
+        if self.samples:
+            previous = self.samples[-1]
+            self.status_time[previous[5]] += sample[1] - previous[1]
+        self.samples.append(sample)
+
+        sequence = sample[0]
+        for i in range(len(METRICS)):
+            value = sample[2 + i]
+            self.sums[i] += value
+            self.squares[i] += value * value
+
+            mins = self.mins[i]
+            while mins and mins[-1][1] >= value:
+                mins.pop()
+            mins.append((sequence, value))
+
+            maxs = self.maxs[i]
+            while maxs and maxs[-1][1] <= value:
+                maxs.pop()
+            maxs.append((sequence, value))
+
+        self.expire(sample[1])
+
+    def expire(self, now: float):
+        """Drop samples older than the window."""
+        cutoff = now - self.seconds
+        samples = self.samples
+        while samples and samples[0][1] < cutoff:
+            sample = samples.popleft()
+            sequence = sample[0]
+            if samples:
+                # The interval that started at this sample leaves the window too
+                self.status_time[sample[5]] -= samples[0][1] - sample[1]
+
+            for i in range(len(METRICS)):
+                value = sample[2 + i]
+                self.sums[i] -= value
+                self.squares[i] -= value * value
+                if self.mins[i] and self.mins[i][0][0] <= sequence:
+                    self.mins[i].popleft()
+                if self.maxs[i] and self.maxs[i][0][0] <= sequence:
+                    self.maxs[i].popleft()
+
+        if not samples:
+            # Reset so floating-point drift cannot accumulate forever
+            self.sums = [0.0] * len(METRICS)
+            self.squares = [0.0] * len(METRICS)
+            self.status_time = dict.fromkeys(STATUSES, 0.0)
+
+    def snapshot(self, now: float) -> Dict:
+        """Current aggregates; the newest sample's status lasts until `now`."""
+        self.expire(now)
+        count = len(self.samples)
+        result: Dict = {"count": count}
+
+        for i, metric in enumerate(METRICS):
+            if not count:
+                result[metric] = None
+                continue
+            mean = self.sums[i] / count
+            variance = max(self.squares[i] / count - mean * mean, 0.0)
+            result[metric] = {
+                "min": self.mins[i][0][1],
+                "max": self.maxs[i][0][1],
+                "mean": mean,
+                "stddev": math.sqrt(variance)
+            }
+
+        status_time = dict(self.status_time)
+        if count:
+            newest = self.samples[-1]
+            status_time[newest[5]] += max(now - newest[1], 0.0)
+        result["time_in_status"] = {
+            "WARNING": status_time["WARNING"],
+            "DANGER": status_time["DANGER"]
+        }
+        return result
+
+
+class StatsTracker:
+    """Rolling windows for every device."""
+
+    def __init__(self, windows=WINDOWS):
+        self.windows = windows
+        self.devices: Dict[str, List[RollingWindow]] = {}
+        self._sequence = 0
+
+    def add(self, device_id: str, timestamp: float, temperature: float,
+            gas_level: float, humidity: float, status: str):
+        """Feed one reading into every window of its device."""
+        windows = self.devices.get(device_id)
+        if windows is None:
+            windows = [RollingWindow(seconds) for _, seconds in self.windows]
+            self.devices[device_id] = windows
+
+        newest = windows[-1].samples
+        if newest and timestamp < newest[-1][1]:
+            return  # A late reading: the windows only take samples in time order
+
+        self._sequence += 1
+        # One tuple shared by all windows of the device
+        sample = (self._sequence, timestamp, temperature, gas_level, humidity, status)
+        for window in windows:
+            window.add(sample)
+
+    def snapshot(self, now: float, device_id: Optional[str] = None) -> Dict:
+        """Aggregates per device and window name."""
+        if device_id is not None:
+            devices = {device_id: self.devices[device_id]} if device_id in self.devices else {}
+        else:
+            devices = self.devices
+        return {
+            device: {
+                name: window.snapshot(now)
+                for (name, _), window in zip(self.windows, windows)
+            }
+            for device, windows in devices.items()
+        }
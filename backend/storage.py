@@ -0,0 +1,505 @@
+"""
+Durable storage for SmartSense sensor readings.
+
+The default engine is an append-only log split into time-based segment files.
+Readings are queued by the ingest path and written by a background thread in
+group commits (many readings per write + fsync), so disk I/O never blocks the
+event loop. Old segments are deleted once they fall out of the retention
+window. Historical reads memory-map segment files and binary-search on time.
+
+Readings normally arrive in time order, but a late one (e.g. replayed from a
+gateway's spool) is stored with its own time, not clamped. The segment it
+lands in is then marked out of order by a small sidecar file holding its
+earliest reading; reads scan such a segment linearly and sort what they
+find. A new segment only starts at or after the newest reading written, so
+every reading of a segment is older than the start of the next one.
+
+With several worker processes, one of them holds a lock on the storage
+directory and writes every reading it sees (its own plus those received over
+the worker bus); the others only read. If the writer exits, a waiting worker
+takes over.
+"""
+
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from history import STATUS_CODES
+from logger import log
+
+# Longest device ID that fits in a record (UTF-8 bytes)
+DEVICE_ID_BYTES = 32
+
+# Storage engine: "log" (segmented append-only log) or "none" (disabled)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "log")
+STORAGE_DIR = os.getenv("STORAGE_DIR", "data")
+
+# Start a new segment file after this many seconds
+SEGMENT_SECONDS = int(os.getenv("STORAGE_SEGMENT_SECONDS", "3600"))
+
+# Delete segments whose readings are all older than this (seconds)
+RETENTION_SECONDS = int(os.getenv("STORAGE_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+# Group commit: flush after this many readings or this many seconds
+COMMIT_MAX_RECORDS = int(os.getenv("STORAGE_COMMIT_MAX_RECORDS", "1000"))
+COMMIT_INTERVAL = float(os.getenv("STORAGE_COMMIT_INTERVAL", "0.05"))
+
+# Readings buffered in memory before new ones are dropped
+QUEUE_SIZE = int(os.getenv("STORAGE_QUEUE_SIZE", "100000"))
+
+# timestamp, temperature, gas_level, humidity, status code, device ID
+RECORD = struct.Struct(f"<ddqdb{DEVICE_ID_BYTES}s")
+RECORD_SIZE = RECORD.size
+
+WRITER_LOCK = "writer.lock"
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+# Sidecar of a segment holding out-of-order readings: the earliest timestamp in it
+UNORDERED_SUFFIX = ".unordered"
+
+# (timestamp, temperature, gas_level, humidity, status code, device ID)
+Record = Tuple[float, float, int, float, int, bytes]
+
+
+class StorageBackend:
+    """Interface for persistence engines behind the ingest path."""
+
+    def start(self):
+        """Start background work (called once at app startup)."""
+
+    def stop(self):
+        """Flush pending readings and stop background work."""
+
+    def append(self, record: Record):
+        """Queue one reading for durable storage. Must never block."""
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              limit: Optional[int] = None, device_id: Optional[str] = None) -> List[Record]:
+        """Stored readings in a time range, oldest first (most recent `limit`)."""
+        return []
+
+    def scan(self, start: Optional[float] = None, end: Optional[float] = None,
+             device_id: Optional[str] = None, batch_size: int = 5000) -> Iterator[List[Record]]:
+        """Every stored reading in a time range, oldest first, a batch at a time."""
+        return iter(())
+
+
+class NullStorage(StorageBackend):
+    """Storage disabled: readings live only in memory."""
+
+
+class SegmentedLogStorage(StorageBackend):
+    """Append-only log of fixed-size records split into time-based segments."""
+
+    def __init__(self, directory: str = STORAGE_DIR,
+                 segment_seconds: int = SEGMENT_SECONDS,
+                 retention_seconds: int = RETENTION_SECONDS,
+                 commit_max_records: int = COMMIT_MAX_RECORDS,
+                 commit_interval: float = COMMIT_INTERVAL,
+                 queue_size: int = QUEUE_SIZE):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.retention_seconds = retention_seconds
+        self.commit_max_records = commit_max_records
+        self.commit_interval = commit_interval
+        self.queue: "queue.Queue[Optional[Record]]" = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.commits = 0
+        self._file = None
+        self._segment_start = 0.0
+        self._segment_path = ""
+        self._high: Optional[float] = None  # Newest timestamp written (None: not read yet)
+        self._earliest: Optional[float] = None  # Set once the segment is out of order
+        self._thread: Optional[threading.Thread] = None
+        # Whether this process is the one writing (see WRITER_LOCK)
+        self.owner = False
+        self._lock_file = None
+
+    # -- Writing (background thread) -------------------------------------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.owner = self._take_writer_lock(wait=False)
+        if not self.owner:
+            log.info("💾 Another worker is writing storage; standing by")
+        self._thread = threading.Thread(
+            target=self._run, name="storage-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        if self.owner:
+            self.queue.put(None)  # Sentinel: flush and exit
+            self._thread.join()
+        self._thread = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _take_writer_lock(self, wait: bool) -> bool:
+        """Lock the directory for writing (always succeeds where flock is unavailable)."""
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self.directory, WRITER_LOCK), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except OSError:
+            return False
+        return True
+
+    def _run(self):
+        if not self.owner:
+            self._take_writer_lock(wait=True)  # Blocks until the writing worker exits
+            self.owner = True
+            log.info("💾 Took over storage writing")
+        self._writer()
+
+    def append(self, record: Record):
+        if not self.owner:
+            return  # The writing worker stores it (it gets it over the worker bus)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self):
+        """Collect readings into group commits until the stop sentinel arrives."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.commit_max_records:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+
+            if batch:
+                try:
+                    self._commit(batch)
+                except (OSError, struct.error) as e:
+                    log.error("❌ Storage write failed: %s", e)
+
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _commit(self, batch: List[Record]):
+        """Write a batch with a single write + fsync."""
+        first_timestamp = batch[0][0]
+        if self._file is None or (first_timestamp - self._segment_start >= self.segment_seconds
+                                  and first_timestamp >= self._high):
+            self._rotate(first_timestamp)
+
+        high = self._high
+        earliest = None
+        for record in batch:
+            if record[0] < high:
+                if earliest is None or record[0] < earliest:
+                    earliest = record[0]
+            else:
+                high = record[0]
+        if earliest is not None and (self._earliest is None or earliest < self._earliest):
+            # Marked before the records land, so no reader ever bisects them
+            self._earliest = earliest
+            write_marker(self._segment_path, earliest)
+        self._high = high
+
+        pack = RECORD.pack
+        self._file.write(b"".join(pack(*record) for record in batch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.written += len(batch)
+        self.commits += 1
+
+    def _rotate(self, timestamp: float):
+        """Close the current segment, open a new one and apply retention."""
+        if self._file:
+            self._file.close()
+        if self._high is None:
+            segments = self.segments()
+            self._high = segment_high(segments[-1][0]) if segments else timestamp
+        # Never before the newest reading written, which may be in the previous segment
+        timestamp = max(timestamp, self._high)
+        self._segment_start = self._high = timestamp
+        path = os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{timestamp:.6f}{SEGMENT_SUFFIX}"
+        )
+        self._segment_path = path
+        self._earliest = read_marker(path)
+        self._file = open(path, "ab")
+        self._apply_retention(timestamp)
+
+    def _apply_retention(self, now: float):
+        """Delete segments whose newest reading is past the retention window."""
+        segments = self.segments()
+        # A segment ends where the next one starts; never delete the newest
+        for (path, _), (_, next_start) in zip(segments, segments[1:]):
+            if now - next_start > self.retention_seconds:
+                try:
+                    os.remove(path)
+                    if os.path.exists(path + UNORDERED_SUFFIX):
+                        os.remove(path + UNORDERED_SUFFIX)
+                except OSError as e:
+                    log.warning("⚠️  Could not delete old segment %s: %s", path, e)
+
+    # -- Reading (memory-mapped segments) --------------------------------
+
+    def segments(self) -> List[Tuple[str, float]]:
+        """Segment files and their start times, oldest first."""
+        return [(path, start) for path, start, _ in self._catalog()]
+
+    def _catalog(self) -> List[Tuple[str, float, Optional[float]]]:
+        """
+        Segment files, their start times and, for segments holding
+        out-of-order readings, their earliest reading (None otherwise), oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        names = os.listdir(self.directory)
+        unordered = set(name for name in names if name.endswith(UNORDERED_SUFFIX))
+        segments = []
+        for name in names:
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    start = float(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                except ValueError:
+                    continue
+                path = os.path.join(self.directory, name)
+                earliest = read_marker(path) if name + UNORDERED_SUFFIX in unordered else None
+                segments.append((path, start, earliest))
+        segments.sort(key=lambda segment: segment[1])
+        return segments
+
+    @staticmethod
+    def _bisect(view: mmap.mmap, count: int, timestamp: float, right: bool) -> int:
+        """Binary-search record positions in a mapped segment by timestamp."""
+        unpack_from = RECORD.unpack_from
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = unpack_from(view, mid * RECORD_SIZE)[0]
+            if value < timestamp or (right and value == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read_segment(self, path: str, start: Optional[float], end: Optional[float],
+                      limit: Optional[int], device: Optional[bytes],
+                      ordered: bool = True) -> List[Record]:
+        """Matching records from one segment (the most recent `limit` of them)."""
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                count = size // RECORD_SIZE  # Ignore a torn trailing record
+                if count == 0:
+                    return []
+                with mmap.mmap(f.fileno(), count * RECORD_SIZE,
+                               access=mmap.ACCESS_READ) as view:
+                    if not ordered:
+                        records = unordered_records(view, start, end, device)
+                        return records[-limit:] if limit is not None else records
+                    lo = 0 if start is None else self._bisect(view, count, start, False)
+                    hi = count if end is None else self._bisect(view, count, end, True)
+                    if device is None:
+                        if limit is not None and hi - lo > limit:
+                            lo = hi - limit
+                        return list(RECORD.iter_unpack(view[lo * RECORD_SIZE:hi * RECORD_SIZE]))
+                    records = [
+                        record
+                        for record in RECORD.iter_unpack(view[lo * RECORD_SIZE:hi * RECORD_SIZE])
+                        if record[5] == device
+                    ]
+                    return records[-limit:] if limit is not None else records
+        except FileNotFoundError:
+            return []  # Removed by retention while we were reading
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              limit: Optional[int] = None, device_id: Optional[str] = None) -> List[Record]:
+        device = None if device_id is None else encode_device_id(device_id)
+        segments = self._catalog()
+        chunks = []
+        remaining = limit
+        mixed = False  # Whether an out-of-order segment was read
+        # Walk newest to oldest so `limit` stops the scan early
+        for index in range(len(segments) - 1, -1, -1):
+            path, segment_start, earliest = segments[index]
+            if end is not None and min(segment_start, earliest or segment_start) > end:
+                continue
+            if start is not None and index + 1 < len(segments) \
+                    and segments[index + 1][1] < start:
+                break
+            if earliest is None and not mixed:
+                records = self._read_segment(path, start, end, remaining, device)
+                chunks.append(records)
+                if remaining is not None:
+                    remaining -= len(records)
+                    if remaining <= 0:
+                        break
+                continue
+            # Late readings may be older than anything in earlier segments:
+            # only readings at or after this segment's start are surely settled
+            mixed = True
+            chunks.append(self._read_segment(path, start, end, limit, device, earliest is None))
+            if limit is not None and sum(
+                    1 for chunk in chunks for record in chunk if record[0] >= segment_start) >= limit:
+                break
+        records = [record for chunk in reversed(chunks) for record in chunk]
+        if mixed:
+            records.sort(key=itemgetter(0))
+            if limit is not None:
+                records = records[-limit:]
+        return records
+
+    def scan(self, start: Optional[float] = None, end: Optional[float] = None,
+             device_id: Optional[str] = None, batch_size: int = 5000) -> Iterator[List[Record]]:
+        device = None if device_id is None else encode_device_id(device_id)
+        segments = self._catalog()
+        for index, (path, segment_start, earliest) in enumerate(segments):
+            # Not a break: a later out-of-order segment may still hold earlier readings
+            if end is not None and min(segment_start, earliest or segment_start) > end:
+                continue
+            if start is not None and index + 1 < len(segments) \
+                    and segments[index + 1][1] < start:
+                continue
+            yield from self._scan_segment(path, start, end, device, batch_size, earliest is None)
+
+    def _scan_segment(self, path: str, start: Optional[float], end: Optional[float],
+                      device: Optional[bytes], batch_size: int,
+                      ordered: bool = True) -> Iterator[List[Record]]:
+        """
+        Matching records from one segment, unpacked `batch_size` at a time
+        (an out-of-order segment is read whole and sorted first).
+        """
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return  # Removed by retention
+        with f:
+            count = os.fstat(f.fileno()).st_size // RECORD_SIZE
+            if count == 0:
+                return
+            with mmap.mmap(f.fileno(), count * RECORD_SIZE, access=mmap.ACCESS_READ) as view:
+                if not ordered:
+                    records = unordered_records(view, start, end, device)
+                    for offset in range(0, len(records), batch_size):
+                        yield records[offset:offset + batch_size]
+                    return
+                lo = 0 if start is None else self._bisect(view, count, start, False)
+                hi = count if end is None else self._bisect(view, count, end, True)
+                pending: List[Record] = []
+                for offset in range(lo, hi, batch_size):
+                    records = RECORD.iter_unpack(
+                        view[offset * RECORD_SIZE:min(offset + batch_size, hi) * RECORD_SIZE])
+                    if device is None:
+                        yield list(records)
+                        continue
+                    pending.extend(record for record in records if record[5] == device)
+                    if len(pending) >= batch_size:
+                        yield pending
+                        pending = []
+                if pending:
+                    yield pending
+
+
+def write_marker(path: str, earliest: float):
+    """Mark a segment as holding out-of-order readings, the earliest at `earliest`."""
+    marker = path + UNORDERED_SUFFIX
+    with open(marker + ".tmp", "w") as f:
+        f.write(repr(earliest))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(marker + ".tmp", marker)
+
+
+def read_marker(path: str) -> Optional[float]:
+    """Earliest reading of an out-of-order segment, or None for an ordered one."""
+    try:
+        with open(path + UNORDERED_SUFFIX) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def unordered_records(view: mmap.mmap, start: Optional[float], end: Optional[float],
+                      device: Optional[bytes]) -> List[Record]:
+    """Matching records of an out-of-order segment by linear scan, sorted by time."""
+    low = float("-inf") if start is None else start
+    high = float("inf") if end is None else end
+    records = [
+        record for record in RECORD.iter_unpack(view)
+        if low <= record[0] <= high and (device is None or record[5] == device)
+    ]
+    records.sort(key=itemgetter(0))
+    return records
+
+
+def segment_high(path: str) -> float:
+    """Newest timestamp in a segment (its start when it is empty)."""
+    start = float(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+    try:
+        with open(path, "rb") as f:
+            count = os.fstat(f.fileno()).st_size // RECORD_SIZE
+            if count == 0:
+                return start
+            with mmap.mmap(f.fileno(), count * RECORD_SIZE, access=mmap.ACCESS_READ) as view:
+                if read_marker(path) is None:
+                    return max(start, RECORD.unpack_from(view, (count - 1) * RECORD_SIZE)[0])
+                return max(start, max(record[0] for record in RECORD.iter_unpack(view)))
+    except OSError:
+        return start
+
+
+def encode_device_id(device_id: str) -> bytes:
+    """Device ID as the fixed-width field stored in records (NUL padded)."""
+    return device_id.encode("utf-8")[:DEVICE_ID_BYTES].ljust(DEVICE_ID_BYTES, b"\0")
+
+
+def decode_device_id(field: bytes) -> str:
+    """Inverse of encode_device_id."""
+    return field.rstrip(b"\0").decode("utf-8", errors="replace")
+
+
+def record_to_reading(record: Record) -> Dict:
+    """Convert a stored record to the broadcast reading format."""
+    timestamp, temperature, gas_level, humidity, status, device = record
+    return {
+        "device_id": decode_device_id(device),
+        "temperature": temperature,
+        "gas_level": gas_level,
+        "humidity": humidity,
+        "status": STATUS_CODES[status],
+        "timestamp": datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+    }
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> StorageBackend:
+    """Build the storage engine selected by STORAGE_BACKEND."""
+    if backend == "log":
+        return SegmentedLogStorage()
+    if backend == "none":
+        return NullStorage()
+    raise ValueError(f"Unknown storage backend '{backend}' (expected 'log' or 'none')")
@@ -0,0 +1,369 @@
+"""
+Store-and-forward uplink from sensor readers to the SmartSense backend.
+
+The serial loop only calls Uplink.submit(), which appends to an in-memory
+queue and returns immediately. A background thread sends queued readings in
+batches to /data/batch over one keep-alive HTTP session (or, with a ws://
+URL, as frames on the persistent /ingest channel). When the backend is
+slow or down, readings spill into a bounded on-disk spool (NDJSON segment
+files) and are replayed oldest first once it is reachable again, so a backend
+outage never blocks serial reads or loses data (up to the spool limit).
+
+Each reading is stamped with the time it was submitted, so one replayed from
+the spool hours later is still stored (and judged by the alerting) as the
+reading it was.
+
+Delivery is at-least-once: a reading sent just before a crash may be sent
+again after restart.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import requests
+from websockets.exceptions import WebSocketException
+from websockets.sync.client import connect as ws_connect
+
+# POST endpoint, or the persistent channel (e.g. ws://localhost:8000/ingest)
+UPLINK_URL = os.getenv("UPLINK_URL", "http://localhost:8000/data/batch")
+
+# Readings per POST, and how long to wait for a batch to fill (seconds)
+UPLINK_BATCH_SIZE = int(os.getenv("UPLINK_BATCH_SIZE", "200"))
+UPLINK_LINGER = float(os.getenv("UPLINK_LINGER", "0.2"))
+
+# (connect, read) timeouts for each POST (seconds)
+UPLINK_TIMEOUT = (float(os.getenv("UPLINK_CONNECT_TIMEOUT", "3")),
+                  float(os.getenv("UPLINK_READ_TIMEOUT", "10")))
+
+# Readings held in memory before the oldest are dropped (the spool is the buffer)
+UPLINK_MEMORY_LIMIT = int(os.getenv("UPLINK_MEMORY_LIMIT", "10000"))
+
+UPLINK_SPOOL_DIR = os.getenv("UPLINK_SPOOL_DIR", "spool")
+
+# Readings kept on disk while the backend is unreachable; oldest dropped beyond this
+UPLINK_SPOOL_MAX = int(os.getenv("UPLINK_SPOOL_MAX", "1000000"))
+
+# Retry backoff after a failed send (seconds)
+UPLINK_RETRY_MIN = 0.5
+UPLINK_RETRY_MAX = 30.0
+
+SPOOL_SEGMENT_RECORDS = 10000
+SPOOL_PREFIX = "spool-"
+SPOOL_SUFFIX = ".ndjson"
+SPOOL_OFFSET_FILE = "offset"
+
+
+class DiskSpool:
+    """
+    Bounded FIFO of readings on disk, split into NDJSON segment files.
+
+    Readings are appended to the newest segment and read from the oldest one.
+    The position reached in the oldest segment is kept in a small offset file
+    so replay resumes where it stopped after a restart.
+    """
+
+    def __init__(self, directory: str = UPLINK_SPOOL_DIR, max_records: int = UPLINK_SPOOL_MAX,
+                 segment_records: int = SPOOL_SEGMENT_RECORDS):
+        self.directory = directory
+        self.max_records = max_records
+        self.segment_records = segment_records
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        # (sequence, records in file) oldest first
+        self.segments: Deque[List[int]] = deque()
+        for name in sorted(os.listdir(directory)):
+            if name.startswith(SPOOL_PREFIX) and name.endswith(SPOOL_SUFFIX):
+                sequence = int(name[len(SPOOL_PREFIX):-len(SPOOL_SUFFIX)])
+                self.segments.append([sequence, self._count_lines(self._path(sequence))])
+        # An offset past the end of its segment (a stale offset file) re-sends nothing
+        self.offset = min(self._load_offset(), self.segments[0][1] if self.segments else 0)
+        self._head: Optional[List[str]] = None  # Cached lines of the oldest segment
+
+    def _path(self, sequence: int) -> str:
+        return os.path.join(self.directory, f"{SPOOL_PREFIX}{sequence:012d}{SPOOL_SUFFIX}")
+
+    @staticmethod
+    def _count_lines(path: str) -> int:
+        """Count complete readings, trimming a line torn by a crash mid-write."""
+        with open(path, "rb+") as f:
+            data = f.read()
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                f.truncate(complete)
+            return data.count(b"\n")
+
+    def _load_offset(self) -> int:
+        try:
+            with open(os.path.join(self.directory, SPOOL_OFFSET_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _save_offset(self):
+        path = os.path.join(self.directory, SPOOL_OFFSET_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(self.offset))
+        os.replace(path + ".tmp", path)
+
+    def __len__(self) -> int:
+        return sum(count for _, count in self.segments) - (self.offset if self.segments else 0)
+
+    def append(self, readings: List[Dict]):
+        """Add readings at the tail, dropping the oldest segment when full."""
+        while readings:
+            if not self.segments or self.segments[-1][1] >= self.segment_records:
+                sequence = self.segments[-1][0] + 1 if self.segments else 0
+                self.segments.append([sequence, 0])
+            tail = self.segments[-1]
+            room = self.segment_records - tail[1]
+            chunk, readings = readings[:room], readings[room:]
+            with open(self._path(tail[0]), "a") as f:
+                f.write("".join(json.dumps(reading) + "\n" for reading in chunk))
+                f.flush()
+                os.fsync(f.fileno())
+            tail[1] += len(chunk)
+            if tail is self.segments[0]:
+                self._head = None  # Cached head lines are stale
+
+        while len(self.segments) > 1 and len(self) > self.max_records:
+            self.dropped += self.segments[0][1] - self.offset
+            self._remove_head()
+
+    def peek(self, limit: int) -> List[Dict]:
+        """Up to `limit` of the oldest readings (from a single segment)."""
+        if not self.segments:
+            return []
+        if self._head is None:
+            try:
+                with open(self._path(self.segments[0][0])) as f:
+                    self._head = [line for line in f if line.endswith("\n")]
+            except FileNotFoundError:
+                self._head = []
+        return [json.loads(line) for line in self._head[self.offset:self.offset + limit]]
+
+    def commit(self, count: int):
+        """Mark the first `count` peeked readings as delivered."""
+        self.offset += count
+        if self.offset >= self.segments[0][1]:
+            self._remove_head()
+        else:
+            self._save_offset()
+
+    def skip_head(self):
+        """Give up on the rest of the oldest segment (it holds fewer readings than recorded)."""
+        self.dropped += max(self.segments[0][1] - self.offset, 0)
+        self._remove_head()
+
+    def _remove_head(self):
+        # Reset the offset first: a crash in between re-sends rather than skips
+        self.offset = 0
+        self._head = None
+        self._save_offset()
+        sequence, _ = self.segments.popleft()
+        try:
+            os.remove(self._path(sequence))
+        except FileNotFoundError:
+            pass
+
+
+class Uplink:
+    """Background sender with batching, keep-alive and a disk spool for outages."""
+
+    def __init__(self, url: str = UPLINK_URL, batch_size: int = UPLINK_BATCH_SIZE,
+                 linger: float = UPLINK_LINGER, memory_limit: int = UPLINK_MEMORY_LIMIT,
+                 spool: Optional[DiskSpool] = None,
+                 timeout: Tuple[float, float] = UPLINK_TIMEOUT):
+        self.url = url
+        self.batch_size = batch_size
+        self.linger = linger
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.spool = spool if spool is not None else DiskSpool()
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json"
+        self._channel = None  # WebSocket connection when the URL is ws://
+        self.pending: Deque[Dict] = deque()
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.online = True
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    # -- Called from the reader ------------------------------------------
+
+    def submit(self, reading: Dict):
+        """Queue a reading for upload. Never blocks on the network or disk."""
+        reading.setdefault("timestamp", time.time())
+        with self.condition:
+            if len(self.pending) >= self.memory_limit:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(reading)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="uplink", daemon=True)
+        self._thread.start()
+        if len(self.spool):
+            print(f"📦 {len(self.spool)} spooled readings will be replayed")
+
+    def stop(self):
+        """Try to flush what is queued, then spool the rest to disk."""
+        if self._thread is None:
+            return
+        self._running = False
+        with self.condition:
+            self.condition.notify()
+        # Long enough for an in-flight POST to finish or time out
+        self._thread.join()
+        self._thread = None
+        with self.condition:
+            leftover = list(self.pending)
+            self.pending.clear()
+        if leftover:
+            self.spool.append(leftover)
+            print(f"💾 Spooled {len(leftover)} unsent readings to disk")
+        self.session.close()
+        self._close_channel()
+
+    # -- Sender thread ---------------------------------------------------
+
+    def _take_batch(self) -> List[Dict]:
+        """Wait up to `linger` for a full batch, then take what is queued."""
+        with self.condition:
+            if len(self.pending) < self.batch_size and self._running:
+                self.condition.wait(self.linger)
+            count = min(len(self.pending), self.batch_size)
+            return [self.pending.popleft() for _ in range(count)]
+
+    def _offline(self, reason: str) -> bool:
+        if self.online:
+            print(f"❌ {reason}, spooling readings to disk")
+        self.online = False
+        return False
+
+    def _delivered(self, batch: List[Dict], rejected: int) -> bool:
+        self.rejected += rejected
+        self.sent += len(batch)
+        if not self.online:
+            print("✅ Backend reachable again")
+        self.online = True
+        return True
+
+    def _send(self, batch: List[Dict]) -> bool:
+        """Send one batch. True if the backend took it (even with rejected items)."""
+        if self.url.startswith(("ws://", "wss://")):
+            return self._send_frame(batch)
+        return self._post(batch)
+
+    def _post(self, batch: List[Dict]) -> bool:
+        """Send a batch as one POST to /data/batch."""
+        try:
+            response = self.session.post(self.url, data=json.dumps(batch), timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            return self._offline(f"Backend unreachable ({type(e).__name__})")
+
+        if response.status_code >= 500 or response.status_code == 429:
+            return self._offline(f"Backend error {response.status_code}")
+
+        if response.status_code != 200:
+            # Malformed for this backend; retrying would never succeed
+            print(f"⚠️  Backend refused batch ({response.status_code}): {response.text[:200]}")
+            self.rejected += len(batch)
+            return True
+
+        try:
+            rejected = int(response.json().get("rejected", 0))
+        except (ValueError, TypeError, AttributeError):
+            # Not our backend's reply (a proxy's page?): keep the batch and back off
+            return self._offline("Backend sent an unreadable reply")
+        return self._delivered(batch, rejected)
+
+    def _send_frame(self, batch: List[Dict]) -> bool:
+        """Send a batch as one frame on the persistent /ingest channel and await its ack."""
+        try:
+            if self._channel is None:
+                self._channel = ws_connect(self.url, open_timeout=self.timeout[0])
+            self._channel.send(json.dumps(batch))
+            reply = json.loads(self._channel.recv(timeout=self.timeout[1]))
+        except (OSError, TimeoutError, ValueError, WebSocketException) as e:
+            self._close_channel()
+            return self._offline(f"Ingest channel down ({type(e).__name__})")
+
+        if not isinstance(reply, dict):
+            self._close_channel()
+            return self._offline("Backend sent an unreadable reply")
+        if reply.get("type") != "ack":
+            print(f"⚠️  Backend refused batch: {reply.get('detail')}")
+            self.rejected += len(batch)
+            return True
+        try:
+            rejected = int(reply.get("rejected", 0))
+        except (ValueError, TypeError):
+            self._close_channel()
+            return self._offline("Backend sent an unreadable reply")
+        return self._delivered(batch, rejected)
+
+    def _close_channel(self):
+        if self._channel is not None:
+            try:
+                self._channel.close()
+            except (OSError, WebSocketException):
+                pass
+            self._channel = None
+
+    def _run(self):
+        delay = UPLINK_RETRY_MIN
+        while True:
+            if len(self.spool):
+                # Replay oldest first; new readings queue behind the spool
+                with self.condition:
+                    backlog = list(self.pending)
+                    self.pending.clear()
+                if backlog:
+                    self.spool.append(backlog)
+                batch = self.spool.peek(self.batch_size)
+                if not batch:
+                    # Lost or cut short outside our control; move on to the next segment
+                    print("⚠️  Spool segment is shorter than recorded, skipping the rest of it")
+                    self.spool.skip_head()
+                    continue
+                if self._send(batch):
+                    self.spool.commit(len(batch))
+                    delay = UPLINK_RETRY_MIN
+                    if not len(self.spool):
+                        print("✅ Spool replayed")
+                    continue
+            else:
+                batch = self._take_batch()
+                if not batch:
+                    if not self._running:
+                        return
+                    continue
+                if self._send(batch):
+                    delay = UPLINK_RETRY_MIN
+                    continue
+                self.spool.append(batch)
+
+            if not self._running:
+                return
+            # Back off, keeping new readings on disk rather than in memory
+            deadline = time.monotonic() + delay
+            while self._running and time.monotonic() < deadline:
+                with self.condition:
+                    self.condition.wait(min(1.0, deadline - time.monotonic()))
+                    backlog = list(self.pending)
+                    self.pending.clear()
+                if backlog:
+                    self.spool.append(backlog)
+            delay = min(delay * 2, UPLINK_RETRY_MAX)
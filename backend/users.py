@@ -0,0 +1,96 @@
+"""
+User accounts for SmartSense.
+
+MemoryUserStore keeps accounts in the process (demo default). With several
+worker processes, SqliteUserStore keeps them in the shared auth database so
+an account created through one worker can log in through any other.
+"""
+
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+from sessions import SESSION_BACKEND, SESSION_DB, connect_db
+
+
+class UserStore(ABC):
+    """Interface for user account backends."""
+
+    # True when calls may block on I/O (run them with sessions.run_store())
+    blocking = False
+
+    @abstractmethod
+    def get(self, username: str) -> Optional[dict]:
+        """The account for a username, or None."""
+
+    @abstractmethod
+    def email_taken(self, email: str) -> bool:
+        """Whether an account already uses this email."""
+
+    @abstractmethod
+    def add(self, username: str, user: dict) -> bool:
+        """Create an account. Returns False if the username or email is taken."""
+
+
+class MemoryUserStore(UserStore):
+    """Process-local accounts."""
+
+    def __init__(self, seed: Dict[str, dict]):
+        self.users: Dict[str, dict] = {}
+        self.emails: Dict[str, str] = {}
+        for username, user in seed.items():
+            self.add(username, user)
+
+    def get(self, username: str) -> Optional[dict]:
+        return self.users.get(username)
+
+    def email_taken(self, email: str) -> bool:
+        return email in self.emails
+
+    def add(self, username: str, user: dict) -> bool:
+        if username in self.users or user["email"] in self.emails:
+            return False
+        self.users[username] = user
+        self.emails[user["email"]] = username
+        return True
+
+
+class SqliteUserStore(UserStore):
+    """Accounts in the SQLite auth database shared by all workers."""
+
+    blocking = True
+
+    def __init__(self, seed: Dict[str, dict], path: str = SESSION_DB):
+        self.db = connect_db(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                email TEXT NOT NULL UNIQUE,
+                data TEXT NOT NULL
+            )
+        """)
+        for username, user in seed.items():
+            self.add(username, user)
+
+    def get(self, username: str) -> Optional[dict]:
+        row = self.db.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def email_taken(self, email: str) -> bool:
+        return self.db.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone() is not None
+
+    def add(self, username: str, user: dict) -> bool:
+        try:
+            self.db.execute("INSERT INTO users VALUES (?, ?, ?)",
+                            (username, user["email"], json.dumps(user)))
+        except sqlite3.IntegrityError:
+            return False  # Taken, possibly by another worker just now
+        return True
+
+
+def create_user_store(seed: Dict[str, dict], backend: str = SESSION_BACKEND) -> UserStore:
+    """Build the user store matching SESSION_BACKEND, with the seed accounts."""
+    if backend == "sqlite":
+        return SqliteUserStore(seed)
+    return MemoryUserStore(seed)
@@ -1,13 +1,29 @@
 import { useState, useEffect, useCallback, useRef } from 'react';
 import { SensorData, SensorReading } from '@/types/sensor';
+import { FrameDecoder, FrameFormat, StreamReading, inflate } from '@/lib/frames';
+
+interface StreamControl {
+  type: string;
+  epoch?: string;
+  seq?: number;
+  readings?: StreamReading[];
+}
 
 interface UseWebSocketOptions {
   url: string;
   simulateData?: boolean;
   reconnectInterval?: number;
+  /** Ask the server for at most this many updates per second (e.g. 1 for wall displays) */
+  maxHz?: number;
+  /** Compact frames for low-bandwidth links: 'binary' or 'delta' (default 'json') */
+  format?: FrameFormat;
+  /** Have the server deflate every frame */
+  compress?: boolean;
 }
 
-export function useWebSocket({ url, simulateData = true, reconnectInterval = 3000 }: UseWebSocketOptions) {
+export function useWebSocket({
+  url, simulateData = true, reconnectInterval = 3000, maxHz, format = 'json', compress = false,
+}: UseWebSocketOptions) {
   const [isConnected, setIsConnected] = useState(false);
   const [currentData, setCurrentData] = useState<SensorReading | null>(null);
   const [history, setHistory] = useState<SensorReading[]>([]);
@@ -15,7 +31,8 @@ export function useWebSocket({ url, simulateData = true, reconnectInterval = 300
   const simulateIntervalRef = useRef<NodeJS.Timeout | null>(null);
 
   const determineStatus = useCallback((temp: number, gas: number): SensorData['status'] => {
-    if (temp > 45 || gas > 500) return 'DANGER';
+    // Mirrors the backend's default rules (backend/rules.json)
+    if (temp > 45 || gas > 1000) return 'DANGER';
     if (temp > 35 || gas > 300) return 'WARNING';
     return 'SAFE';
   }, []);
@@ -59,6 +76,36 @@ export function useWebSocket({ url, simulateData = true, reconnectInterval = 300
     });
   }, []);
 
+  // Position in the server's stream, so a reconnect only fetches what was missed
+  const lastSeqRef = useRef<number | null>(null);
+  const epochRef = useRef<string | null>(null);
+  const decoderRef = useRef(new FrameDecoder());
+  // Frames are handled one at a time, in order, even when inflating is async
+  const pendingRef = useRef<Promise<void>>(Promise.resolve());
+
+  const applySnapshot = useCallback((readings: SensorData[]) => {
+    // The server's first frame seeds the chart so a refresh doesn't start empty
+    const seeded = readings.map((data) => ({
+      ...data,
+      timestamp: data.timestamp ? new Date(data.timestamp) : new Date(),
+    }));
+    setHistory(seeded.slice(-20));
+    if (seeded.length) setCurrentData(seeded[seeded.length - 1]);
+  }, []);
+
+  const streamUrl = useCallback(() => {
+    const params = new URLSearchParams();
+    if (maxHz) params.set('max_hz', String(maxHz));
+    if (format !== 'json') params.set('format', format);
+    if (compress) params.set('compress', 'deflate');
+    if (lastSeqRef.current !== null && epochRef.current) {
+      params.set('last_seq', String(lastSeqRef.current));
+      params.set('epoch', epochRef.current);
+    }
+    const query = params.toString();
+    return query ? `${url}?${query}` : url;
+  }, [url, maxHz, format, compress]);
+
   const startSimulation = useCallback(() => {
     if (simulateIntervalRef.current) return;
     
@@ -86,25 +133,67 @@ export function useWebSocket({ url, simulateData = true, reconnectInterval = 300
     }
 
     try {
-      wsRef.current = new WebSocket(url);
+      wsRef.current = new WebSocket(streamUrl());
+      wsRef.current.binaryType = 'arraybuffer';
+      decoderRef.current.reset();
 
       wsRef.current.onopen = () => {
         setIsConnected(true);
         console.log('WebSocket connected');
       };
 
-      wsRef.current.onmessage = (event) => {
+      const handleFrame = async (data: string | ArrayBuffer) => {
         try {
-          const data: SensorData = JSON.parse(event.data);
-          addReading({
-            ...data,
-            timestamp: new Date(),
+          let text: string;
+          if (typeof data === 'string') {
+            text = data;
+          } else {
+            const bytes = compress ? await inflate(data) : data;
+            if (new Uint8Array(bytes)[0] === 0x01) {
+              // Packed readings (?format=binary / delta)
+              decoderRef.current.decode(bytes).forEach((reading) => {
+                if (reading.seq !== undefined) lastSeqRef.current = reading.seq;
+                addReading({ ...reading, timestamp: new Date() });
+              });
+              return;
+            }
+            text = new TextDecoder().decode(bytes);
+          }
+          const payload: StreamReading | StreamReading[] | StreamControl = JSON.parse(text);
+          if (!Array.isArray(payload) && 'type' in payload) {
+            // First frame: latest readings, or exactly the ones missed while reconnecting
+            if (payload.type === 'snapshot' || payload.type === 'replay') {
+              epochRef.current = payload.epoch ?? null;
+              lastSeqRef.current = payload.seq ?? null;
+              if (payload.type === 'snapshot') {
+                applySnapshot(payload.readings ?? []);
+              } else {
+                (payload.readings ?? []).forEach((data) => {
+                  addReading({ ...data, timestamp: data.timestamp ? new Date(data.timestamp) : new Date() });
+                });
+              }
+            }
+            // Other control replies (e.g. subscription acks) carry no readings
+            return;
+          }
+          // Batched ingestion broadcasts an array of readings in one frame
+          const readings = Array.isArray(payload) ? payload : [payload];
+          readings.forEach((data) => {
+            if (data.seq !== undefined) lastSeqRef.current = data.seq;
+            addReading({
+              ...data,
+              timestamp: new Date(),
+            });
           });
         } catch (err) {
           console.error('Failed to parse WebSocket message:', err);
         }
       };
 
+      wsRef.current.onmessage = (event) => {
+        pendingRef.current = pendingRef.current.then(() => handleFrame(event.data));
+      };
+
       wsRef.current.onclose = () => {
         setIsConnected(false);
         console.log('WebSocket disconnected');
@@ -121,7 +210,7 @@ export function useWebSocket({ url, simulateData = true, reconnectInterval = 300
       // Fall back to simulation
       startSimulation();
     }
-  }, [url, simulateData, reconnectInterval, addReading, startSimulation]);
+  }, [simulateData, reconnectInterval, compress, streamUrl, addReading, applySnapshot, startSimulation]);
 
   const disconnect = useCallback(() => {
     if (simulateData) {
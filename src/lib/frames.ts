@@ -0,0 +1,96 @@
+import { SensorData, SensorStatus } from '@/types/sensor';
+
+/** Frame formats offered by the backend's /ws endpoint (see backend/frames.py) */
+export type FrameFormat = 'json' | 'binary' | 'delta';
+
+export type StreamReading = SensorData & { seq?: number };
+
+const FRAME_BINARY = 0x01;
+const TEMPERATURE = 0x01;
+const GAS_LEVEL = 0x02;
+const HUMIDITY = 0x04;
+const STATUS = 0x08;
+const DELTA = 0x80;
+const STATUS_CODES: SensorStatus[] = ['SAFE', 'WARNING', 'DANGER'];
+
+interface DeviceState {
+  reading: StreamReading;
+  seq: number;
+  ms: number;
+}
+
+/** float32 back to the decimal that was sent (40.1, not 40.099998...) */
+const fromFloat32 = (value: number) => parseFloat(value.toPrecision(7));
+
+/**
+ * Decode binary frames. Keeps each device's last reading, which delta
+ * records build on, so use one decoder per connection.
+ * Timestamps come out in UTC, like the ones in JSON frames.
+ */
+export class FrameDecoder {
+  private devices = new Map<string, DeviceState>();
+  private text = new TextDecoder();
+
+  reset() {
+    this.devices.clear();
+  }
+
+  decode(buffer: ArrayBuffer): StreamReading[] {
+    const view = new DataView(buffer);
+    if (view.getUint8(0) !== FRAME_BINARY) throw new Error('Not a binary frame');
+    const readings: StreamReading[] = [];
+    let offset = 1;
+    while (offset < view.byteLength) {
+      const flags = view.getUint8(offset);
+      const length = view.getUint8(offset + 1);
+      offset += 2;
+      const deviceId = this.text.decode(new Uint8Array(buffer, offset, length));
+      offset += length;
+
+      let seq: number;
+      let ms: number;
+      let reading: StreamReading;
+      if (flags & DELTA) {
+        const previous = this.devices.get(deviceId);
+        if (!previous) throw new Error(`Delta record for ${deviceId} without a previous reading`);
+        seq = previous.seq + view.getUint32(offset, true);
+        ms = previous.ms + view.getInt32(offset + 4, true);
+        offset += 8;
+        reading = { ...previous.reading };
+      } else {
+        seq = Number(view.getBigUint64(offset, true));
+        ms = Math.round(view.getFloat64(offset + 8, true) * 1000);
+        offset += 16;
+        reading = { temperature: 0, gas_level: 0, humidity: 0, status: 'SAFE' };
+      }
+
+      if (flags & TEMPERATURE) {
+        reading.temperature = fromFloat32(view.getFloat32(offset, true));
+        offset += 4;
+      }
+      if (flags & GAS_LEVEL) {
+        reading.gas_level = view.getInt32(offset, true);
+        offset += 4;
+      }
+      if (flags & HUMIDITY) {
+        reading.humidity = fromFloat32(view.getFloat32(offset, true));
+        offset += 4;
+      }
+      if (flags & STATUS) {
+        reading.status = STATUS_CODES[view.getUint8(offset)];
+        offset += 1;
+      }
+
+      reading = { ...reading, device_id: deviceId, seq, timestamp: new Date(ms).toISOString() };
+      this.devices.set(deviceId, { reading, seq, ms });
+      readings.push(reading);
+    }
+    return readings;
+  }
+}
+
+/** Undo ?compress=deflate (each frame is raw-deflated by the server) */
+export async function inflate(data: ArrayBuffer): Promise<ArrayBuffer> {
+  const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream('deflate-raw'));
+  return new Response(stream).arrayBuffer();
+}
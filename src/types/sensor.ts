@@ -1,6 +1,7 @@
 export type SensorStatus = 'SAFE' | 'WARNING' | 'DANGER';
 
 export interface SensorData {
+  device_id?: string;
   temperature: number;
   gas_level: number;
   humidity: number;
@@ -9,6 +10,7 @@ export interface SensorData {
 }
 
 export interface SensorReading {
+  device_id?: string;
   temperature: number;
   gas_level: number;
   humidity: number;